@@ -0,0 +1,153 @@
+"""The AMI map (config/ami_map.json) with indexes and safe updates.
+
+The file is still a JSON object of AMI name to {'date': ..., region: AMI
+id, ...} so anything that reads it as JSON keeps working, but it's written
+with one AMI per line, sorted by name, which keeps it small and keeps diffs
+to one line per AMI however many thousands of AMIs it holds.
+
+Names look like persona-<tier>-<git hash> and are indexed by tier, hash,
+region and date:
+
+    registry = ami_registry.AmiRegistry('config/ami_map.json')
+    name, image_id = registry.latest('webhead', 'us-west-2')
+    registry.record('persona-webhead-1234abcd', 'us-east-1', 'ami-12345678')
+
+Every change re-reads the file under an exclusive lock, applies just that
+change and replaces the file atomically, so concurrent bakes can't lose
+each other's AMIs. Reads are cached until the file's mtime changes.
+"""
+
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+DATE_FORMAT = '%m/%d/%Y %H:%M'
+
+NAME_PATTERN = re.compile(r'^(?:persona|identity)-(?P<tier>.+)-(?P<hash>[0-9a-f]{7,40})$')
+
+class AmiRegistryError(Exception):
+    pass
+
+def parse_name(name):
+    """Return (tier, hash) for a baked AMI's name or (None, None)."""
+    match = NAME_PATTERN.match(name)
+    if not match:
+        return None, None
+    return match.group('tier'), match.group('hash')
+
+def parse_date(entry):
+    try:
+        return time.mktime(time.strptime(entry.get('date', ''), DATE_FORMAT))
+    except ValueError:
+        return 0
+
+def dumps(entries):
+    """Serialise entries one AMI per line."""
+    lines = ['    %s: %s' % (json.dumps(x), json.dumps(entries[x], sort_keys=True))
+             for x in sorted(entries)]
+    return '{\n%s\n}\n' % ',\n'.join(lines)
+
+class AmiRegistry:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.entries = {}
+        self.indexes = {}
+
+    def load(self):
+        """Return the entries, re-reading the file only if it has changed."""
+        with self.lock:
+            mtime = os.stat(self.filename).st_mtime
+            if mtime != self.mtime:
+                with open(self.filename, 'r') as f:
+                    self.entries = json.load(f)
+                self.mtime = mtime
+                self._index()
+            return self.entries
+
+    def _index(self):
+        indexes = {'tier': {}, 'hash': {}, 'region': {}}
+        for name, entry in self.entries.items():
+            tier, git_hash = parse_name(name)
+            if tier:
+                indexes['tier'].setdefault(tier, set()).add(name)
+                indexes['hash'].setdefault(git_hash, set()).add(name)
+            for region in entry:
+                # The map has some empty ids, which aren't AMIs
+                if region != 'date' and entry[region]:
+                    indexes['region'].setdefault(region, set()).add(name)
+        # Newest first
+        indexes['date'] = sorted(self.entries, key=lambda x: parse_date(self.entries[x]), reverse=True)
+        self.indexes = indexes
+
+    def get(self, name, region):
+        """Return the AMI id for name in region."""
+        entries = self.load()
+        if name not in entries:
+            raise AmiRegistryError('unable to find AMI %s in %s' % (name, self.filename))
+        if region == 'date' or not entries[name].get(region):
+            raise AmiRegistryError('AMI %s has not been copied to %s, it is only in %s' % (
+                name, region, ', '.join(sorted(x for x in entries[name] if x != 'date' and entries[name][x])) or 'no regions'))
+        return entries[name][region]
+
+    def find(self, tier=None, git_hash=None, region=None):
+        """Return the names of the AMIs matching everything given, newest
+        first."""
+        self.load()
+        names = None
+        for index, key in [('tier', tier), ('hash', git_hash), ('region', region)]:
+            if key is not None:
+                matches = self.indexes[index].get(key, set())
+                names = matches if names is None else names & matches
+        if names is None:
+            return list(self.indexes['date'])
+        return [x for x in self.indexes['date'] if x in names]
+
+    def latest(self, tier, region):
+        """Return (name, AMI id) of the newest AMI for tier in region, or
+        None."""
+        names = self.find(tier=tier, region=region)
+        if not names:
+            return None
+        return names[0], self.entries[names[0]][region]
+
+    def update(self, change):
+        """Apply change(entries), which modifies the entries in place, to
+        the current contents of the file under an exclusive lock."""
+        # The file itself is replaced on every write so the lock is taken on
+        # the directory it's in
+        lock = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.filename, 'r') as f:
+                entries = json.load(f)
+            change(entries)
+            with open(self.filename + '.tmp', 'w') as f:
+                f.write(dumps(entries))
+            os.rename(self.filename + '.tmp', self.filename)
+        finally:
+            os.close(lock)
+        with self.lock:
+            self.mtime = None
+
+    def record(self, name, region, image_id, date=None):
+        """Add or replace the AMI id for name in region."""
+        def change(entries):
+            entries.setdefault(name, {})[region] = image_id
+            entries[name]['date'] = date or time.strftime(DATE_FORMAT)
+        self.update(change)
+
+    def remove(self, name, regions=None):
+        """Remove name from regions, or entirely if no regions are given."""
+        def change(entries):
+            if name not in entries:
+                return
+            for region in regions or [x for x in entries[name] if x != 'date']:
+                entries[name].pop(region, None)
+            if not [x for x in entries[name] if x != 'date']:
+                del entries[name]
+        self.update(change)
@@ -0,0 +1,83 @@
+"""Turn the image names in the autoscale config into AMI ids.
+
+Names are looked up in the AMI map first. Any that aren't in it for the
+region are looked up in AWS with a single describe_images call filtered by
+owner and name, taking the newest available image with each name, so a new
+build only needs update_autoscale.py and not an edit to the AMI map as well.
+Answers are cached for TTL seconds.
+
+    image_ids = ami_resolver.resolve('us-west-2', ['persona-webhead-1234abcd',
+                                                   'persona-keysign-1234abcd'])
+"""
+
+import logging
+import threading
+import time
+
+import ami_registry
+import connections
+import stack_config
+
+class AmiResolver:
+    def __init__(self, owners=('self',), ttl=300, config=None):
+        self.owners = list(owners)
+        self.ttl = ttl
+        self.registry = (config or stack_config.get()).registry
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def _cached(self, region, name):
+        with self.lock:
+            if (region, name) in self.cache:
+                image_id, fetched = self.cache[(region, name)]
+                if time.time() - fetched < self.ttl:
+                    return image_id
+        return None
+
+    def resolve(self, region, names):
+        """Return a dict of name to AMI id in region for every name. Names
+        that are already AMI ids are returned as they are."""
+        resolved = {}
+        missing = []
+        for name in set(names):
+            if name.startswith('ami-'):
+                resolved[name] = name
+                continue
+            image_id = self._cached(region, name)
+            if image_id is None:
+                try:
+                    image_id = self.registry.get(name, region)
+                except ami_registry.AmiRegistryError:
+                    missing.append(name)
+                    continue
+            resolved[name] = image_id
+
+        if missing:
+            conn_ec2 = connections.connect('boto.ec2', region)
+            images = conn_ec2.get_all_images(owners=self.owners,
+                                             filters={'name': sorted(missing),
+                                                      'state': 'available'})
+            # The newest image with each name wins
+            for image in sorted(images, key=lambda x: getattr(x, 'creationDate', None) or ''):
+                resolved[image.name] = image.id
+            not_found = [x for x in missing if x not in resolved]
+            if not_found:
+                raise stack_config.ConfigError('unable to find AMIs %s in %s in the AMI map or owned by %s' % (
+                    ', '.join(sorted(not_found)), region, ', '.join(self.owners)))
+            logging.debug('resolved AMIs %s in %s from AWS' % (', '.join('%s=%s' % (x, resolved[x]) for x in sorted(missing)), region))
+
+        with self.lock:
+            for name, image_id in resolved.items():
+                self.cache[(region, name)] = (image_id, time.time())
+        return resolved
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+def resolve(region, names):
+    """resolve() with a resolver shared by the whole process."""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = AmiResolver()
+    return _resolver.resolve(region, names)
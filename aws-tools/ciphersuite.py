@@ -0,0 +1,182 @@
+"""The ELB ciphersuite policy from
+https://wiki.mozilla.org/Security/Server_Side_TLS and how to apply it.
+
+The policy's name ends in a hash of its attributes, so a load balancer that
+already has a policy with the current name has the current ciphersuite and
+changing POLICY_ATTRIBUTES produces a new name that every load balancer will
+pick up. The CreateLoadBalancerPolicy parameters are built once at import.
+A policy belongs to a load balancer, so it's created once per load balancer
+however many HTTPS listeners then use it.
+
+    ciphersuite.apply('us-west-2')
+
+brings every load balancer in a region up to date, describing them all
+once and updating those that need it concurrently.
+"""
+
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+
+import connections
+from inventory import Inventory
+
+POLICY_ATTRIBUTES = {"ADH-AES128-GCM-SHA256": False,
+                    "ADH-AES256-GCM-SHA384": False,
+                    "ADH-AES128-SHA": False,
+                    "ADH-AES128-SHA256": False,
+                    "ADH-AES256-SHA": False,
+                    "ADH-AES256-SHA256": False,
+                    "ADH-CAMELLIA128-SHA": False,
+                    "ADH-CAMELLIA256-SHA": False,
+                    "ADH-DES-CBC3-SHA": False,
+                    "ADH-DES-CBC-SHA": False,
+                    "ADH-RC4-MD5": False,
+                    "ADH-SEED-SHA": False,
+                    "AES128-GCM-SHA256": True,
+                    "AES256-GCM-SHA384": True,
+                    "AES128-SHA": True,
+                    "AES128-SHA256": True,
+                    "AES256-SHA": True,
+                    "AES256-SHA256": True,
+                    "CAMELLIA128-SHA": True,
+                    "CAMELLIA256-SHA": True,
+                    "DES-CBC3-MD5": False,
+                    "DES-CBC3-SHA": False,
+                    "DES-CBC-MD5": False,
+                    "DES-CBC-SHA": False,
+                    "DHE-DSS-AES128-GCM-SHA256": True,
+                    "DHE-DSS-AES256-GCM-SHA384": True,
+                    "DHE-DSS-AES128-SHA": True,
+                    "DHE-DSS-AES128-SHA256": True,
+                    "DHE-DSS-AES256-SHA": True,
+                    "DHE-DSS-AES256-SHA256": True,
+                    "DHE-DSS-CAMELLIA128-SHA": False,
+                    "DHE-DSS-CAMELLIA256-SHA": False,
+                    "DHE-DSS-SEED-SHA": False,
+                    "DHE-RSA-AES128-GCM-SHA256": True,
+                    "DHE-RSA-AES256-GCM-SHA384": True,
+                    "DHE-RSA-AES128-SHA": True,
+                    "DHE-RSA-AES128-SHA256": True,
+                    "DHE-RSA-AES256-SHA": True,
+                    "DHE-RSA-AES256-SHA256": True,
+                    "DHE-RSA-CAMELLIA128-SHA": False,
+                    "DHE-RSA-CAMELLIA256-SHA": False,
+                    "DHE-RSA-SEED-SHA": False,
+                    "EDH-DSS-DES-CBC3-SHA": False,
+                    "EDH-DSS-DES-CBC-SHA": False,
+                    "EDH-RSA-DES-CBC3-SHA": False,
+                    "EDH-RSA-DES-CBC-SHA": False,
+                    "EXP-ADH-DES-CBC-SHA": False,
+                    "EXP-ADH-RC4-MD5": False,
+                    "EXP-DES-CBC-SHA": False,
+                    "EXP-EDH-DSS-DES-CBC-SHA": False,
+                    "EXP-EDH-RSA-DES-CBC-SHA": False,
+                    "EXP-KRB5-DES-CBC-MD5": False,
+                    "EXP-KRB5-DES-CBC-SHA": False,
+                    "EXP-KRB5-RC2-CBC-MD5": False,
+                    "EXP-KRB5-RC2-CBC-SHA": False,
+                    "EXP-KRB5-RC4-MD5": False,
+                    "EXP-KRB5-RC4-SHA": False,
+                    "EXP-RC2-CBC-MD5": False,
+                    "EXP-RC4-MD5": False,
+                    "IDEA-CBC-SHA": False,
+                    "KRB5-DES-CBC3-MD5": False,
+                    "KRB5-DES-CBC3-SHA": False,
+                    "KRB5-DES-CBC-MD5": False,
+                    "KRB5-DES-CBC-SHA": False,
+                    "KRB5-RC4-MD5": False,
+                    "KRB5-RC4-SHA": False,
+                    "Protocol-SSLv2": False,
+                    "Protocol-SSLv3": True,
+                    "Protocol-TLSv1": True,
+                    "Protocol-TLSv1.1": True,
+                    "Protocol-TLSv1.2": True,
+                    "PSK-3DES-EDE-CBC-SHA": False,
+                    "PSK-AES128-CBC-SHA": False,
+                    "PSK-AES256-CBC-SHA": False,
+                    "PSK-RC4-SHA": False,
+                    "RC2-CBC-MD5": False,
+                    "RC4-MD5": False,
+                    "RC4-SHA": True,
+                    "SEED-SHA": False}
+
+POLICY_PREFIX = 'Mozilla-Security-Assurance-Ciphersuite-Policy'
+
+def policy_name(attributes):
+    content = ','.join('%s=%s' % (x, attributes[x]) for x in sorted(attributes.keys()))
+    return '%s-%s' % (POLICY_PREFIX, hashlib.sha1(content).hexdigest()[:12])
+
+def policy_params(attributes):
+    """Return the PolicyAttributes.member.N parameters for attributes."""
+    params = {}
+    for i, attribute in enumerate(sorted(attributes.keys())):
+        params['PolicyAttributes.member.%d.AttributeName' % (i + 1)] = attribute
+        params['PolicyAttributes.member.%d.AttributeValue' % (i + 1)] = str(attributes[attribute]).lower()
+    return params
+
+POLICY_NAME = policy_name(POLICY_ATTRIBUTES)
+POLICY_PARAMS = policy_params(POLICY_ATTRIBUTES)
+
+def has_policy(load_balancer):
+    """Whether the current policy has been created on a boto load balancer."""
+    return POLICY_NAME in [x.policy_name for x in load_balancer.policies.other_policies]
+
+def missing_ports(load_balancer):
+    """Return the HTTPS ports of a boto load balancer whose listeners don't
+    use the current policy."""
+    return sorted(int(x.load_balancer_port) for x in load_balancer.listeners
+                  if x.protocol.upper() == 'HTTPS' and POLICY_NAME not in (x.policy_names or []))
+
+def set_policy(region, load_balancer_name, ports, create_policy=True):
+    """Use the current policy on the listeners on ports, creating it on the
+    load balancer first unless create_policy is False. Returns the number
+    of calls made."""
+    conn_elb = connections.connect('boto.ec2.elb', region)
+    calls = 0
+    if create_policy:
+        params = dict(POLICY_PARAMS)
+        params.update({'LoadBalancerName': load_balancer_name,
+                       'PolicyName': POLICY_NAME,
+                       'PolicyTypeName': 'SSLNegotiationPolicyType'})
+        conn_elb.get_status('CreateLoadBalancerPolicy', params, verb='POST')
+        calls += 1
+    for port in ports:
+        conn_elb.get_status('SetLoadBalancerPoliciesOfListener',
+                            {'LoadBalancerName': load_balancer_name,
+                             'LoadBalancerPort': port,
+                             'PolicyNames.member.1': POLICY_NAME})
+        calls += 1
+        logging.debug("policy '%s' applied to port %s of load balancer %s in %s" % (POLICY_NAME, port, load_balancer_name, region))
+    return calls
+
+def update(region, load_balancer):
+    """Bring a boto load balancer up to date. Returns the ports updated."""
+    ports = missing_ports(load_balancer)
+    if ports:
+        set_policy(region, load_balancer.name, ports, not has_policy(load_balancer))
+    return ports
+
+def apply(region, names=None, max_workers=8, dry_run=False):
+    """Bring every load balancer in region, or only those named, up to date.
+
+    Returns a dict of load balancer name to the ports that were (or with
+    dry_run, would be) updated, leaving out load balancers that were
+    already up to date.
+    """
+    inventory = Inventory(region, ['load_balancers'])
+    load_balancers = inventory.named('load_balancers', names) if names else inventory.all('load_balancers')
+    if names:
+        for name in set(names) - set(x.name for x in load_balancers):
+            logging.error('unable to find load balancer %s in %s' % (name, region))
+    stale = [x for x in load_balancers if missing_ports(x)]
+    logging.info('%s of %s load balancers in %s need the ciphersuite policy %s' % (len(stale), len(load_balancers), region, POLICY_NAME))
+    if dry_run or not stale:
+        return dict((x.name, missing_ports(x)) for x in stale)
+    pool = ThreadPool(max(1, min(max_workers, len(stale))))
+    try:
+        results = pool.map(lambda x: update(region, x), stale)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip([x.name for x in stale], results))
@@ -0,0 +1,26 @@
+"""Per-thread boto connections.
+
+boto connection objects shouldn't be shared between threads, so anything
+that runs work concurrently asks for its connections here. Each thread gets
+its own connection per (service, region) and reuses it for the rest of the
+run.
+"""
+
+import importlib
+import threading
+
+_local = threading.local()
+
+def connect(service, region):
+    """Return this thread's connection for a boto service module and region.
+
+    service is the module name that provides connect_to_region, for example
+    'boto.ec2', 'boto.ec2.elb' or 'boto.ec2.autoscale'.
+    """
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+    key = (service, region)
+    if key not in _local.connections:
+        module = importlib.import_module(service)
+        _local.connections[key] = module.connect_to_region(region)
+    return _local.connections[key]
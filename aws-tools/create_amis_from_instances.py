@@ -1,114 +1,140 @@
 #!/usr/bin/env python
 
 import argparse
-import boto.ec2
-import json
 import time
 import logging
-#logging.basicConfig(level=logging.DEBUG)
-logging.basicConfig(level=logging.INFO)
+import sys
 
-def write_amimap(amimap, filename, dryrun=False):
-  if dryrun:
-    logging.info("Would have written ami_map.json")
-    print json.dumps(amimap, sort_keys=True, indent=4, separators=(',', ': '))
-  else:
-    with open(filename, 'w') as f:
-      json.dump(amimap, f, sort_keys=True, indent=4, separators=(',', ': '))
-    logging.debug("wrote ami_map to disk")
-  
-def wait_for_amis(conn_ec2, amis):
-  available_amis = []
-  while len(available_amis) < amis:
-    pending_amis = [x for x in amis if x not in available_amis]
-    logging.info("Waiting on AMIs to become available : %s" % pending_amis)
-    images = conn_ec2.get_all_images(image_ids=pending_amis)
-    for ami in pending_amis:
-      if ami.state == 'available':
-        available_amis.append(ami_id)
-    if len(available_amis) < amis:
-      time.sleep(10)
+def type_comma_delimited_string(string):
+  return string.split(',')
 
-parser = argparse.ArgumentParser(description='Create AMIs from instances')
-parser.add_argument('hash',
-                    help='git hash of identity-ops that the instances were created from')
-parser.add_argument('ips', nargs='+',
-                   help='IP addresses of the instances to snapshot')
-parser.add_argument('--amimap', default='/home/gene/Documents/coderepo/github.com/mozilla/identity-ops/aws-tools/config/ami_map.json',
-                   help='AMI map json filename (default: /home/gene/Documents/coderepo/github.com/mozilla/identity-ops/aws-tools/config/ami_map.json)')
-parser.add_argument('--region', default='us-west-2',
-                   help='AWS region containing intances (default: us-west-2)')
-parser.add_argument('--copy', 
-                   help='Region to copy resulting AMIs to')
-parser.add_argument('--wait', action="store_true",
-                    help="wait for AMIs to be available before exiting")
-parser.add_argument('--dryrun', action="store_true",
-                    help="don't actually change anything")
+def build_parser():
+  parser = argparse.ArgumentParser(description='Create AMIs from instances')
+  parser.add_argument('hash',
+                      help='git hash of identity-ops that the instances were created from')
+  parser.add_argument('ips', nargs='+',
+                     help='IP addresses of the instances to snapshot')
+  parser.add_argument('--amimap', default='/home/gene/Documents/coderepo/github.com/mozilla/identity-ops/aws-tools/config/ami_map.json',
+                     help='AMI map json filename (default: /home/gene/Documents/coderepo/github.com/mozilla/identity-ops/aws-tools/config/ami_map.json)')
+  parser.add_argument('--region', default='us-west-2',
+                     help='AWS region containing intances (default: us-west-2)')
+  parser.add_argument('--copy', type=type_comma_delimited_string, default=[],
+                     metavar='REGION,REGION...',
+                     help='Regions to copy resulting AMIs to as soon as each one is available')
+  parser.add_argument('--wait', action="store_true",
+                      help="wait for AMIs to be available before exiting")
+  parser.add_argument('--timeout', default=3600, type=int, metavar='SECONDS',
+                      help='how long to wait for AMIs to be available (default: 3600)')
+  parser.add_argument('--dryrun', action="store_true",
+                      help="don't actually change anything")
+  return parser
 
-args = parser.parse_args()
+class Bake:
+  def __init__(self, args):
+    import ami_registry
+    from tagging import TagAccumulator
+    self.args = args
+    self.today = time.strftime(ami_registry.DATE_FORMAT)
+    self.registry = ami_registry.AmiRegistry(args.amimap)
+    self.tags = TagAccumulator(args.region)
+    self.copy_tags = dict((x, TagAccumulator(x)) for x in args.copy)
 
-today = time.strftime('%m/%d/%Y %H:%M')
-conn_ec2 = boto.ec2.connect_to_region(args.region)
-reservations = conn_ec2.get_all_instances()
-instances = []
-for reservation in reservations:
-  for instance in reservation.instances:
-    if instance.private_ip_address in args.ips:
+  def record_ami(self, name, region, ami_id):
+    """Add an AMI to the map straight away so a failure later in the bake
+    doesn't lose the AMIs already made. Only this AMI is written, under a
+    lock, so concurrent bakes don't overwrite each other."""
+    if self.args.dryrun:
+      logging.info("Would have added AMI %s in %s to the AMI map as %s" % (ami_id, region, name))
+    else:
+      self.registry.record(name, region, ami_id, self.today)
+      logging.debug("added AMI %s in %s to the AMI map as %s" % (ami_id, region, name))
+
+  def create_image(self, instance):
+    import connections
+    name = "persona-%s-%s" % (instance['tier'], self.args.hash)
+    if self.args.dryrun:
+      logging.info("Would have created AMI from instance %s with name %s" % (instance['id'], name))
+      ami_id = 'ami-example'
+    else:
+      conn_ec2 = connections.connect('boto.ec2', self.args.region)
+      ami_id = conn_ec2.create_image(instance_id = instance['id'],
+                                     name = name,
+                                     description = name)
+      self.tags.add(ami_id, {'Name': name,
+                             'App': 'identity',
+                             'Tier': instance['tier']})
+      logging.info("Created AMI %s from instance %s with name %s" % (ami_id, instance['id'], name))
+    self.record_ami(name, self.args.region, ami_id)
+    return ami_id
+
+  def copy_image(self, ami, region):
+    import connections
+    conn_ec2 = connections.connect('boto.ec2', region)
+    ami_id = conn_ec2.copy_image(source_region = self.args.region,
+                                 source_image_id = ami.id,
+                                 name = ami.name,
+                                 description = ami.name).image_id
+    self.copy_tags[region].add(ami_id, dict(ami.tags, Name=ami.name))
+    logging.info("Copied ami %s with name %s from %s to %s resulting the in the new ami %s" % (ami.id, ami.name, self.args.region, region, ami_id))
+    self.record_ami(ami.name, region, ami_id)
+    return (region, ami_id)
+
+  def run(self, instances):
+    """Create an image of every instance at once and copy each one as soon
+    as it's available. Returns the (region, AMI id) of the copies."""
+    from multiprocessing.pool import ThreadPool
+    import waiters
+    args = self.args
+    pool = ThreadPool(max(1, len(instances)))
+    try:
+      created_amis = pool.map(self.create_image, instances)
+      self.tags.flush()
+
+      # Each copy starts as soon as its source is available rather than once
+      # every source is
+      copies = []
+      if args.dryrun:
+        for ami_id in created_amis:
+          for region in args.copy:
+            logging.info("Would have copied ami %s from %s to %s" % (ami_id, args.region, region))
+      elif args.copy or args.wait:
+        for region, ami_id, ami in waiters.wait_for_images([(args.region, x) for x in created_amis], timeout=args.timeout):
+          for copy_region in args.copy:
+            copies.append(pool.apply_async(self.copy_image, (ami, copy_region)))
+        copies = [x.get() for x in copies]
+        for copy_region in args.copy:
+          self.copy_tags[copy_region].flush()
+    finally:
+      pool.close()
+      pool.join()
+    return copies
+
+def main(argv=None):
+  #logging.basicConfig(level=logging.DEBUG)
+  logging.basicConfig(level=logging.INFO)
+  import connections
+  import waiters
+  parser = build_parser()
+  args = parser.parse_args(argv)
+
+  conn_ec2 = connections.connect('boto.ec2', args.region)
+  reservations = conn_ec2.get_all_instances(filters={'private-ip-address': args.ips})
+  instances = []
+  for reservation in reservations:
+    for instance in reservation.instances:
       logging.debug("instance : %s %s" % (instance.id, instance.tags['Tier']))
       instances.append({'id': instance.id,
                         'tier': instance.tags['Tier']})
+  missing_ips = set(args.ips) - set(x.private_ip_address for x in sum([x.instances for x in reservations], []))
+  if missing_ips:
+    parser.error("Unable to find instances with IP addresses %s in %s" % (sorted(missing_ips), args.region))
 
-with open(args.amimap, 'r') as f:
-  amimap = json.load(f)
-
-created_amis = []
-for instance in instances:
-  name = "persona-%s-%s" % (instance['tier'], args.hash)
-  if not name in amimap:
-    amimap[name] = {}
-  if args.dryrun:
-    logging.info("Would have created AMI from instance %s with name %s" % (instance['id'], name))
-    ami_id = 'ami-example'
-  else:
-    ami_id = conn_ec2.create_image(instance_id = instance['id'],
-                                   name = name,
-                                   description = name)
-    # TODO : tag the ami
-    logging.info("Created AMI %s from instance %s with name %s" % (ami_id, instance['id'], name))
-  amimap[name][args.region] = ami_id
-  amimap[name]['date'] = today
-  created_amis.append(ami_id)
+  copies = Bake(args).run(instances)
 
-write_amimap(amimap, args.amimap, args.dryrun)
+  if args.wait and copies:
+    for region, ami_id, image in waiters.wait_for_images(copies, timeout=args.timeout):
+      logging.info("AMI %s in %s is available" % (ami_id, region))
+  return 0
 
-if args.copy:
-  conn_ec2 = boto.ec2.connect_to_region(args.copy)
-  created_amis = []
-  copied_amis = []
-  while len(copied_amis) < created_amis:
-    pending_amis = [x for x in created_amis if x not in copied_amis]
-    logging.info("Waiting on AMIs to become available : %s" % pending_amis)
-    images = conn_ec2.get_all_images(image_ids=pending_amis)
-    for ami in pending_amis:
-      if ami.state == 'available':
-        if args.dryrun:
-          logging.info("Would have copied ami %s with name %s from %s to %s" % (ami.id, name, args.region, args.copy))
-          ami_id = 'ami-copy-example'
-        else:
-          ami_id = conn_ec2.copy_image(source_region = args.region, 
-                                       source_image_id = ami.id, 
-                                       name = ami.name, 
-                                       description = ami.name)
-          # TODO : tag the ami
-          logging.info("Copied ami %s with name %s from %s to %s resulting the in the new ami %s" % (ami.id, name, args.region, args.copy, ami_id))
-          created_amis.append(ami_id)
-        if not ami.name in amimap:
-          amimap[ami.name] = {}
-        amimap[ami.name][args.copy] = ami_id
-        amimap[ami.name][date] = today
-        copied_amis.append(ami.id)
-    if len([x for x in pending_amis if x.state != 'available']) > 0:
-      time.sleep(10)
-  write_amimap(amimap, args.amimap, args.dryrun)
-if args.wait:
-  wait_for_amis(conn_ec2, created_amis)
\ No newline at end of file
+if __name__ == '__main__':
+  sys.exit(main())
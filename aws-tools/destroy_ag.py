@@ -1,48 +1,32 @@
 import logging
 logging.basicConfig(level=logging.INFO)
-import time
 
-def destroy_autoscale_group(name):
+import teardown
+from inventory import Inventory
+
+def destroy_autoscale_groups(names):
   import boto.ec2
-  import boto.ec2.elb
-  import boto.ec2.autoscale
   region = 'us-west-2'
 
-  conn_autoscale = boto.ec2.autoscale.connect_to_region(region)
-  conn_elb = boto.ec2.elb.connect_to_region(region)
   conn_ec2 = boto.ec2.connect_to_region(region)
 
-  autoscale_group = conn_autoscale.get_all_groups([name])[0]
-  launch_configuration = conn_autoscale.get_all_launch_configurations(names=[name])[0]
-  load_balancers = autoscale_group.load_balancers
-  existing_load_balancers = conn_elb.get_all_load_balancers()
-  existing_addresses = conn_ec2.get_all_addresses()
-
-  for address in [x for x in existing_addresses if x.instance_id in [y.instance_id for y in autoscale_group.instances]]:
-      if not conn_ec2.disassociate_address(association_id=address.association_id):
-          logging.error('failed to disassociate eip %s from instance %s' % (address.public_ip, address.instance_id))
-      if not conn_ec2.release_address(allocation_id=address.allocation_id):
-          logging.error('failed to release eip %s' % address.public_ip)
-
-  autoscale_group.shutdown_instances()
-
-  attempts=0
-  while True:
-      try:
-          attempts += 1
-          autoscale_group.delete()
-          break
-      except boto.exception.BotoServerError:
-          logging.info('waiting 10 seconds for instances to finish shutting down')
-          time.sleep(10)
-          if attempts > 30:
-              logging.error('unable to delete autoscale group %s after 5 minutes' % autoscale_group.name)
-              autoscale_group.get_activities()
-              raise
-  launch_configuration.delete()
-  for load_balancer in [x for x in existing_load_balancers if x.name in load_balancers]:
-    load_balancer.delete()
-  logging.info('ag %s destroyed' % name)
+  inventory = Inventory(region, ['autoscale_groups', 'launch_configurations', 'load_balancers', 'addresses'])
+  autoscale_groups = inventory.named('autoscale_groups', names)
+  launch_configurations = inventory.named('launch_configurations', names)
+  load_balancers = inventory.named('load_balancers', set(sum([x.load_balancers for x in autoscale_groups], [])))
+
+  for autoscale_group in autoscale_groups:
+    for address in sum([inventory.find('addresses', 'instance', x.instance_id) for x in autoscale_group.instances], []):
+        if not conn_ec2.disassociate_address(association_id=address.association_id):
+            logging.error('failed to disassociate eip %s from instance %s' % (address.public_ip, address.instance_id))
+        if not conn_ec2.release_address(allocation_id=address.allocation_id):
+            logging.error('failed to release eip %s' % address.public_ip)
+
+  teardown.teardown(region, autoscale_groups, launch_configurations, load_balancers)
+  logging.info('ags %s destroyed' % ', '.join(names))
+
+def destroy_autoscale_group(name):
+  destroy_autoscale_groups([name])
 
 if __name__ == '__main__':
   import argparse
@@ -51,5 +35,4 @@ if __name__ == '__main__':
                      help='name of the autoscale group')
 
   args = parser.parse_args()
-  for name in args.names:
-      destroy_autoscale_group(name)
\ No newline at end of file
+  destroy_autoscale_groups(args.names)
\ No newline at end of file
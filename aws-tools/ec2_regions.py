@@ -0,0 +1,67 @@
+"""The list of EC2 regions, without asking AWS for it every time.
+
+regions() answers from a copy cached on disk if it's fresher than TTL and
+otherwise from the list bundled here, so it never touches the network.
+refresh() asks AWS and rewrites the cache; call it once there's going to be
+network traffic anyway, or when a region isn't in the list.
+
+    if region not in ec2_regions.regions() and region not in ec2_regions.refresh():
+        raise ValueError('unknown region %s' % region)
+"""
+
+import json
+import logging
+import os
+import time
+
+BUNDLED_REGIONS = ['ap-northeast-1',
+                   'ap-southeast-1',
+                   'ap-southeast-2',
+                   'eu-west-1',
+                   'sa-east-1',
+                   'us-east-1',
+                   'us-west-1',
+                   'us-west-2']
+
+CACHE_FILENAME = os.path.join(os.path.expanduser('~'), '.identity-ops', 'regions.json')
+
+# A week
+TTL = 7 * 24 * 60 * 60
+
+def _read_cache():
+    try:
+        with open(CACHE_FILENAME, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def is_stale():
+    cache = _read_cache()
+    return cache is None or time.time() - cache.get('fetched', 0) > TTL
+
+def regions():
+    """Return the region names from the cache or the bundled list."""
+    cache = _read_cache()
+    if cache is None or time.time() - cache.get('fetched', 0) > TTL:
+        return list(BUNDLED_REGIONS)
+    return cache['regions']
+
+def refresh():
+    """Fetch the region names from AWS, cache them and return them. If AWS
+    can't be reached the list from regions() is returned instead."""
+    import boto.ec2
+    import boto.exception
+    try:
+        names = sorted(x.name for x in boto.ec2.connect_to_region('us-east-1').get_all_regions())
+    except (boto.exception.BotoClientError, boto.exception.BotoServerError, IOError) as error:
+        logging.warning('unable to fetch the list of regions : %s' % error)
+        return regions()
+    try:
+        if not os.path.isdir(os.path.dirname(CACHE_FILENAME)):
+            os.makedirs(os.path.dirname(CACHE_FILENAME))
+        with open(CACHE_FILENAME + '.tmp', 'w') as f:
+            json.dump({'fetched': time.time(), 'regions': names}, f)
+        os.rename(CACHE_FILENAME + '.tmp', CACHE_FILENAME)
+    except (IOError, OSError) as error:
+        logging.warning('unable to cache the list of regions in %s : %s' % (CACHE_FILENAME, error))
+    return names
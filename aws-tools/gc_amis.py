@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Deregister baked AMIs that nothing uses any more and delete their
+snapshots.
+
+usage: gc_amis.py [-h] [-r REGION,REGION...] [-k COUNT] [--amimap FILENAME]
+                  [--rate CALLS] [-d]
+
+An AMI is kept if it is
+  * named in one of the config/autoscale.*.json files, whether or not it's
+    in the AMI map
+  * used by a launch configuration or instance in its region
+  * one of the newest --keep AMIs of its tier in the AMI map
+  * in the AMI map without being a baked tier image (base and NAT AMIs)
+
+Only AMIs owned by this account with baked names (persona-<tier>-<hash>)
+are ever removed. Regions are cleaned up concurrently and each region's
+API calls are limited to --rate calls per second. --dryrun prints what
+would be removed and why everything else is kept.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import ami_registry
+
+class RateLimiter:
+  """Let at most rate calls a second through wait()."""
+  def __init__(self, rate):
+    self.interval = 1.0 / rate
+    self.lock = threading.Lock()
+    self.next_call = 0
+
+  def wait(self):
+    with self.lock:
+      now = time.time()
+      delay = self.next_call - now
+      self.next_call = max(now, self.next_call) + self.interval
+    if delay > 0:
+      time.sleep(delay)
+
+def type_comma_delimited_string(string):
+  return string.split(',')
+
+def build_parser():
+  parser = argparse.ArgumentParser(description='Deregister unused AMIs and delete their snapshots')
+  parser.add_argument('-r', '--regions', default=['us-west-2', 'us-east-1'],
+                      type=type_comma_delimited_string,
+                      metavar='REGION,REGION...',
+                      help='AWS regions to clean up (default: us-west-2,us-east-1)')
+  parser.add_argument('-k', '--keep', default=3, type=int, metavar='COUNT',
+                      help='Number of the newest AMIs of each tier to keep (default: 3)')
+  parser.add_argument('--amimap', default='config/ami_map.json', metavar='FILENAME',
+                      help='AMI map json filename (default: config/ami_map.json)')
+  parser.add_argument('--rate', default=5, type=float, metavar='CALLS',
+                      help='Most API calls per second in each region (default: 5)')
+  parser.add_argument('-d', '--dryrun', action="store_true",
+                      help="don't actually change anything, just report")
+  return parser
+
+def configured_names(config_dir):
+  """Return the image names used by every autoscale.*.json file."""
+  import stack_config
+  config = stack_config.get(config_dir)
+  names = set()
+  for filename in glob.glob(os.path.join(config_dir, 'autoscale.*.json')):
+    stack_type = os.path.basename(filename).split('.')[1]
+    names.update(x['launch_configuration']['image_id'] for x in config.autoscale(stack_type))
+  return names
+
+def referenced(registry, region, keep, names):
+  """Return a dict of AMI id to why it's kept in region from the AMI map."""
+  entries = registry.load()
+  reasons = {}
+  for name in names:
+    if name.startswith('ami-'):
+      reasons[name] = 'in autoscale config'
+    elif region in entries.get(name, {}):
+      reasons[entries[name][region]] = 'in autoscale config as %s' % name
+  tiers = set(ami_registry.parse_name(x)[0] for x in entries) - set([None])
+  for tier in tiers:
+    for name in registry.find(tier=tier, region=region)[:keep]:
+      reasons.setdefault(entries[name][region], 'one of the newest %s %s AMIs' % (keep, tier))
+  for name, entry in entries.items():
+    if ami_registry.parse_name(name)[0] is None and region in entry:
+      reasons.setdefault(entry[region], 'base AMI %s' % name)
+  return reasons
+
+def collect(region, registry, keep, names, rate, dryrun):
+  """Work out what to remove in region and, unless dryrun, remove it.
+  Returns a list of (AMI id, name, snapshot ids, reason kept or None)."""
+  import connections
+  from inventory import Inventory
+  conn_ec2 = connections.connect('boto.ec2', region)
+  limiter = RateLimiter(rate)
+
+  reasons = referenced(registry, region, keep, names)
+  inventory = Inventory(region, ['launch_configurations'])
+  for launch_configuration in inventory.all('launch_configurations'):
+    reasons.setdefault(launch_configuration.image_id, 'used by launch configuration %s' % launch_configuration.name)
+  limiter.wait()
+  for reservation in conn_ec2.get_all_instances(filters={'instance-state-name': ['pending', 'running', 'stopping', 'stopped']}):
+    for instance in reservation.instances:
+      reasons.setdefault(instance.image_id, 'used by instance %s' % instance.id)
+
+  limiter.wait()
+  images = [x for x in conn_ec2.get_all_images(owners=['self'])
+            if ami_registry.parse_name(x.name or '')[0] is not None]
+  report = []
+  for image in sorted(images, key=lambda x: x.name):
+    snapshot_ids = [x.snapshot_id for x in image.block_device_mapping.values() if x.snapshot_id]
+    reason = reasons.get(image.id)
+    if reason is None and image.name in names:
+      # ami_resolver deploys configured names straight from AWS, so an
+      # image doesn't have to be in the AMI map to be in use
+      reason = 'in autoscale config as %s' % image.name
+    report.append((image.id, image.name, snapshot_ids, reason))
+  if dryrun:
+    return report
+
+  def remove(item):
+    image_id, name, snapshot_ids, reason = item
+    conn = connections.connect('boto.ec2', region)
+    limiter.wait()
+    conn.deregister_image(image_id)
+    logging.info('deregistered AMI %s (%s) in %s' % (image_id, name, region))
+    for snapshot_id in snapshot_ids:
+      limiter.wait()
+      conn.delete_snapshot(snapshot_id)
+      logging.info('deleted snapshot %s of AMI %s in %s' % (snapshot_id, image_id, region))
+    if region in registry.load().get(name, {}):
+      registry.remove(name, [region])
+  pool = ThreadPool(4)
+  try:
+    pool.map(remove, [x for x in report if x[3] is None])
+  finally:
+    pool.close()
+    pool.join()
+  return report
+
+def main(argv=None):
+  logging.basicConfig(level=logging.INFO)
+  args = build_parser().parse_args(argv)
+  registry = ami_registry.AmiRegistry(args.amimap)
+  config_dir = os.path.dirname(args.amimap) or '.'
+  names = configured_names(config_dir)
+  if not names:
+    # Without the autoscale config nothing that's deployed is protected
+    logging.error('no images are named in %s/autoscale.*.json, not collecting anything' % config_dir)
+    return 1
+
+  pool = ThreadPool(len(args.regions))
+  try:
+    reports = pool.map(lambda region: collect(region, registry, args.keep, names, args.rate, args.dryrun),
+                       args.regions)
+  finally:
+    pool.close()
+    pool.join()
+
+  for region, report in zip(args.regions, reports):
+    removed = [x for x in report if x[3] is None]
+    print "# %s : %s AMIs, %s %s" % (region, len(report), len(removed),
+                                     'would be removed' if args.dryrun else 'removed')
+    for image_id, name, snapshot_ids, reason in report:
+      if reason is None:
+        print "remove %s %s snapshots %s" % (image_id, name, ','.join(snapshot_ids) or 'none')
+      else:
+        print "keep   %s %s : %s" % (image_id, name, reason)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""One command line for the aws-tools.
+
+    identity_ops.py create --stack-type stage --application persona --name 1234
+    identity_ops.py destroy --stack-type stage --name 1234 --regions us-west-2,us-east-1
+    identity_ops.py show --stack-type prod --name 1234
+    identity_ops.py plan --stack-type stage --application persona --name 1234 [--yes]
+    identity_ops.py point-dns --stack-type stage --application persona --name 1234
+    identity_ops.py provision --region us-east-1
+    identity_ops.py drift --region us-east-1 --environment identity-prod [--apply]
+    identity_ops.py publish-amis [publish_amis.py arguments]
+    identity_ops.py bake [create_amis_from_instances.py arguments]
+    identity_ops.py gc [gc_amis.py arguments]
+
+Only argparse is imported up front. Each subcommand imports the modules it
+needs, and so boto, when it runs, so --help and scripted calls don't pay
+for anything they don't use.
+"""
+
+import argparse
+import logging
+import sys
+
+# Subcommands that hand the rest of the command line to another script
+PASSTHROUGH = {'publish-amis': ('publish_amis', 'copy AMIs to regions and share them'),
+               'bake': ('create_amis_from_instances', 'create AMIs from instances and copy them'),
+               'gc': ('gc_amis', 'deregister unused AMIs and delete their snapshots')}
+
+def type_comma_delimited_string(string):
+    return string.split(',')
+
+def create(args):
+    import regions
+    results = regions.create_stacks(args.regions,
+                                    environment=args.environment,
+                                    stack_type=args.stack_type,
+                                    application=args.application,
+                                    path=args.path,
+                                    name=args.name,
+                                    replace=args.replace,
+                                    key_name=args.key_name,
+                                    mini_stack=args.mini_stack,
+                                    generic=args.generic,
+                                    hydrate=args.hydrate)
+    results.raise_for_failures()
+
+def destroy(args):
+    import regions
+    regions.destroy_stacks(args.regions, args.environment, args.stack_type, args.name).raise_for_failures()
+
+def show(args):
+    import regions
+    regions.show_stacks(args.regions, args.environment, args.stack_type, args.name).raise_for_failures()
+
+def plan(args):
+    import regions
+    import stack_plan
+    proposed = stack_plan.plan_stack(args.region,
+                                    environment=args.environment,
+                                    stack_type=args.stack_type,
+                                    application=args.application,
+                                    availability_zones=args.availability_zones or regions.AVAILABILITY_ZONES[args.region],
+                                    path=args.path,
+                                    name=args.name,
+                                    key_name=args.key_name,
+                                    mini_stack=args.mini_stack,
+                                    generic=args.generic,
+                                    hydrate=args.hydrate)
+    stack_plan.print_plan(proposed)
+    if not proposed.changes:
+        return 0
+    if not args.yes:
+        try:
+            answer = raw_input('Apply these changes? [y/N] ')
+        except EOFError:
+            answer = ''
+        if answer.strip().lower() not in ['y', 'yes']:
+            print "Not applying"
+            return 1
+    stack_plan.apply_stack(proposed)
+
+def point_dns(args):
+    import stack_control
+    stack_control.point_dns_to_stack(region=args.region,
+                                     stack_type=args.stack_type,
+                                     application=args.application,
+                                     name=args.name)
+
+def provision(args):
+    import provision_aws_services
+    import regions
+    secrets = provision_aws_services.get_secrets()
+    if args.global_resources:
+        provision_aws_services.global_one_time_provision(secrets, args.path)
+    provision_aws_services.one_time_provision(secrets,
+                                              args.path,
+                                              args.region,
+                                              args.availability_zones or regions.AVAILABILITY_ZONES[args.region],
+                                              args.key_name,
+                                              journal_filename=args.journal,
+                                              nat_topology=args.nat_topology,
+                                              nat_instance_type=args.nat_instance_type)
+
+def drift(args):
+    import security_groups
+    changes = security_groups.drift(args.region, args.environment, apply=args.apply)
+    # Like diff, exit 1 when there are differences left
+    return 1 if changes and not args.apply else 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Build and manage identity stacks in AWS')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log debugging output')
+    subparsers = parser.add_subparsers(title='commands', metavar='COMMAND')
+
+    def stack_command(name, func, help, application=False):
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        subparser.set_defaults(func=func)
+        subparser.add_argument('--regions', default=['us-west-2'],
+                               type=type_comma_delimited_string, metavar='REGION,REGION...',
+                               help='regions to work in, all at once (default: us-west-2)')
+        subparser.add_argument('--environment', default='identity-dev',
+                               help='VPC the stack is in (default: identity-dev)')
+        subparser.add_argument('--stack-type', required=True, choices=['dev', 'stage', 'prod'])
+        if application:
+            subparser.add_argument('--application', required=True,
+                                   help='application to build, for example persona or bridge-yahoo')
+        return subparser
+
+    subparser = stack_command('create', create, 'create a stack', application=True)
+    subparser.add_argument('--name', help='stack name, at most 4 characters (default: random)')
+    subparser.add_argument('--path', default='/identity/',
+                           help='IAM path of the server certificates (default: /identity/)')
+    subparser.add_argument('--key-name', help='EC2 key pair for the instances')
+    subparser.add_argument('--replace', action='store_true',
+                           help='replace load balancers that already exist')
+    subparser.add_argument('--mini-stack', action='store_true',
+                           help='run one instance per tier')
+    subparser.add_argument('--generic', action='store_true',
+                           help='use generic user data')
+    subparser.add_argument('--no-hydrate', dest='hydrate', action='store_false',
+                           help="don't run chef on boot")
+
+    subparser = stack_command('destroy', destroy, 'destroy a stack')
+    subparser.add_argument('--name', required=True)
+
+    subparser = stack_command('show', show, 'show a stack\'s load balancers')
+    subparser.add_argument('--name', required=True)
+
+    subparser = subparsers.add_parser('plan', help='show the changes that would converge a stack on its config and apply them',
+                                      description='show the changes that would converge a stack on its config '
+                                                  'and, once confirmed, apply them')
+    subparser.set_defaults(func=plan)
+    subparser.add_argument('--region', default='us-west-2')
+    subparser.add_argument('--environment', default='identity-dev',
+                           help='VPC the stack is in (default: identity-dev)')
+    subparser.add_argument('--stack-type', required=True, choices=['dev', 'stage', 'prod'])
+    subparser.add_argument('--application', required=True,
+                           help='application to build, for example persona or bridge-yahoo')
+    subparser.add_argument('--name', required=True)
+    subparser.add_argument('--availability-zones', type=type_comma_delimited_string,
+                           metavar='ZONE,ZONE...',
+                           help='availability zone letters (default: regions.AVAILABILITY_ZONES)')
+    subparser.add_argument('--path', default='/identity/',
+                           help='IAM path of the server certificates (default: /identity/)')
+    subparser.add_argument('--key-name', help='EC2 key pair for the instances')
+    subparser.add_argument('--mini-stack', action='store_true',
+                           help='run one instance per tier')
+    subparser.add_argument('--generic', action='store_true',
+                           help='use generic user data')
+    subparser.add_argument('--no-hydrate', dest='hydrate', action='store_false',
+                           help="don't run chef on boot")
+    subparser.add_argument('-y', '--yes', action='store_true',
+                           help='apply the changes without asking')
+
+    subparser = subparsers.add_parser('point-dns', help='point DNS at a stack\'s load balancers',
+                                      description='point DNS at a stack\'s load balancers')
+    subparser.set_defaults(func=point_dns)
+    subparser.add_argument('--region', default='us-west-2')
+    subparser.add_argument('--stack-type', required=True, choices=['stage', 'prod'])
+    subparser.add_argument('--application', required=True)
+    subparser.add_argument('--name', required=True)
+
+    subparser = subparsers.add_parser('provision', help='provision a region\'s VPCs',
+                                      description='provision a region\'s VPCs')
+    subparser.set_defaults(func=provision)
+    subparser.add_argument('--region', required=True)
+    subparser.add_argument('--availability-zones', type=type_comma_delimited_string,
+                           metavar='ZONE,ZONE...',
+                           help='availability zone letters (default: regions.AVAILABILITY_ZONES)')
+    subparser.add_argument('--path', default='/identity/',
+                           help='IAM path of the server certificates (default: /identity/)')
+    subparser.add_argument('--key-name', help='EC2 key pair for the NAT instances')
+    subparser.add_argument('--nat-topology', choices=['single', 'per-az'], default='single',
+                           help='one NAT instance for the VPC or one, with its own private route table, '
+                                'per availability zone (default: single)')
+    subparser.add_argument('--nat-instance-type', default='t1.micro',
+                           help='NAT instance type, which must run the i386 NAT AMI (default: t1.micro)')
+    subparser.add_argument('--journal', metavar='FILENAME',
+                           help='journal to resume from and record to (default: ~/.identity-ops/provision-REGION.json)')
+    subparser.add_argument('--global', dest='global_resources', action='store_true',
+                           help='upload the server certificates first')
+
+    subparser = subparsers.add_parser('drift', help='compare a VPC\'s security groups with security_groups.json',
+                                      description='compare a VPC\'s security groups with security_groups.json '
+                                                  'and print the rules to authorize and revoke')
+    subparser.set_defaults(func=drift)
+    subparser.add_argument('--region', required=True)
+    subparser.add_argument('--environment', default='identity-dev',
+                           help='VPC to check (default: identity-dev)')
+    subparser.add_argument('--apply', action='store_true',
+                           help='authorize and revoke rules until the groups match')
+
+    for name in sorted(PASSTHROUGH):
+        subparsers.add_parser(name, help='%s (see %s --help)' % (PASSTHROUGH[name][1], name), add_help=False)
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    verbose = bool(argv) and argv[0] in ['-v', '--verbose']
+    command_argv = argv[1:] if verbose else argv
+    if command_argv and command_argv[0] in PASSTHROUGH:
+        # These scripts have their own arguments and logging set up
+        module = __import__(PASSTHROUGH[command_argv[0]][0])
+        return module.main(command_argv[1:])
+
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    return args.func(args) or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""A snapshot of the resources in an account's region, fetched once.
+
+Each kind of resource is fetched with one describe call (following
+pagination) and all the kinds asked for are fetched concurrently. Lookups
+then go through hash indexes instead of scanning lists:
+
+    inventory = Inventory(region, ['vpcs', 'subnets', 'security_groups'])
+    vpc = inventory.get('vpcs', 'tag:Name', 'identity-dev')
+    subnets = inventory.find('subnets', 'vpc', vpc.id)
+    security_groups = inventory.named('security_groups', ['identity-dev-admin'])
+
+After creating or deleting something, refresh just those resources with
+inventory.refresh(kind, ids) or drop them with inventory.forget(kind, ids).
+"""
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import connections
+
+# kind : (boto module, describe method, keyword argument that limits the
+#         describe to a list of ids)
+KINDS = {'vpcs': ('boto.vpc', 'get_all_vpcs', 'vpc_ids'),
+         'subnets': ('boto.vpc', 'get_all_subnets', 'subnet_ids'),
+         'security_groups': ('boto.ec2', 'get_all_security_groups', 'group_ids'),
+         'addresses': ('boto.ec2', 'get_all_addresses', 'allocation_ids'),
+         'load_balancers': ('boto.ec2.elb', 'get_all_load_balancers', 'load_balancer_names'),
+         'autoscale_groups': ('boto.ec2.autoscale', 'get_all_groups', 'names'),
+         'launch_configurations': ('boto.ec2.autoscale', 'get_all_launch_configurations', 'names')}
+
+# kind : (result attribute with the next page's token, keyword argument to
+#         pass it back in) for kinds that don't use next_token
+PAGINATION = {'load_balancers': ('next_marker', 'marker')}
+
+INDEXED_TAGS = ['Name', 'Stack', 'Tier']
+
+def get_tags(resource):
+    """Return a resource's tags as a dict whatever the service."""
+    tags = getattr(resource, 'tags', None) or {}
+    if isinstance(tags, dict):
+        return tags
+    # autoscale groups have a list of Tag objects
+    return dict((x.key, x.value) for x in tags)
+
+def get_id(kind, resource):
+    if kind == 'addresses':
+        return resource.allocation_id or resource.public_ip
+    if kind in ['load_balancers', 'autoscale_groups', 'launch_configurations']:
+        return resource.name
+    return resource.id
+
+def get_name(kind, resource):
+    if kind in ['vpcs', 'subnets']:
+        return get_tags(resource).get('Name')
+    if kind == 'addresses':
+        return resource.public_ip
+    return resource.name
+
+class Inventory:
+    def __init__(self, region, kinds=None, max_workers=8):
+        self.region = region
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.indexes = {}
+        self.fetch(kinds or KINDS.keys())
+
+    def _describe(self, kind, ids=None):
+        module, method, ids_argument = KINDS[kind]
+        conn = connections.connect(module, self.region)
+        kwargs = {}
+        if ids is not None:
+            kwargs[ids_argument] = list(ids)
+        # ELB pages with a marker, everything else with a token
+        token_attribute, token_argument = PAGINATION.get(kind, ('next_token', 'next_token'))
+        resources = []
+        while True:
+            result = getattr(conn, method)(**kwargs)
+            resources.extend(result)
+            next_token = getattr(result, token_attribute, None)
+            if not next_token:
+                return resources
+            kwargs[token_argument] = next_token
+
+    def fetch(self, kinds):
+        """(Re)fetch every resource of each kind, concurrently."""
+        kinds = list(kinds)
+        pool = ThreadPool(max(1, min(self.max_workers, len(kinds))))
+        try:
+            results = pool.map(self._describe, kinds)
+        finally:
+            pool.close()
+            pool.join()
+        with self.lock:
+            for kind, resources in zip(kinds, results):
+                self.resources[kind] = dict((get_id(kind, x), x) for x in resources)
+                self._index(kind)
+                logging.debug('inventory of %s in %s : %s %s' % (kind, self.region, len(resources), kind))
+
+    def refresh(self, kind, ids=None):
+        """Re-describe only the given resources of a kind (by id, or by name
+        for load balancers and autoscale resources), or the whole kind if no
+        ids are given. Resources that no longer exist are dropped."""
+        if ids is None:
+            return self.fetch([kind])
+        import boto.exception
+        ids = list(ids)
+        if not ids:
+            return
+        try:
+            resources = self._describe(kind, ids)
+        except boto.exception.BotoServerError:
+            # Some describes fail outright if any of the ids doesn't exist
+            return self.fetch([kind])
+        with self.lock:
+            for resource_id in ids:
+                self.resources[kind].pop(resource_id, None)
+            for resource in resources:
+                self.resources[kind][get_id(kind, resource)] = resource
+            self._index(kind)
+
+    def forget(self, kind, ids):
+        """Drop deleted resources without asking AWS."""
+        with self.lock:
+            for resource_id in ids:
+                self.resources[kind].pop(resource_id, None)
+            self._index(kind)
+
+    def _index(self, kind):
+        indexes = {'id': {}, 'name': {}, 'vpc': {}, 'instance': {}}
+        for tag in INDEXED_TAGS:
+            indexes['tag:%s' % tag] = {}
+        for resource_id, resource in self.resources[kind].items():
+            tags = get_tags(resource)
+            keys = {'id': resource_id,
+                    'name': get_name(kind, resource),
+                    'vpc': getattr(resource, 'vpc_id', None),
+                    'instance': getattr(resource, 'instance_id', None)}
+            for tag in INDEXED_TAGS:
+                keys['tag:%s' % tag] = tags.get(tag)
+            for index, key in keys.items():
+                if key:
+                    indexes[index].setdefault(key, []).append(resource)
+        self.indexes[kind] = indexes
+
+    def all(self, kind):
+        return self.resources[kind].values()
+
+    def find(self, kind, index, key):
+        """Return every resource of a kind whose index key matches. index is
+        one of id, name, vpc, instance or tag:Name, tag:Stack, tag:Tier."""
+        return list(self.indexes[kind][index].get(key, []))
+
+    def get(self, kind, index, key):
+        """Return the one resource matching, or None."""
+        found = self.indexes[kind][index].get(key)
+        return found[0] if found else None
+
+    def named(self, kind, names):
+        """Return the resources with any of the given names."""
+        return sum([self.find(kind, 'name', x) for x in names], [])
@@ -1,12 +1,22 @@
 import logging
-logging.basicConfig(level=logging.DEBUG)
 
 import json
 import time
-import pickle
 import os
 
-def global_one_time_provision(path):
+import connections
+import provision_journal
+import security_groups
+import stack_config
+import task_graph
+import waiters
+from tagging import TagAccumulator
+
+# single : one NAT instance in the first availability zone for the VPC
+# per-az : a NAT instance and private route table in every availability zone
+NAT_TOPOLOGIES = ('single', 'per-az')
+
+def global_one_time_provision(secrets, path):
     region = 'universal'
 
     # Upload certificates
@@ -109,7 +119,317 @@ def create_iam_roles(path):
             logging.debug('about to add policy to %s : "%s"' % (role_name, policy_document))
             conn_iam.put_role_policy(role_name, policy_name, policy_document)
 
-def one_time_provision(secrets, path, region, availability_zones, key_name = None):
+def create_vpc(region, environment, cidr_block):
+    conn_vpc = connections.connect('boto.vpc', region)
+    vpc = conn_vpc.create_vpc(cidr_block)
+    logging.debug('created vpc %s with id %s and ip range %s' % (environment, vpc.id, vpc.cidr_block))
+    if vpc.state != 'available':
+        time.sleep(1)
+        vpc = conn_vpc.get_all_vpcs([vpc.id])[0]
+    return vpc
+
+def create_security_group(region, vpc, security_group_name):
+    """Create an empty security group. Its rules, including the internal
+    egress rule that replaces the default one, are added by
+    security_groups.authorize_rules."""
+    conn_ec2 = connections.connect('boto.ec2', region)
+    security_group = conn_ec2.create_security_group(security_group_name,
+                                                    security_group_name,
+                                                    vpc.id)
+    logging.debug('created security group %s in VPC %s' % (security_group.name, vpc.id))
+    return security_group
+
+def create_internet_gateway(region, vpc):
+    conn_vpc = connections.connect('boto.vpc', region)
+    internet_gateway = conn_vpc.create_internet_gateway()
+    # not testing to validate that the ig exists
+    if not conn_vpc.attach_internet_gateway(internet_gateway.id, vpc.id):
+        logging.error('failed to attach internet gateway %s to vpc %s' % (internet_gateway.id, vpc.id))
+    return internet_gateway
+
+def create_vpn(region, vpc, vpn_target, asn):
+    """Create a VPN to vpn_target and return the customer gateway configuration."""
+    conn_vpc = connections.connect('boto.vpc', region)
+    customer_gateway = conn_vpc.create_customer_gateway('ipsec.1', vpn_target, asn)
+    vpn_gateway = conn_vpc.create_vpn_gateway('ipsec.1')
+    vpn_connection = conn_vpc.create_vpn_connection('ipsec.1', customer_gateway.id, vpn_gateway.id)
+    # routing : dynamic
+
+    # TODO set the route table to allow route propoation from the VGW
+
+    vpn_gateway_attachment = conn_vpc.attach_vpn_gateway(vpn_gateway.id, vpc.id)
+    #conn_vpc.create_vpn_connection_route(destination_cidr_block, vpn_connection_id)
+    #conn_vpc.create_route(route_table_id, destination_cidr_block, gateway_id=None, instance_id=None)
+    return vpn_connection.customer_gateway_configuration
+
+def create_subnet(region, vpc, cidr_block, availability_zone, subnet_type):
+    conn_vpc = connections.connect('boto.vpc', region)
+    subnet = conn_vpc.create_subnet(vpc.id,
+                                    cidr_block,
+                                    availability_zone=availability_zone)
+    if subnet.state != 'available':
+        time.sleep(1)
+        subnet = conn_vpc.get_all_subnets([subnet.id])[0]
+    logging.debug('created %s subnet %s in VPC %s in AZ %s' % (subnet_type, subnet.cidr_block, subnet.vpc_id, subnet.availability_zone))
+    # http://docs.aws.amazon.com/AWSEC2/latest/APIReference/ApiReference-ItemType-SubnetType.html
+    return subnet
+
+def launch_nat_instance(region, image_id, key_name, security_group, subnet, instance_type='t1.micro'):
+    conn_ec2 = connections.connect('boto.ec2', region)
+    reservation = conn_ec2.run_instances(image_id = image_id,
+                                         key_name = key_name,
+                                         security_group_ids = [security_group.id],
+                                         instance_type = instance_type,
+                                         subnet_id = subnet.id)
+    return reservation.instances[0]
+
+def wait_for_nat_instance(region, nat_instance):
+    """Wait for the NAT instance to be running and return it."""
+    try:
+        for nat_region, nat_instance_id, nat_instance in waiters.wait_for_instances([(region, nat_instance.id)], timeout=600):
+            pass
+    except waiters.WaiterError:
+        logging.error('after 10 minutes instance %s remains in a state other than "running". continuing with EIP association which will fail' % nat_instance.id)
+    return nat_instance
+
+def allocate_address(region):
+    conn_ec2 = connections.connect('boto.ec2', region)
+    return conn_ec2.allocate_address('vpc')
+
+def configure_nat_instance(region, nat_instance, address):
+    conn_ec2 = connections.connect('boto.ec2', region)
+    conn_ec2.associate_address(instance_id=nat_instance.id,
+                               public_ip=None,
+                               allocation_id=address.allocation_id
+                               )
+
+    # Not using address.associate while waiting for merge of  https://github.com/boto/boto/pull/1310
+    # address.associate(nat_instance.id)
+
+    # Disabling Source/Destination Checks
+    if not conn_ec2.modify_instance_attribute(nat_instance.id, 'sourceDestCheck', False):
+        logging.error('failed to disable Source/Desk Checks on nat_instance %s' % nat_instance.id)
+
+def create_route_table(region, vpc):
+    conn_vpc = connections.connect('boto.vpc', region)
+    return conn_vpc.create_route_table(vpc.id)
+
+def create_default_route(region, route_table, gateway_id=None, instance_id=None):
+    """Send 0.0.0.0/0 traffic in route_table to a gateway or an instance.
+    A route left by an earlier run, to a gateway or instance that has since
+    been replaced, is pointed at the new one."""
+    import boto.exception
+    conn_vpc = connections.connect('boto.vpc', region)
+    try:
+        added = conn_vpc.create_route(route_table_id = route_table.id,
+                                      destination_cidr_block = '0.0.0.0/0',
+                                      gateway_id = gateway_id,
+                                      instance_id = instance_id)
+    except boto.exception.EC2ResponseError as error:
+        if error.error_code != 'RouteAlreadyExists':
+            raise
+        added = conn_vpc.replace_route(route_table_id = route_table.id,
+                                       destination_cidr_block = '0.0.0.0/0',
+                                       gateway_id = gateway_id,
+                                       instance_id = instance_id)
+    if not added:
+        logging.error('failed to add route sending 0.0.0.0/0 traffic to %s in route table %s' % (gateway_id or instance_id, route_table.id))
+
+def associate_route_table(region, route_table, subnet):
+    conn_vpc = connections.connect('boto.vpc', region)
+    route_table_association = conn_vpc.associate_route_table(route_table.id,
+                                                             subnet.id)
+    logging.debug('associated subnet %s with route table %s' % (subnet.id, route_table.id))
+    return route_table_association
+
+def add_vpc_tasks(graph, journal, region, desired_vpc, availability_zones, key_name, asn,
+                  nat_image_id, desired_security_groups, subnet_size=24,
+                  nat_topology='single', nat_instance_type='t1.micro'):
+    """Add the tasks that build one VPC to graph.
+
+    Returns the task names in the same shape as the dict one_time_provision
+    returns for the VPC, so the results can be looked up once the graph has
+    run. Nothing waits for more than it needs : subnets and security groups
+    are created as soon as the VPC exists, the NAT instance is started as
+    soon as its subnet and security group exist and route tables are created
+    and associated while it boots. Only the private default route waits for
+    the NAT instance to be running.
+
+    With nat_topology 'per-az' each availability zone's dict also has its
+    own 'nat_instance' and 'route_tables' {'private': ...} and there's no
+    VPC wide 'nat_instance' or private route table.
+
+    Every task is a step in journal, so steps a previous run finished are
+    skipped and the resources they created are used instead.
+    """
+    from netaddr import IPNetwork # sudo pip install netaddr
+
+    environment = desired_vpc['Name']
+    common_tags = {'App': desired_vpc['App'],
+                   'Env': desired_vpc['Env']}
+    # Each VPC has its own accumulator so its tags are applied as soon as
+    # its resources exist rather than when the slowest VPC is finished
+    tags = TagAccumulator(region)
+    def task(name, func, dependencies=(), phase=None, kind=None, tag_name=None):
+        """Add func as a journaled step. Resources are tagged with Name
+        tag_name whether they were created now or by an earlier run. A
+        step that only changes its dependencies is done again if any of them
+        is created again."""
+        step = '%s %s' % (environment, name)
+        def run():
+            result = journal.run(step, func, kind, uses=dependencies)
+            if tag_name is not None:
+                tags.add(getattr(result, provision_journal.KINDS[kind][3]), dict(common_tags, Name=tag_name))
+            return result
+        return graph.add(step, run, dependencies, phase or name)
+
+    names = {}
+    vpc_task = names['vpc'] = task('vpc',
+                                   lambda: create_vpc(region, environment, desired_vpc['cidr']),
+                                   kind='vpc', tag_name=environment)
+    vpc = lambda: graph.result(vpc_task)
+
+    # Create all security groups at once. The rules are compiled first so a
+    # bad reference is found before anything is created, and each group's
+    # rules are added, in at most three calls, once the groups they refer
+    # to exist
+    compiled_rules = security_groups.compile_rules(environment, desired_vpc['cidr'], desired_security_groups)
+    names['security-groups'] = {}
+    for security_group_name in compiled_rules:
+        names['security-groups'][security_group_name] = task(
+            'security group %s' % security_group_name[len(environment) + 1:],
+            lambda security_group_name=security_group_name: create_security_group(region, vpc(), security_group_name),
+            [vpc_task], phase='security groups', kind='security_group', tag_name=security_group_name)
+    for security_group_name, rules in compiled_rules.items():
+        sources = security_groups.sources(rules)
+        task('security group rules %s' % security_group_name[len(environment) + 1:],
+             lambda security_group_name=security_group_name, rules=rules, sources=sources:
+                 security_groups.authorize_rules(region, graph.result(names['security-groups'][security_group_name]), rules,
+                                                 dict((x, graph.result(names['security-groups'][x]).id) for x in sources)),
+             [names['security-groups'][x] for x in set([security_group_name]) | sources],
+             phase='security group rules')
+
+    # Create internet gateway (a separate one is required for each VPC)
+    names['internet_gateway'] = task('internet gateway',
+                                     lambda: create_internet_gateway(region, vpc()),
+                                     [vpc_task], kind='internet_gateway', tag_name=environment + '-internet_gateway')
+
+    # Create VPN to PHX1
+    if 'vpn_target' in desired_vpc:
+        names['customer_gateway_configuration'] = task('vpn',
+                                                       lambda: create_vpn(region, vpc(), desired_vpc['vpn_target'], asn),
+                                                       [vpc_task])
+
+    # Create subnets. The cidr blocks are handed out in the same order as
+    # when the subnets were created one at a time
+    names['availability_zones'] = {}
+    available_subnets = IPNetwork(desired_vpc['cidr']).subnet(subnet_size)
+    for availability_zone in [region + x for x in availability_zones]:
+        names['availability_zones'][availability_zone] = {'subnets': {}}
+        for subnet_type in ['public', 'private']:
+            names['availability_zones'][availability_zone]['subnets'][subnet_type] = task(
+                'subnet %s %s' % (subnet_type, availability_zone),
+                lambda cidr_block=available_subnets.next(), availability_zone=availability_zone, subnet_type=subnet_type:
+                    create_subnet(region, vpc(), cidr_block, availability_zone, subnet_type),
+                [vpc_task], phase='subnets', kind='subnet',
+                tag_name=environment + '-' + subnet_type + '-' + availability_zone)
+    subnet = lambda availability_zone, subnet_type: names['availability_zones'][availability_zone]['subnets'][subnet_type]
+
+    # Spin up the NAT instances. With the single topology there's one, in
+    # the first availability zone, whatever that is, and every private
+    # subnet routes through it. With per-az every availability zone gets its
+    # own NAT instance and private route table, so outbound traffic stays in
+    # its zone and losing one NAT instance only cuts off that zone.
+    # Each instance is journaled as soon as it's started so an interrupted
+    # wait doesn't start another one, and its EIP is allocated while it boots
+    nat_security_group = names['security-groups'][environment + '-' + 'natsg']
+    def add_nat(suffix, nat_zone, private_zones):
+        """Add the tasks for one NAT instance in nat_zone and the private
+        route table of private_zones. Returns their task names."""
+        nat_subnet = subnet(nat_zone, 'public')
+        nat_launched = task('nat instance' + suffix,
+                            lambda: launch_nat_instance(region, nat_image_id, key_name,
+                                                        graph.result(nat_security_group),
+                                                        graph.result(nat_subnet),
+                                                        nat_instance_type),
+                            [nat_security_group, nat_subnet], phase='nat instance', kind='instance',
+                            tag_name=environment + '-nat_instance' + suffix.replace(' ', '-'))
+        nat = {}
+        nat['instance'] = task('nat instance running' + suffix,
+                               lambda: wait_for_nat_instance(region, graph.result(nat_launched)),
+                               [nat_launched], phase='nat instance running', kind='instance')
+        nat['address'] = task('nat address' + suffix,
+                              lambda: allocate_address(region),
+                              [vpc_task], phase='nat address', kind='address',
+                              tag_name=environment + '-nat_instance' + suffix.replace(' ', '-'))
+        task('nat configuration' + suffix,
+             lambda: configure_nat_instance(region, graph.result(nat['instance']), graph.result(nat['address'])),
+             [nat['instance'], nat['address']], phase='nat configuration')
+
+        route_table = task('route table private' + suffix,
+                           lambda: create_route_table(region, vpc()),
+                           [vpc_task], phase='route tables', kind='route_table',
+                           tag_name=environment + '-private' + suffix.replace(' ', '-'))
+        for availability_zone in private_zones:
+            task('route table association private %s' % availability_zone,
+                 lambda availability_zone=availability_zone:
+                     associate_route_table(region, graph.result(route_table),
+                                           graph.result(subnet(availability_zone, 'private'))),
+                 [route_table, subnet(availability_zone, 'private')],
+                 phase='route table associations')
+
+        # TODO add a route for the PHX1 DB 10.18.20.21/32
+
+        # Set Instance NAT as gateway route for private route table
+        task('route private' + suffix,
+             lambda: create_default_route(region, graph.result(route_table),
+                                          instance_id=graph.result(nat['instance']).id),
+             [route_table, nat['instance']], phase='routes')
+        return nat, route_table
+
+    names['route_tables'] = {}
+    zones = [region + x for x in availability_zones]
+    if nat_topology == 'per-az':
+        for availability_zone in zones:
+            nat, route_table = add_nat(' ' + availability_zone, availability_zone, [availability_zone])
+            names['availability_zones'][availability_zone]['nat_instance'] = nat
+            names['availability_zones'][availability_zone]['route_tables'] = {'private': route_table}
+    else:
+        names['nat_instance'], names['route_tables']['private'] = add_nat('', zones[0], zones)
+
+    # Create public route table
+    names['route_tables']['public'] = task('route table public',
+                                           lambda: create_route_table(region, vpc()),
+                                           [vpc_task], phase='route tables', kind='route_table',
+                                           tag_name=environment + '-public')
+    for availability_zone in zones:
+        task('route table association public %s' % availability_zone,
+             lambda availability_zone=availability_zone:
+                 associate_route_table(region, graph.result(names['route_tables']['public']),
+                                       graph.result(subnet(availability_zone, 'public'))),
+             [names['route_tables']['public'], subnet(availability_zone, 'public')],
+             phase='route table associations')
+
+    # Send public traffic out through the internet gateway
+    task('route public',
+         lambda: create_default_route(region, graph.result(names['route_tables']['public']),
+                                      gateway_id=graph.result(names['internet_gateway']).id),
+         [names['route_tables']['public'], names['internet_gateway']], phase='routes')
+
+    # Every resource of the VPC is tagged together once it all exists. This
+    # isn't journaled since CreateTags can safely be repeated
+    graph.add('%s tags' % environment,
+              lambda: logging.debug('applied tags to vpc %s with %s calls' % (environment, tags.flush())),
+              [x for x in graph.order if x.startswith(environment + ' ')], phase='tags')
+    return names
+
+def _task_results(graph, names):
+    if isinstance(names, dict):
+        return dict((key, _task_results(graph, value)) for key, value in names.items())
+    return graph.result(names)
+
+def one_time_provision(secrets, path, region, availability_zones, key_name = None, max_workers = 16,
+                       journal_filename = None, nat_topology = 'single', nat_instance_type = 't1.micro'):
     # 1 region
     # 2 VPCs, prod and nonprod
     # 3 AZs in each VPC
@@ -117,20 +437,13 @@ def one_time_provision(secrets, path, region, availability_zones, key_name = Non
     # 6*3 = 18 subnets
     # 32 /26 subnets in the VPC's /21
 
-    from netaddr import IPNetwork # sudo pip install netaddr
-
-    subnet_size = 24
-    desired_security_groups = json.load(open('config/security_groups.json', 'r'))
-    
-    import boto.vpc
-    import boto.ec2
-    import boto.exception
+    config = stack_config.get()
+    desired_security_groups = config.security_groups()
 
     vpcs = {}
 
     vpcs[region] = {}
-    conn_vpc = boto.vpc.connect_to_region(region)
-    conn_ec2 = boto.ec2.connect_to_region(region)
+    conn_vpc = connections.connect('boto.vpc', region)
 
     desired_vpcs = {'us-west-2': 
                        [{'Name':'identity-dev',
@@ -159,243 +472,47 @@ def one_time_provision(secrets, path, region, availability_zones, key_name = Non
     asn_map = {'us-west-2': 65148,
                'us-east-1': 65146}
 
-    ami_map = json.load(open('config/ami_map.json', 'r'))
-
     if not key_name:
         key_name = 'svcops-sl62-base-key-%s' % region
-
+    if nat_topology not in NAT_TOPOLOGIES:
+        raise ValueError('nat_topology must be one of %s, not %s' % (', '.join(NAT_TOPOLOGIES), nat_topology))
+
+    # Everything a previous run of this region created is looked up again
+    # so the run carries on from the first step that didn't finish
+    journal = provision_journal.ProvisionJournal(region, journal_filename)
+    journal.rebind()
+
+    # The VPCs share nothing so they're built at the same time, each one as
+    # a set of tasks in one graph. Each task opens its own connections
+    # through connections.connect since boto connections can't be shared
+    # across threads
+    graph = task_graph.TaskGraph(max_workers)
+    existing_vpcs = conn_vpc.get_all_vpcs()
+    task_names = {}
     for desired_vpc in desired_vpcs[region]:
         environment=desired_vpc['Name']
-        existing_vpcs = conn_vpc.get_all_vpcs()
-        if desired_vpc['Name'] in [x.tags['Name'] for x in existing_vpcs if 'Name' in x.tags]:
-            logging.debug('skipping creation of vpc %s since it already exists' % desired_vpc['Name'])
-            #continue
-        vpcs[region][environment] = {}
-
-        # Create VPCs
-        vpcs[region][environment]['vpc'] = [x.tags['Name'] for x in existing_vpcs if 'Name' in x.tags]
-        vpcs[region][environment]['vpc'] = conn_vpc.create_vpc(desired_vpc['cidr'])
-        vpc = vpcs[region][environment]['vpc']
-        logging.debug('created vpc %s with id %s and ip range %s' % (environment, vpc.id, vpc.cidr_block))
-        if vpc.state != 'available':
-            time.sleep(1)
-            vpc = conn_vpc.get_all_vpcs([vpc.id])[0]
-        vpc.add_tag('Name', environment)
-        vpc.add_tag('App', desired_vpc['App'])
-        vpc.add_tag('Env', desired_vpc['Env'])
-        logging.debug('tagged vpc %s with %s' % (vpc.cidr_block, environment))
-
-        # Create all security groups
-        vpcs[region][environment]['security-groups'] = {}
-        for security_group_definition in desired_security_groups:
-            security_group_name = environment + '-' + security_group_definition[0]
-            vpcs[region][environment]['security-groups'][security_group_name] = conn_ec2.create_security_group(
-                      security_group_name, 
-                      security_group_name, 
-                      vpc.id)
-            security_group = vpcs[region][environment]['security-groups'][security_group_name]
-
-            # This loop is to workaround the race condition between creating the security group
-            # and the security group being available for use
-            attempts=0
-            while True:
-                try:
-                    # This is to workaround the fact that AWS only returns the groupId when CreateSecurityGroup is called
-                    # instead of the entire object
-                    attempts += 1
-                    security_group = conn_ec2.get_all_security_groups(group_ids=[security_group.id])[0]
-                    break
-                except boto.exception.EC2ResponseError:
-                    time.sleep(1)
-                    if attempts > 5:
-                        raise
-
-            security_group.add_tag('Name', security_group_name)
-            security_group.add_tag('App', desired_vpc['App'])
-            security_group.add_tag('Env', desired_vpc['Env'])
-
-            # Delete the default egress authorization
-            conn_ec2.revoke_security_group_egress(group_id=security_group.id, ip_protocol=-1, cidr_ip='0.0.0.0/0')
-            # And create an internal egress authorization
-            conn_ec2.authorize_security_group_egress(group_id=security_group.id, ip_protocol=-1, cidr_ip=desired_vpc['cidr'])
-
-            logging.debug('created security group %s in VPC %s' % (security_group.name, security_group.vpc_id))
-            for security_group_definition_rule in security_group_definition[1]:
-                rule = security_group_definition_rule.copy()
-                rule['group_id'] = security_group.id
-
-                # Handle rules where we set the cidr_ip to "vpc"
-                if 'cidr_ip' in rule and rule['cidr_ip'] == 'vpc':
-                    rule['cidr_ip'] = desired_vpc['cidr']
-                
-                if 'direction' not in rule:
-                    rule['direction'] = 'ingress'
-
-                # This is to deal with the fact that ingress and egress authorizations work differently
-                if 'src_security_group_name' in rule:
-                    rule['src_security_group_name'] = environment + '-' + rule['src_security_group_name']
-                    src_group = vpcs[region][environment]['security-groups'][rule['src_security_group_name']]
-                    if rule['direction'] == 'egress':
-                        # egress
-                        rule['src_group_id'] = src_group.id
-                    else:
-                        # ingress
-                        rule['src_security_group_owner_id'] = src_group.owner_id
-                        rule['src_security_group_group_id'] = src_group.id
-                    del rule['src_security_group_name']
-
-                if rule['direction'] == 'ingress':
-                    del rule['direction']
-                    if not conn_ec2.authorize_security_group(**rule):
-                        logging.error('failed to add ingress rule %s to security group %s' % (rule,security_group_name))
-                else:
-                    del rule['direction']
-                    if not conn_ec2.authorize_security_group_egress(**rule):
-                        logging.error('failed to add egress rule %s to security group %s' % (rule,security_group_name))
-                logging.debug('added rule %s to security group %s' % (rule, security_group_name))
-
-        # Create internet gateway (a separate one is required for each VPC)
-        vpcs[region][environment]['internet_gateway'] = conn_vpc.create_internet_gateway()
-        # not testing to validate that the ig exists
-        internet_gateway = vpcs[region][environment]['internet_gateway']
-        if not conn_vpc.attach_internet_gateway(internet_gateway.id, vpc.id):
-            logging.error('failed to attach internet gateway %s to vpc %s' % (internet_gateway.id, vpc.id))
-        # TODO : tag the internet_gateway
-
-        # Create VPN to PHX1
-        if 'vpn_target' in desired_vpc:
-            customer_gateway = conn_vpc.create_customer_gateway('ipsec.1', desired_vpc['vpn_target'], asn_map[region])
-            vpn_gateway = conn_vpc.create_vpn_gateway('ipsec.1')
-            vpn_connection = conn_vpc.create_vpn_connection('ipsec.1', customer_gateway.id, vpn_gateway.id)
-            # routing : dynamic
-            customer_gateway_configuration = vpn_connection.customer_gateway_configuration
-            
-            # TODO set the route table to allow route propoation from the VGW
-
-            vpn_gateway_attachment = conn_vpc.attach_vpn_gateway(vpn_gateway.id, vpc.id)
-            #conn_vpc.create_vpn_connection_route(destination_cidr_block, vpn_connection_id)
-            #conn_vpc.create_route(route_table_id, destination_cidr_block, gateway_id=None, instance_id=None)
-
-        # Create subnets
-        vpcs[region][environment]['availability_zones'] = {}
-        ip = IPNetwork(vpc.cidr_block)
-        available_subnets = ip.subnet(subnet_size)
-        for availability_zone in [region + x for x in availability_zones]:
-            vpcs[region][environment]['availability_zones'][availability_zone] = {}
-            vpcs[region][environment]['availability_zones'][availability_zone]['subnets'] = {}
-            for subnet_type in ['public', 'private']:
-                vpcs[region][environment]['availability_zones'][availability_zone]['subnets'][subnet_type] = conn_vpc.create_subnet(
-                        vpc.id, 
-                        available_subnets.next(), 
-                        availability_zone=availability_zone)
-                subnet = vpcs[region][environment]['availability_zones'][availability_zone]['subnets'][subnet_type]
-                if subnet.state != 'available':
-                    time.sleep(1)
-                    subnet = conn_vpc.get_all_subnets([subnet.id])[0]
-                subnet.add_tag('Name', environment + '-' + subnet_type + '-' + availability_zone)
-                subnet.add_tag('App', desired_vpc['App'])
-                subnet.add_tag('Env', desired_vpc['Env'])
-                logging.debug('created %s subnet %s in VPC %s in AZ %s' % (subnet_type, subnet.cidr_block, subnet.vpc_id, subnet.availability_zone)) 
-                # http://docs.aws.amazon.com/AWSEC2/latest/APIReference/ApiReference-ItemType-SubnetType.html
-
-        # Spin up a NAT instance
-        # We'll just put it in the first availability zone, whatever that is
-        reservation = conn_ec2.run_instances(image_id = ami_map['ami-vpc-nat-1.0.0-beta.i386-ebs'][region],
-                               key_name = key_name,
-                               security_group_ids = [vpcs[region][environment]['security-groups'][environment + '-' + 'natsg'].id],
-                               instance_type = 't1.micro',
-                               subnet_id = vpcs[region][environment]['availability_zones'][region + availability_zones[0]]['subnets']['public'].id)
-        vpcs[region][environment]['nat_instance'] = {}
-        
-        # Loop to wait for the instance to spin up
-        attempts = 0
-        sleep_time = 10
-        max_attempts = 600
-        while True:
-            try:
-                nat_instance_state = conn_ec2.get_all_instances([reservation.instances[0].id])[0].instances[0].state
-            except (boto.exception.EC2ResponseError, IndexError):
-                nat_instance_state = False
-            attempts += 1
-            if nat_instance_state != 'running':
-                logging.debug('waiting 10 seconds while instance %s enters a "running" state in order to assign it\'s EIP' % reservation.instances[0].id) 
-                time.sleep(sleep_time)
-                if attempts > max_attempts:
-                    logging.error('after 10 minutes instance %s remains in a state other than "running". continuing with EIP association which will fail' % reservation.instances[0].id)
-            else:
-                break
-
-        vpcs[region][environment]['nat_instance']['instance'] = conn_ec2.get_all_instances([reservation.instances[0].id])[0].instances[0]
-        nat_instance = vpcs[region][environment]['nat_instance']['instance']
-
-        nat_instance.add_tag('Name', environment + '-nat_instance')
-        nat_instance.add_tag('App', desired_vpc['App'])
-        nat_instance.add_tag('Env', desired_vpc['Env'])
-
-        # Get and assign EIP to NAT instance
-        vpcs[region][environment]['nat_instance']['address'] = conn_ec2.allocate_address('vpc')
-        address = vpcs[region][environment]['nat_instance']['address']
-
-        # TODO : tag the address
-
-        conn_ec2.associate_address(instance_id=nat_instance.id,
-                                   public_ip=None,
-                                   allocation_id=address.allocation_id
-                                   )
-
-        # Not using address.associate while waiting for merge of  https://github.com/boto/boto/pull/1310
-        # address.associate(nat_instance.id)
-        
-        # Disabling Source/Destination Checks
-        if not conn_ec2.modify_instance_attribute(nat_instance.id, 'sourceDestCheck', False):
-            logging.error('failed to disable Source/Desk Checks on nat_instance %s' % nat_instance.id)
-        
-        # Route tables
-        vpcs[region][environment]['route_tables'] = {}
-
-        # Create public route table
-        vpcs[region][environment]['route_tables']['public'] = conn_vpc.create_route_table(vpc.id)
-        route_table = vpcs[region][environment]['route_tables']['public']
-        if not conn_vpc.create_route(route_table_id = route_table.id,
-                                     destination_cidr_block = '0.0.0.0/0',
-                                     gateway_id = internet_gateway.id):
-            logging.error('failed to add route sending 0.0.0.0/0 traffic to internet gateway %s in route table %s' % (internet_gateway.id, route_table.id))
-
-        # TODO : tag the route_table
-
-        # Associate public subnets with route table
-        for availability_zone in [region + x for x in availability_zones]:
-            subnet = vpcs[region][environment]['availability_zones'][availability_zone]['subnets']['public']
-            route_table_association = conn_vpc.associate_route_table(route_table.id,
-                                                                     subnet.id)
-            logging.debug('associated subnet %s with route table %s' % (subnet.id, route_table.id)) 
-
-        # Create private route table
-        vpcs[region][environment]['route_tables']['private'] = conn_vpc.create_route_table(vpc.id)
-        route_table = vpcs[region][environment]['route_tables']['private']
-
-        # TODO : tag the route_table
-
-        # TODO add a route for the PHX1 DB 10.18.20.21/32
-
-        # Associate private subnets with route table
-        for availability_zone in [region + x for x in availability_zones]:
-            subnet = vpcs[region][environment]['availability_zones'][availability_zone]['subnets']['private']
-            route_table_association = conn_vpc.associate_route_table(route_table.id,
-                                                                     subnet.id)
-            logging.debug('associated subnet %s with route table %s' % (subnet.id, route_table.id)) 
-
-        # Set Instance NAT as gateway route for private route table
-        if not conn_vpc.create_route(route_table_id = route_table.id,
-                                     destination_cidr_block = '0.0.0.0/0',
-                                     instance_id = nat_instance.id):
-            logging.error('failed to add route sending 0.0.0.0/0 traffic to nat instance %s in route table %s' % (nat_instance.id, route_table.id))
-
-        if 'vpn_target' in desired_vpc:
-            logging.info('Customer Gateway Configuration = "\n%s\n"' % customer_gateway_configuration)
-        logging.debug('vpc created')
-        #pickle.dump(vpcs[region][environment], open(pkl_filename, 'wb'))
-        #logging.debug('pickled vpc to %s' % pkl_filename)
+        if (desired_vpc['Name'] in [x.tags['Name'] for x in existing_vpcs if 'Name' in x.tags]
+                and journal.resource(environment + ' vpc') is None):
+            logging.info('skipping creation of vpc %s since it already exists and isn\'t in %s' % (desired_vpc['Name'], journal.filename))
+            continue
+        task_names[environment] = add_vpc_tasks(graph, journal, region, desired_vpc, availability_zones, key_name,
+                                                asn_map[region],
+                                                config.ami('ami-vpc-nat-1.0.0-beta.i386-ebs', region),
+                                                desired_security_groups,
+                                                nat_topology=nat_topology,
+                                                nat_instance_type=nat_instance_type)
+
+    try:
+        graph.run()
+    finally:
+        logging.info('%s : provision %s timings\n%s' % (time.strftime('%c'), region, graph.timing_report()))
+
+    for environment in task_names:
+        vpcs[region][environment] = _task_results(graph, task_names[environment])
+        if 'customer_gateway_configuration' in vpcs[region][environment]:
+            logging.info('Customer Gateway Configuration = "\n%s\n"' % vpcs[region][environment]['customer_gateway_configuration'])
+        logging.debug('vpc %s created' % environment)
+    logging.info('provisioning of %s is recorded in %s' % (region, journal.filename))
 
     return vpcs
 
@@ -409,6 +526,7 @@ def get_secrets():
         return json.load(secrets_file)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
     secrets = get_secrets()
     path = "/identity/"
 
@@ -421,7 +539,7 @@ if __name__ == '__main__':
     region = 'us-east-1'
     availability_zones = ['a','b','d']
 
-    global_data = global_one_time_provision(path)
+    global_data = global_one_time_provision(secrets, path)
     # create_iam_roles(path)
     vpcs = one_time_provision(secrets, path, region, availability_zones, None)
     
\ No newline at end of file
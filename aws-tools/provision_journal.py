@@ -0,0 +1,143 @@
+"""A journal of what one_time_provision has done in a region, so a failed or
+interrupted run can pick up where it stopped.
+
+Each step is recorded as soon as it finishes, with the id of the resource
+it created. When provisioning runs again every resource in the journal is
+looked up with one describe per kind of resource, and a step whose
+resource still exists hands that resource back instead of creating
+another. Steps that only change existing resources (rules, routes,
+associations) are recorded as done, with the ids of the resources they
+changed, and aren't repeated while those resources still exist. Anything
+the journal doesn't have, or whose resource has gone, is done again, and so
+is every step that changed a resource that has gone.
+
+    journal = ProvisionJournal(region)
+    journal.rebind()
+    vpc = journal.run('identity-dev vpc', lambda: create_vpc(...), kind='vpc')
+    journal.run('identity-dev route public', lambda: create_default_route(...),
+                uses=['identity-dev route table public'])
+
+The journal is a JSON object of step to {'kind': ..., 'id': ...} or
+{'done': true, 'uses': [id, ...], 'result': ...}, rewritten atomically after
+every step.
+"""
+
+import json
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import connections
+
+JOURNAL_DIRECTORY = os.path.join(os.path.expanduser('~'), '.identity-ops')
+
+# kind : (boto service, describe method, id filter, id attribute, extra filters)
+KINDS = {'vpc': ('boto.vpc', 'get_all_vpcs', 'vpc-id', 'id', {}),
+         'subnet': ('boto.vpc', 'get_all_subnets', 'subnet-id', 'id', {}),
+         'security_group': ('boto.ec2', 'get_all_security_groups', 'group-id', 'id', {}),
+         'internet_gateway': ('boto.vpc', 'get_all_internet_gateways', 'internet-gateway-id', 'id', {}),
+         'route_table': ('boto.vpc', 'get_all_route_tables', 'route-table-id', 'id', {}),
+         'instance': ('boto.ec2', 'get_all_instances', 'instance-id', 'id',
+                      {'instance-state-name': ['pending', 'running', 'stopping', 'stopped']}),
+         'address': ('boto.ec2', 'get_all_addresses', 'allocation-id', 'allocation_id', {})}
+
+class ProvisionJournal:
+    def __init__(self, region, filename=None):
+        self.region = region
+        self.filename = filename or os.path.join(JOURNAL_DIRECTORY, 'provision-%s.json' % region)
+        self.lock = threading.Lock()
+        self.resources = {}
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+            logging.info('resuming provisioning of %s from %s with %s steps done' % (region, self.filename, len(self.entries)))
+        except IOError:
+            self.entries = {}
+
+    def _save(self):
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def rebind(self):
+        """Look up every resource in the journal, one describe per kind,
+        concurrently. Steps whose resource no longer exists are forgotten so
+        they're done again, along with the steps that changed it, since the
+        resource that replaces it won't have their changes."""
+        ids_by_kind = {}
+        for step, entry in self.entries.items():
+            if 'kind' in entry:
+                ids_by_kind.setdefault(entry['kind'], []).append(entry['id'])
+
+        def describe(kind):
+            service, method, id_filter, id_attribute, filters = KINDS[kind]
+            conn = connections.connect(service, self.region)
+            resources = getattr(conn, method)(filters=dict(filters, **{id_filter: ids_by_kind[kind]}))
+            if kind == 'instance':
+                resources = sum([x.instances for x in resources], [])
+            return dict((getattr(x, id_attribute), x) for x in resources)
+        if not ids_by_kind:
+            return
+        pool = ThreadPool(len(ids_by_kind))
+        try:
+            found = dict(zip(ids_by_kind, pool.map(describe, ids_by_kind.keys())))
+        finally:
+            pool.close()
+            pool.join()
+
+        with self.lock:
+            for step, entry in self.entries.items():
+                if 'kind' not in entry:
+                    continue
+                if entry['id'] in found[entry['kind']]:
+                    self.resources[step] = found[entry['kind']][entry['id']]
+                else:
+                    logging.warning('%s %s from step %s no longer exists and will be created again' % (
+                        entry['kind'], entry['id'], step))
+                    del self.entries[step]
+            ids = set(x['id'] for x in self.entries.values() if 'kind' in x)
+            for step, entry in self.entries.items():
+                gone = [x for x in entry.get('uses', []) if x not in ids]
+                if gone:
+                    logging.warning('step %s changed %s which no longer exist and will be done again' % (
+                        step, ', '.join(gone)))
+                    del self.entries[step]
+            self._save()
+        logging.debug('rebound %s resources in %s' % (len(self.resources), self.region))
+
+    def resource(self, step):
+        """Return the resource a step created, if the journal has it."""
+        with self.lock:
+            return self.resources.get(step)
+
+    def run(self, step, func, kind=None, uses=()):
+        """Return what the journal has for step or else call func and record
+        what it returns. kind is the KINDS name of the resource func creates,
+        or None for steps whose result is recorded as it is. uses are the
+        steps whose resources func changes, so that it's done again if any of
+        them has to be created again."""
+        with self.lock:
+            if step in self.resources:
+                logging.debug('step %s already done, using %s' % (step, self.entries[step]['id']))
+                return self.resources[step]
+            if step in self.entries and 'done' in self.entries[step]:
+                logging.debug('step %s already done' % step)
+                return self.entries[step].get('result')
+        result = func()
+        with self.lock:
+            if kind is None:
+                self.entries[step] = {'done': True,
+                                      'uses': sorted(self.entries[x]['id'] for x in uses
+                                                     if 'kind' in self.entries.get(x, {}))}
+                # Only plain results, like the customer gateway configuration,
+                # are kept
+                if isinstance(result, (basestring, int, float, bool)):
+                    self.entries[step]['result'] = result
+            else:
+                self.entries[step] = {'kind': kind, 'id': getattr(result, KINDS[kind][3])}
+                self.resources[step] = result
+            self._save()
+        return result
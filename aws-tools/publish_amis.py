@@ -2,7 +2,8 @@
 """Copy an AMI to a set of target regions and/or share that AMI to another Amazon user.
 
 usage: publish_amis.py [-h] [-a {copy,share,copyandshare}] [-s REGION]
-                      [-r REGION,REGION...] [-u USERID,USERID...] [-d]
+                      [-r REGION,REGION...] [-u USERID,USERID...]
+                      [-m COUNT] [-t SECONDS] [--state FILENAME] [-d]
                       AMIID [AMIID ...]
 
 Publish and share AMI across regions and IAMs
@@ -19,12 +20,22 @@ optional arguments:
                         east-1)
   -r REGION,REGION..., --regions REGION,REGION...
                         AWS regions where you want images shared or copied to
-                        (default: eu-west-1,sa-east-1,us-east-1,ap-northeast-1
-                        ,us-west-2,us-west-1,ap-southeast-1,ap-southeast-2)
+                        (default: ap-northeast-1,ap-southeast-1,ap-southeast-2
+                        ,eu-west-1,sa-east-1,us-east-1,us-west-1,us-west-2)
   -u USERID,USERID..., --userids USERID,USERID...
                         Amazon User IDs to share the AMIs with (default:
                         142069644989,351644144250)
-  -d, --dryrun          don't actually do anything
+  -m COUNT, --max-in-flight COUNT
+                        Number of copies to run at once in each region
+                        (default: 5)
+  -t SECONDS, --timeout SECONDS
+                        How long to wait for each AMI to become available
+                        (default: 3600)
+  --state FILENAME      File that records the copies made and AMIs shared so
+                        an interrupted run can be resumed (default:
+                        publish_amis.state.json)
+  -d, --dryrun          don't actually do anything, just show what would be
+                        copied and shared
 
 action : copy
   This tool will first copy the AMIs (passed in as the AMIID argument) to all
@@ -36,170 +47,345 @@ action : share
   them with the Amazon users or IAMs passed in as the --userids argument.
 
 action :copyandshare
-  This tool will first copy the AMIs (passed in as the AMIID argument) to all
-  regions (passed in as the --regions option). The tool will then wait for 
-  the copying process to complete and for the AMIs to enter an "available" 
-  state at each of their destination regions. Once they are all available the
-  tool will modify each AMIs attributes to share them with the Amazon users 
-  or IAMs passed in as the --userids argument.
+  This tool will start copying the AMIs (passed in as the AMIID argument) to
+  all regions (passed in as the --regions option), up to --max-in-flight
+  copies at a time in each region. As each copy enters an "available" state
+  in its destination region the tool will modify its attributes to share it
+  with the Amazon users or IAMs passed in as the --userids argument, without
+  waiting for the other copies.
+
+AMIs that were already copied to a region, found by name or by the copy id
+recorded in the --state file, are reused rather than copied again, and AMIs
+the state file records as shared aren't shared again, so an interrupted run
+can simply be re-run.
 
-Upon completion the tool will output the map of new AMIs to regions in json
+The list of regions comes from a copy bundled with the tool, refreshed from
+AWS at most once a week (see ec2_regions.py), so parsing arguments, --help
+and --dryrun don't make any network calls.
+
+Progress is written to stdout as one JSON object per line (copy_started,
+available, shared, failed, ...) while the AMIs are copied and shared. The
+last line is a "done" event with the map of new AMIs to regions.
 
 """
 
 import argparse
-import boto.ec2
-import boto.iam
 import json
 import logging
+import os
+import sys
 import time
 
-#logging.basicConfig(level=logging.DEBUG)
-logging.basicConfig(level=logging.INFO)
+import ec2_regions
 
 all_userids = ['142069644989', '351644144250']
-all_regions = [x.name for x in 
-               boto.ec2.connect_to_region('us-east-1').get_all_regions()]
 
 def type_comma_delimited_string(string):
   return string.split(',')
 
-parser = argparse.ArgumentParser(description=('Publish and share AMI across '
-                                              'regions and IAMs'))
-parser.add_argument('amiids', nargs='+', metavar='AMIID',
-                    help='AMI IDs of the AMIs to publish and share')
-parser.add_argument('-a', '--action', default='copyandshare',
-                    choices=['copy', 'share', 'copyandshare'],
-                    help='Action to take (default: copyandshare)')
-parser.add_argument('-s', '--source-region', default='us-east-1', 
-                    choices=all_regions, metavar='REGION',
-                    help=('AWS region that the source AMI is in '
-                          '(default: us-east-1)'))
-parser.add_argument('-r', '--regions', default=','.join(all_regions), 
-                    metavar='REGION,REGION...', type=type_comma_delimited_string,
-                    help=('AWS regions where you want images shared or copied '
-                         'to (default: %s)' % ','.join(all_regions)))
-parser.add_argument('-u', '--userids', default=','.join(all_userids), 
-                    metavar='USERID,USERID...', 
-                    type=type_comma_delimited_string,
-                    help=('Amazon User IDs to share the AMIs with '
-                         '(default: %s)' % ','.join(all_userids)))
-parser.add_argument('-d', '--dryrun', action="store_true",
-                    help="don't actually do anything")
-
-args = parser.parse_args()
-
-def wait_for_ami(conn_ec2, region, amiid):
-  """Loop, waiting for a given AMI to become available.
-  
-  Check a given AMI with ID amiid to see if it's available.
-  If not, loop, sleeping interval seconds and then checking again
-  
-  """
-
-  interval=15
-  ami_unavailable = True
-  while ami_unavailable:
+def build_parser():
+  all_regions = ec2_regions.regions()
+  parser = argparse.ArgumentParser(description=('Publish and share AMI across '
+                                                'regions and IAMs'))
+  parser.add_argument('amiids', nargs='+', metavar='AMIID',
+                      help='AMI IDs of the AMIs to publish and share')
+  parser.add_argument('-a', '--action', default='copyandshare',
+                      choices=['copy', 'share', 'copyandshare'],
+                      help='Action to take (default: copyandshare)')
+  parser.add_argument('-s', '--source-region', default='us-east-1', 
+                      metavar='REGION',
+                      help=('AWS region that the source AMI is in '
+                            '(default: us-east-1)'))
+  parser.add_argument('-r', '--regions', default=','.join(all_regions), 
+                      metavar='REGION,REGION...', type=type_comma_delimited_string,
+                      help=('AWS regions where you want images shared or copied '
+                           'to (default: %s)' % ','.join(all_regions)))
+  parser.add_argument('-u', '--userids', default=','.join(all_userids), 
+                      metavar='USERID,USERID...', 
+                      type=type_comma_delimited_string,
+                      help=('Amazon User IDs to share the AMIs with '
+                           '(default: %s)' % ','.join(all_userids)))
+  parser.add_argument('-m', '--max-in-flight', default=5, type=int,
+                      metavar='COUNT',
+                      help=('Number of copies to run at once in each region '
+                            '(default: 5)'))
+  parser.add_argument('-t', '--timeout', default=3600, type=int,
+                      metavar='SECONDS',
+                      help=('How long to wait for each AMI to become available '
+                            '(default: 3600)'))
+  parser.add_argument('--state', default='publish_amis.state.json',
+                      metavar='FILENAME',
+                      help=('File that records the copies made and AMIs shared '
+                            'so an interrupted run can be resumed '
+                            '(default: publish_amis.state.json)'))
+  parser.add_argument('-d', '--dryrun', action="store_true",
+                      help=("don't actually do anything, just show what would "
+                            "be copied and shared"))
+  return parser
+
+def emit(event, **fields):
+  """Write one line of JSON describing progress to stdout."""
+  fields['event'] = event
+  fields['time'] = round(time.time(), 1)
+  print(json.dumps(fields, sort_keys=True))
+  sys.stdout.flush()
+
+class Publisher:
+  def __init__(self, args, images):
+    import connections
+    from tagging import TagAccumulator
+    self.args = args
+    self.images = images
+    self.results = {}
+    for image in images:
+      self.results[image.id] = {'map': {args.source_region: image.id}, 
+                                'name': image.name}
+    self.conn_ec2_destination = {}
+    for region in args.regions + [args.source_region]:
+      self.conn_ec2_destination[region] = connections.connect('boto.ec2', 
+                                                              region)
+    self.copy_tags = dict((region, TagAccumulator(region)) 
+                          for region in args.regions)
+    self.failures = []
+    self.state = self.load_state()
+
+  def load_state(self):
     try:
-      images = conn_ec2.get_all_images(image_ids=[amiid])
-    except boto.exception.EC2ResponseError:
-      logging.debug("AMI %s doesn't yet exist in %s" % (amiid, region))
-      time.sleep(interval)
-      continue
-    if images[0].state == 'available':
-      logging.info('AMI %s in %s is available for use' % (amiid, region))
-      ami_unavailable = False
+      with open(self.args.state, 'r') as f:
+        return json.load(f)
+    except IOError:
+      return {'copies': {}, 'shared': []}
+
+  def save_state(self):
+    # Write then rename so an interrupted run never leaves half a file
+    with open(self.args.state + '.tmp', 'w') as f:
+      json.dump(self.state, f, sort_keys=True, indent=4, 
+                separators=(',', ': '))
+    os.rename(self.args.state + '.tmp', self.args.state)
+
+  def find_copies(self, region):
+    """Return a dict of source AMI id to the copy of it that's already in
+    region, found by the copy id recorded in the state file or by name."""
+    import connections
+    import waiters
+    conn_ec2 = connections.connect('boto.ec2', region)
+    names = dict((x.name, x.id) for x in self.images)
+    found = {}
+    for image in conn_ec2.get_all_images(owners=['self'], 
+                                         filters={'name': names.keys()}):
+      if image.state != 'failed' and image.name in names:
+        found[names[image.name]] = image
+    recorded = dict((copies[region], source_id) 
+                    for source_id, copies in self.state['copies'].items() 
+                    if region in copies and source_id in names.values())
+    if recorded:
+      for image in waiters.describe_images(region, recorded.keys()):
+        if image.state != 'failed':
+          found[recorded[image.id]] = image
+    return found
+
+  def start_copy(self, source_ami, region):
+    ami_id = self.conn_ec2_destination[region].copy_image(
+                                     source_region = self.args.source_region, 
+                                     source_image_id = source_ami.id, 
+                                     name = source_ami.name, 
+                                     description = source_ami.description)
+    self.results[source_ami.id]['map'][region] = ami_id.image_id
+    self.state['copies'].setdefault(source_ami.id, {})[region] = ami_id.image_id
+    self.save_state()
+    # Tags don't follow an AMI when it's copied
+    self.copy_tags[region].add(ami_id.image_id, 
+                               dict(source_ami.tags, Name=source_ami.name))
+    logging.info('AMI %s copied from %s to %s as AMI %s' 
+                 % (source_ami, self.args.source_region, region, 
+                    ami_id.image_id))
+    emit('copy_started', source=source_ami.id, region=region, 
+         ami=ami_id.image_id)
+    return ami_id.image_id
+
+  def share(self, region, ami_id):
+    if '%s:%s' % (region, ami_id) in self.state['shared']:
+      emit('already_shared', region=region, ami=ami_id)
+      return
+    attributes = self.conn_ec2_destination[region].get_image_attribute(
+                              image_id = ami_id)
+    user_ids = (set() if 'user_ids' not in attributes.attrs 
+                else set(attributes.attrs['user_ids']))
+    if user_ids.issuperset(self.args.userids):
+      emit('already_shared', region=region, ami=ami_id, 
+           user_ids=list(user_ids))
+      return
+    user_ids.update(self.args.userids)
+    user_ids = list(user_ids)
+    if self.conn_ec2_destination[region].modify_image_attribute(
+                           image_id = ami_id, 
+                           user_ids = user_ids) is True:
+      logging.info('AMI %s in region %s shared with user_ids %s' 
+                   % (ami_id, region, user_ids))
+      self.state['shared'].append('%s:%s' % (region, ami_id))
+      self.save_state()
+      emit('shared', region=region, ami=ami_id, user_ids=user_ids)
     else:
-      logging.info('Waiting for AMI %s to become available in %s' 
-                    % (amiid, region))
-      time.sleep(interval)
-
-if len(set(args.userids).difference(set(all_userids))) > 0:
-  parser.error("argument -u/--userids: invalid choice: %s (choose from %s)" 
-                % (list(set(args.userids).difference(set(all_userids))), 
-                   list(set(all_userids))))
-if len(set(args.regions).difference(set(all_regions))) > 0:
-  parser.error("argument -r/--regions: invalid choice: %s (choose from %s)" 
-                % (list(set(args.regions).difference(set(all_regions))), 
-                   list(set(all_regions))))
-
-conn_iam = boto.iam.connect_to_region('universal')
-current_user = (conn_iam.get_user()['get_user_response']['get_user_result']
-                ['user']['arn'].split(':')[4])
-if current_user in args.userids:
-  args.userids.remove(current_user)
-if args.source_region in args.regions:
-  args.regions.remove(args.source_region)
-
-conn_ec2_destination = {}
-for region in args.regions + [args.source_region]:
-  conn_ec2_destination[region] = boto.ec2.connect_to_region(region)
-
-results={}
-for i in args.amiids:
-  results[i] = {'map': {
-                        args.source_region : i
-                        }
-               }
-
-conn_ec2 = boto.ec2.connect_to_region(args.source_region)
-try:
-  images = conn_ec2.get_all_images(image_ids=args.amiids)
-except boto.exception.EC2ResponseError:
-  parser.error("Unable to locate the source AMI(s) %s in region %s." 
-               % (args.amiids, args.source_region))
-
-if len(images) < len(args.amiids):
-  parser.error("Unable to find all AMIs. Requested : %s. Found : %s" 
-               % (args.amiids, images))
-
-# Copy
-for source_ami in images:
-  if args.action in ['copy', 'copyandshare']:
-    for region in args.regions:
-      if args.dryrun:
-        logging.info('Dryrun : Would have just copied AMI %s from %s to %s' 
-                     % (source_ami, args.source_region, region))
-      else:
-        ami_id = conn_ec2_destination[region].copy_image(
-                                         source_region = args.source_region, 
-                                         source_image_id = source_ami.id, 
-                                         name = source_ami.name, 
-                                         description = source_ami.description)
-        results[source_ami.id]['map'][region] = ami_id.image_id
-        results[source_ami.id]['name'] = source_ami.name
-        logging.info('AMI %s copied from %s to %s as AMI %s' 
-                     % (source_ami, args.source_region, region, 
-                        results[source_ami.id]['map'][region]))
-
-# Share
-if args.action in ['share', 'copyandshare']:
-  for source_ami in results.keys():
-    for region in results[source_ami]['map'].keys():
-      wait_for_ami(conn_ec2_destination[region], 
-                   region, 
-                   results[source_ami]['map'][region])
-      attributes = conn_ec2_destination[region].get_image_attribute(
-                                image_id = results[source_ami]['map'][region])
-      user_ids = (set() if 'user_ids' not in attributes.attrs 
-                  else set(attributes.attrs['user_ids']))
-      user_ids.update(args.userids)
-      user_ids = list(user_ids)
-      if args.dryrun:
-        logging.info('Dryrun : Would have just shared AMI %s in region %s '
-                     'with user_ids %s' 
-                     % (results[source_ami]['map'][region], region, user_ids))
-      else:
-        if conn_ec2_destination[region].modify_image_attribute(
-                               image_id = results[source_ami]['map'][region], 
-                               user_ids = user_ids) is True:
-          logging.info('AMI %s in region %s shared with user_ids %s' 
-                       % (results[source_ami]['map'][region], 
-                          region, user_ids))
-        else:
-          logging.error('Failed to share AMI %s in region %s shared with '
-                        'user_ids %s : %s' 
-                        % (results[source_ami]['map'][region], 
-                           region, user_ids, result))
-
-print(json.dumps(results.values(), indent=4))
\ No newline at end of file
+      logging.error('Failed to share AMI %s in region %s shared with '
+                    'user_ids %s' 
+                    % (ami_id, region, user_ids))
+      self.failures.append((region, ami_id))
+      emit('share_failed', region=region, ami=ami_id, user_ids=user_ids)
+
+  def publish(self):
+    """Copy and share the images as a pipeline.
+
+    Every region has up to --max-in-flight copies running at once and starts
+    the next one as soon as one finishes. Each tick a region's pending AMIs
+    are checked with one describe call and each AMI is shared as soon as it
+    becomes available, rather than once everything has been copied.
+    """
+    from multiprocessing.pool import ThreadPool
+    import waiters
+    args = self.args
+    copying = args.action in ['copy', 'copyandshare']
+    sharing = args.action in ['share', 'copyandshare']
+    queued = dict((region, list(self.images) if copying else []) 
+                  for region in args.regions)
+    # (region, ami id) : time to give up waiting for it
+    pending = {}
+    if sharing:
+      for image in self.images:
+        pending[(args.source_region, image.id)] = time.time() + args.timeout
+
+    if copying:
+      # Reuse copies left by an earlier run instead of copying again
+      pool = ThreadPool(len(args.regions) or 1)
+      try:
+        existing = dict(zip(args.regions, 
+                            pool.map(self.find_copies, args.regions)))
+      finally:
+        pool.close()
+        pool.join()
+      for region in args.regions:
+        for source_id, image in existing[region].items():
+          queued[region] = [x for x in queued[region] if x.id != source_id]
+          self.results[source_id]['map'][region] = image.id
+          if self.state['copies'].get(source_id, {}).get(region) != image.id:
+            self.state['copies'].setdefault(source_id, {})[region] = image.id
+            self.save_state()
+          emit('copy_exists', source=source_id, region=region, ami=image.id, 
+               state=image.state)
+          if sharing or image.state != 'available':
+            pending[(region, image.id)] = time.time() + args.timeout
+
+    backoff = waiters.Backoff(15)
+    while True:
+      progress = False
+      for region in args.regions:
+        in_flight = len([x for x in pending if x[0] == region])
+        while queued[region] and in_flight < args.max_in_flight:
+          ami_id = self.start_copy(queued[region].pop(0), region)
+          pending[(region, ami_id)] = time.time() + args.timeout
+          in_flight += 1
+          progress = True
+        self.copy_tags[region].flush()
+        if not sharing and not queued[region]:
+          # Nothing left to start here so there's no need to wait
+          for item in [x for x in pending if x[0] == region]:
+            del pending[item]
+      if not pending:
+        break
+
+      ami_ids = {}
+      for region, ami_id in pending:
+        ami_ids.setdefault(region, []).append(ami_id)
+      for region in sorted(ami_ids):
+        states = dict((x.id, x.state) 
+                      for x in waiters.describe_images(region, ami_ids[region]))
+        for ami_id in ami_ids[region]:
+          image_state = states.get(ami_id)
+          if image_state == 'available':
+            del pending[(region, ami_id)]
+            progress = True
+            emit('available', region=region, ami=ami_id)
+            if sharing:
+              self.share(region, ami_id)
+          elif image_state == 'failed':
+            del pending[(region, ami_id)]
+            progress = True
+            self.failures.append((region, ami_id))
+            logging.error('AMI %s in region %s failed' % (ami_id, region))
+            emit('failed', region=region, ami=ami_id)
+          elif time.time() > pending[(region, ami_id)]:
+            del pending[(region, ami_id)]
+            self.failures.append((region, ami_id))
+            logging.error('AMI %s in region %s still not available after '
+                          '%s seconds' % (ami_id, region, args.timeout))
+            emit('timed_out', region=region, ami=ami_id)
+      if pending:
+        emit('waiting', amis=['%s:%s' % x for x in sorted(pending)])
+        backoff.sleep(progress)
+    return self.results
+
+def main(argv=None):
+  #logging.basicConfig(level=logging.DEBUG)
+  logging.basicConfig(level=logging.INFO)
+
+  parser = build_parser()
+  args = parser.parse_args(argv)
+
+  if len(set(args.userids).difference(set(all_userids))) > 0:
+    parser.error("argument -u/--userids: invalid choice: %s (choose from %s)" 
+                  % (list(set(args.userids).difference(set(all_userids))), 
+                     list(set(all_userids))))
+  all_regions = ec2_regions.regions()
+  requested_regions = set(args.regions + [args.source_region])
+  if not requested_regions.issubset(all_regions) and not args.dryrun:
+    # The bundled or cached list may be out of date
+    all_regions = ec2_regions.refresh()
+  if len(requested_regions.difference(set(all_regions))) > 0:
+    parser.error("argument -r/--regions: invalid choice: %s (choose from %s)" 
+                  % (list(requested_regions.difference(set(all_regions))), 
+                     list(set(all_regions))))
+  if args.source_region in args.regions:
+    args.regions.remove(args.source_region)
+
+  if args.dryrun:
+    for amiid in args.amiids:
+      if args.action in ['copy', 'copyandshare']:
+        for region in args.regions:
+          logging.info('Dryrun : Would have just copied AMI %s from %s to %s' 
+                       % (amiid, args.source_region, region))
+          emit('copy_planned', source=amiid, region=region)
+      if args.action in ['share', 'copyandshare']:
+        logging.info('Dryrun : Would have just shared AMI %s and its copies '
+                     'with user_ids %s' % (amiid, args.userids))
+        emit('share_planned', source=amiid, user_ids=args.userids)
+    return 0
+
+  import boto.exception
+  import connections
+  if ec2_regions.is_stale():
+    ec2_regions.refresh()
+
+  conn_ec2 = connections.connect('boto.ec2', args.source_region)
+  try:
+    images = conn_ec2.get_all_images(image_ids=args.amiids)
+  except boto.exception.EC2ResponseError:
+    parser.error("Unable to locate the source AMI(s) %s in region %s." 
+                 % (args.amiids, args.source_region))
+
+  if len(images) < len(args.amiids):
+    parser.error("Unable to find all AMIs. Requested : %s. Found : %s" 
+                 % (args.amiids, images))
+
+  # The source AMIs' owner is the current account, which doesn't need
+  # them shared with itself
+  for owner_id in set(x.owner_id for x in images):
+    if owner_id in args.userids:
+      args.userids.remove(owner_id)
+
+  publisher = Publisher(args, images)
+  results = publisher.publish()
+  emit('done', amis=results.values(), 
+       failed=['%s:%s' % x for x in publisher.failures])
+  return 1 if publisher.failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,116 @@
+"""Run the same stack operation in several regions at once.
+
+Each region runs in its own thread, so it gets its own boto connections
+from connections.connect, and with its own availability zones. A failure
+in one region doesn't stop the others; every region's result or error is
+collected into one RegionResults:
+
+    results = regions.create_stacks(['us-west-2', 'us-east-1'],
+                                    environment='identity-prod',
+                                    stack_type='prod',
+                                    application='persona',
+                                    path='/identity/')
+    print results.report()
+    results.raise_for_failures()
+"""
+
+import logging
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import stack_control
+
+# The availability zones the stacks use in each region
+AVAILABILITY_ZONES = {'us-west-1': ['b', 'c'],
+                      'us-west-2': ['a', 'b', 'c'],
+                      'us-east-1': ['a', 'b', 'd']}
+
+class RegionError(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, 'failed in %s' % ', '.join(
+            '%s (%s)' % (x, failures[x][0]) for x in sorted(failures)))
+
+class RegionResults:
+    def __init__(self, description):
+        self.description = description
+        self.results = {}
+        self.failures = {}
+        self.durations = {}
+
+    def report(self):
+        lines = ['%s in %s regions, %s failed' % (self.description, len(self.durations), len(self.failures))]
+        for region in sorted(self.durations):
+            if region in self.failures:
+                lines.append('%8.1fs %s failed : %s' % (self.durations[region], region, self.failures[region][0]))
+            else:
+                lines.append('%8.1fs %s ok' % (self.durations[region], region))
+        for region in sorted(self.failures):
+            lines.append('%s traceback :\n%s' % (region, self.failures[region][1]))
+        return '\n'.join(lines)
+
+    def raise_for_failures(self):
+        if self.failures:
+            raise RegionError(self.failures)
+
+def fan_out(regions, operation, description='operation', max_workers=None):
+    """Call operation(region) for every region concurrently and return a
+    RegionResults of what each returned or raised."""
+    results = RegionResults(description)
+    regions = list(regions)
+    def run(region):
+        started = time.time()
+        try:
+            results.results[region] = operation(region)
+        except Exception as error:
+            results.failures[region] = (error, traceback.format_exc())
+            logging.error('%s failed in %s : %s' % (description, region, error))
+        results.durations[region] = time.time() - started
+    pool = ThreadPool(max(1, min(max_workers or len(regions), len(regions))))
+    try:
+        pool.map(run, regions)
+    finally:
+        pool.close()
+        pool.join()
+    logging.info(results.report())
+    return results
+
+def availability_zones(regions):
+    """Return a dict of region to its availability zones. regions is either
+    such a dict or a list of regions in AVAILABILITY_ZONES."""
+    if isinstance(regions, dict):
+        return regions
+    return dict((x, AVAILABILITY_ZONES[x]) for x in regions)
+
+def create_stacks(regions, environment, stack_type, application, path, name=None, **kwargs):
+    """create_stack in every region. The stack gets the same name in all of
+    them, picking one if none is given."""
+    if name == None:
+        import random
+        name = str(random.randint(1, 9999))
+    zones = availability_zones(regions)
+    return fan_out(sorted(zones),
+                   lambda region: stack_control.create_stack(region=region,
+                                                             environment=environment,
+                                                             stack_type=stack_type,
+                                                             application=application,
+                                                             availability_zones=zones[region],
+                                                             path=path,
+                                                             name=name,
+                                                             **kwargs),
+                   'create stack %s' % name)
+
+def destroy_stacks(regions, environment, stack_type, name):
+    return fan_out(regions,
+                   lambda region: stack_control.destroy_stack(region, environment, stack_type, name),
+                   'destroy stack %s' % name)
+
+def show_stacks(regions, environment, stack_type, name):
+    """Fetch the stack from every region at once then print them in order."""
+    results = fan_out(regions,
+                      lambda region: stack_control.get_stack(region, environment, stack_type, name),
+                      'show stack %s' % name)
+    for region in sorted(results.results):
+        stack_control.print_stack(region, stack_type, name, results.results[region])
+    return results
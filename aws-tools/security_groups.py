@@ -0,0 +1,251 @@
+"""Compile config/security_groups.json into the rules each group should have
+and apply them in as few calls as possible.
+
+Every rule is resolved up front for a VPC : "vpc" cidrs become the VPC's
+cidr, src_security_group_name becomes the environment's group name and
+references to groups that aren't defined are reported before anything is
+created. Each rule becomes a permission
+
+    (ip_protocol, from_port, to_port, ('cidr', cidr) or ('group', name))
+
+and a group's permissions are sent as one AuthorizeSecurityGroupIngress and
+one AuthorizeSecurityGroupEgress call, with permissions that differ only in
+their source merged into one IpPermissions item.
+
+    compiled = security_groups.compile_rules('identity-dev', '10.148.24.0/21',
+                                             config.security_groups())
+    security_groups.authorize_rules(region, group, compiled[group.name], group_ids)
+
+Every group also gets the internal egress rule to the VPC's cidr and loses
+the default egress rule to 0.0.0.0/0, unless its definition asks for it.
+
+drift() compares the groups in a VPC with the compiled rules. It describes
+every group in the VPC in one call, turns their rules into the same
+permissions, with group ids mapped back to names, and prints what would
+have to be authorized or revoked, which it can then apply with the same
+batched calls:
+
+    security_groups.drift('us-west-2', 'identity-dev', apply=False)
+"""
+
+import logging
+
+import connections
+import stack_config
+import waiters
+
+DEFAULT_EGRESS = ('-1', None, None, ('cidr', '0.0.0.0/0'))
+
+API_CALLS = {('authorize', 'ingress'): 'AuthorizeSecurityGroupIngress',
+             ('authorize', 'egress'): 'AuthorizeSecurityGroupEgress',
+             ('revoke', 'ingress'): 'RevokeSecurityGroupIngress',
+             ('revoke', 'egress'): 'RevokeSecurityGroupEgress'}
+
+def permission(ip_protocol, from_port, to_port, source):
+    """Return a permission in the one form used for both config and AWS
+    rules so they compare equal."""
+    ip_protocol = str(ip_protocol)
+    if ip_protocol == '-1':
+        from_port = to_port = None
+    return (ip_protocol,
+            None if from_port is None else int(from_port),
+            None if to_port is None else int(to_port),
+            source)
+
+def compile_rules(environment, vpc_cidr, definitions):
+    """Return a dict of group name to {'ingress': set, 'egress': set} of
+    permissions for the groups in definitions (security_groups.json) in a
+    VPC. Raises ConfigError for references to groups that aren't defined."""
+    names = set(environment + '-' + x[0] for x in definitions)
+    compiled = {}
+    for short_name, rules in definitions:
+        name = environment + '-' + short_name
+        group = compiled[name] = {'ingress': set(), 'egress': set([permission(-1, None, None, ('cidr', vpc_cidr))])}
+        for rule in rules:
+            if 'src_security_group_name' in rule:
+                source = ('group', environment + '-' + rule['src_security_group_name'])
+                if source[1] not in names:
+                    raise stack_config.ConfigError('security group %s refers to security group %s which isn\'t defined' % (
+                        short_name, rule['src_security_group_name']))
+            elif rule.get('cidr_ip') == 'vpc':
+                source = ('cidr', vpc_cidr)
+            elif 'cidr_ip' in rule:
+                source = ('cidr', rule['cidr_ip'])
+            else:
+                raise stack_config.ConfigError('security group %s has a rule with no source : %s' % (short_name, rule))
+            group[rule.get('direction', 'ingress')].add(
+                permission(rule['ip_protocol'], rule.get('from_port'), rule.get('to_port'), source))
+    return compiled
+
+def sources(rules):
+    """Return the names of the groups compiled rules refer to."""
+    return set(x[3][1] for x in rules['ingress'] | rules['egress'] if x[3][0] == 'group')
+
+def permission_params(group_id, permissions, group_ids):
+    """Return the parameters for one call that covers every permission.
+    group_ids maps the group names permissions refer to to their ids."""
+    merged = {}
+    for ip_protocol, from_port, to_port, source in permissions:
+        merged.setdefault((ip_protocol, from_port, to_port), []).append(source)
+    params = {'GroupId': group_id}
+    for i, key in enumerate(sorted(merged)):
+        prefix = 'IpPermissions.%d.' % (i + 1)
+        ip_protocol, from_port, to_port = key
+        params[prefix + 'IpProtocol'] = ip_protocol
+        if from_port is not None:
+            params[prefix + 'FromPort'] = from_port
+        if to_port is not None:
+            params[prefix + 'ToPort'] = to_port
+        cidrs = sorted(x[1] for x in merged[key] if x[0] == 'cidr')
+        groups = sorted(x[1] for x in merged[key] if x[0] == 'group')
+        for j, cidr in enumerate(cidrs):
+            params[prefix + 'IpRanges.%d.CidrIp' % (j + 1)] = cidr
+        for j, name in enumerate(groups):
+            params[prefix + 'Groups.%d.GroupId' % (j + 1)] = group_ids[name]
+    return params
+
+def change(region, action, direction, group_id, permissions, group_ids, attempts=6):
+    """Authorize or revoke permissions on a group in one call. A group that
+    was only just created sometimes isn't visible yet, so calls that fail
+    with a NotFound error are retried."""
+    import boto.exception
+    if not permissions:
+        return 0
+    conn_ec2 = connections.connect('boto.ec2', region)
+    params = permission_params(group_id, permissions, group_ids)
+    backoff = waiters.Backoff(1, 10)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            conn_ec2.get_status(API_CALLS[(action, direction)], params, verb='POST')
+            break
+        except boto.exception.EC2ResponseError as error:
+            if not (error.error_code or '').endswith('NotFound') or attempt >= attempts:
+                raise
+            logging.debug('security group %s not visible yet, retrying : %s' % (group_id, error.error_code))
+            backoff.sleep()
+    logging.debug('%sd %s %s permissions on security group %s' % (action, len(permissions), direction, group_id))
+    return 1
+
+def authorize_rules(region, security_group, rules, group_ids):
+    """Give a new security group its compiled rules. Returns the number of
+    calls made, at most three."""
+    calls = 0
+    if DEFAULT_EGRESS not in rules['egress']:
+        # Delete the default egress authorization
+        calls += change(region, 'revoke', 'egress', security_group.id, [DEFAULT_EGRESS], group_ids)
+    calls += change(region, 'authorize', 'ingress', security_group.id, rules['ingress'], group_ids)
+    calls += change(region, 'authorize', 'egress', security_group.id, rules['egress'] - set([DEFAULT_EGRESS]), group_ids)
+    logging.debug('added %s rules to security group %s with %s calls' % (
+        len(rules['ingress']) + len(rules['egress']), security_group.name, calls))
+    return calls
+
+def live_rules(region, vpc_id):
+    """Describe every security group in a VPC with one call. Returns a dict
+    of group name to {'ingress': set, 'egress': set} of permissions and a
+    dict of group name to id. Rules that refer to groups outside the VPC
+    keep the group's id as its name."""
+    conn_ec2 = connections.connect('boto.ec2', region)
+    groups = conn_ec2.get_all_security_groups(filters={'vpc-id': vpc_id})
+    names = dict((x.id, x.name) for x in groups)
+    group_ids = dict((x.name, x.id) for x in groups)
+    live = {}
+    for group in groups:
+        live[group.name] = {'ingress': set(), 'egress': set()}
+        for direction, rules in [('ingress', group.rules), ('egress', group.rules_egress)]:
+            for rule in rules:
+                for grant in rule.grants:
+                    if grant.cidr_ip:
+                        source = ('cidr', grant.cidr_ip)
+                    else:
+                        source = ('group', names.get(grant.group_id, grant.group_id))
+                        group_ids.setdefault(source[1], grant.group_id)
+                    live[group.name][direction].add(
+                        permission(rule.ip_protocol, rule.from_port, rule.to_port, source))
+    return live, group_ids
+
+def diff(compiled, live):
+    """Return the changes that make live match compiled as a list of
+    (group name, action, direction, permissions) and the names of the
+    groups that don't exist at all. Groups that aren't in compiled, like
+    default, are left alone."""
+    changes = []
+    missing = []
+    for name in sorted(compiled):
+        if name not in live:
+            missing.append(name)
+            continue
+        for direction in ['ingress', 'egress']:
+            # Revokes go first so a rule that's replaced doesn't briefly
+            # exist twice
+            extra = live[name][direction] - compiled[name][direction]
+            if extra:
+                changes.append((name, 'revoke', direction, extra))
+            absent = compiled[name][direction] - live[name][direction]
+            if absent:
+                changes.append((name, 'authorize', direction, absent))
+    return changes, missing
+
+def describe_permission(direction, permission):
+    ip_protocol, from_port, to_port, (kind, source) = permission
+    if ip_protocol == '-1':
+        ports = 'all'
+    elif from_port == to_port:
+        ports = '%s/%s' % (ip_protocol, from_port)
+    else:
+        ports = '%s/%s-%s' % (ip_protocol, from_port, to_port)
+    return '%s %s %s' % (ports, 'from' if direction == 'ingress' else 'to', source)
+
+def drift(region, environment, definitions=None, apply=False, output=None):
+    """Compare the security groups of an environment's VPC with
+    security_groups.json, print the authorize and revoke calls that would
+    reconcile them and, if apply, make those calls, one per group and
+    direction, concurrently. Returns the number of changes found."""
+    import sys
+    from multiprocessing.pool import ThreadPool
+    output = output or sys.stdout
+    if definitions is None:
+        definitions = stack_config.get().security_groups()
+    conn_vpc = connections.connect('boto.vpc', region)
+    vpcs = conn_vpc.get_all_vpcs(filters={'tag:Name': environment})
+    if not vpcs:
+        raise stack_config.ConfigError('unable to find vpc %s in %s' % (environment, region))
+    vpc = vpcs[0]
+
+    compiled = compile_rules(environment, vpc.cidr_block, definitions)
+    live, group_ids = live_rules(region, vpc.id)
+    changes, missing = diff(compiled, live)
+
+    for name in missing:
+        output.write('missing security group %s\n' % name)
+    for name, action, direction, permissions in changes:
+        for x in sorted(permissions):
+            output.write('%-9s %-7s %s %s\n' % (action, direction, name, describe_permission(direction, x)))
+    output.write('# %s %s : %s security groups, %s missing, %s changes\n' % (
+        region, environment, len(compiled), len(missing), sum(len(x[3]) for x in changes)))
+
+    if apply and changes:
+        # Permissions can only refer to groups that exist
+        unresolvable = [x for x in changes if [y for y in x[3] if y[3][0] == 'group' and y[3][1] not in group_ids]]
+        if unresolvable:
+            raise stack_config.ConfigError('unable to apply changes that refer to missing security groups %s' % (
+                ', '.join(sorted(missing))))
+        # Groups are changed concurrently but each group's revokes finish
+        # before its authorizes start
+        by_group = {}
+        for x in changes:
+            by_group.setdefault(x[0], []).append(x)
+        def apply_group(group_changes):
+            return sum(change(region, action, direction, group_ids[name], permissions, group_ids)
+                       for name, action, direction, permissions in
+                       sorted(group_changes, key=lambda x: x[1] != 'revoke'))
+        pool = ThreadPool(min(8, len(by_group)))
+        try:
+            calls = pool.map(apply_group, by_group.values())
+        finally:
+            pool.close()
+            pool.join()
+        logging.info('applied %s changes to %s in %s with %s calls' % (
+            sum(len(x[3]) for x in changes), environment, region, sum(calls)))
+    return len(missing) + sum(len(x[3]) for x in changes)
@@ -0,0 +1,205 @@
+"""Load the JSON files in config/ once, check them and index them.
+
+Every file is parsed the first time it's asked for, checked against a small
+schema and turned into read-only dicts and tuples, so callers can't change
+what another caller (or another thread of the same stack operation) sees.
+Indexes are built alongside the data and both are thrown away and rebuilt
+when a file's mtime changes, so a long running process picks up an edited
+file without re-parsing anything on every call. ami_map.json is read
+through the config directory's ami_registry.AmiRegistry, which does the
+same for AMIs and is what bakes write to.
+
+    config = stack_config.get()
+    for load_balancer in config.load_balancers('prod', 'persona'):
+        ...
+    image_id = config.ami('identity-bigtent-0.2', 'us-west-2')
+
+Callers that need to change something take a copy first with thaw().
+"""
+
+import json
+import os
+import threading
+
+import ami_registry
+
+class ConfigError(Exception):
+    pass
+
+class FrozenDict(dict):
+    """A dict that refuses to be changed. copy() returns a plain dict."""
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('config is read only, thaw() it first')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def copy(self):
+        return dict(self)
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+    return value
+
+def thaw(value):
+    """Return a mutable deep copy of a piece of config."""
+    if isinstance(value, dict):
+        return dict((k, thaw(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [thaw(x) for x in value]
+    return value
+
+# A schema is a type, a one element list (every item matches the element), a
+# tuple (a fixed length list matched position by position) or a dict of keys
+# to schemas. Dict keys starting with ? are optional, other keys are allowed.
+LISTENER = list
+HEALTHCHECK = {'target': basestring}
+LOAD_BALANCER = {'name': basestring,
+                 'subnet': basestring,
+                 'security_groups': [basestring],
+                 'is_internal': bool,
+                 'listeners': [LISTENER],
+                 '?application': basestring,
+                 '?healthcheck': HEALTHCHECK}
+AUTOSCALE = {'launch_configuration': {'tier': basestring,
+                                      'image_id': basestring,
+                                      'security_groups': [basestring],
+                                      '?instance_type': basestring},
+             'load_balancers': [basestring],
+             'subnet': basestring,
+             '?application': basestring,
+             '?desired_capacity': int,
+             '?scale_method': basestring}
+SECURITY_GROUP = (basestring, [{'ip_protocol': (basestring, int)}])
+
+def check(value, schema, where):
+    """Raise ConfigError if value doesn't match schema."""
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            raise ConfigError('%s should be a list' % where)
+        for i, item in enumerate(value):
+            check(item, schema[0], '%s[%s]' % (where, i))
+    elif isinstance(schema, tuple) and not all(isinstance(x, type) for x in schema):
+        if not isinstance(value, list) or len(value) != len(schema):
+            raise ConfigError('%s should be a list of %s items' % (where, len(schema)))
+        for i, item in enumerate(value):
+            check(item, schema[i], '%s[%s]' % (where, i))
+    elif isinstance(schema, dict):
+        if not isinstance(value, dict):
+            raise ConfigError('%s should be an object' % where)
+        for key, key_schema in schema.items():
+            if key.startswith('?'):
+                key = key[1:]
+                if key not in value:
+                    continue
+            elif key not in value:
+                raise ConfigError('%s is missing %s' % (where, key))
+            check(value[key], key_schema, '%s.%s' % (where, key))
+    elif not isinstance(value, schema):
+        raise ConfigError('%s is %r which is the wrong type' % (where, value))
+
+class Config:
+    def __init__(self, directory='config'):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.files = {}
+        self.indexes = {}
+        self.registry = ami_registry.AmiRegistry(os.path.join(directory, 'ami_map.json'))
+
+    def _load(self, filename, schema):
+        """Return the frozen contents of filename, re-reading it only when
+        its mtime has changed."""
+        path = os.path.join(self.directory, filename)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            raise ConfigError('unable to find config file %s' % path)
+        with self.lock:
+            if filename not in self.files or self.files[filename][0] != mtime:
+                with open(path, 'r') as f:
+                    try:
+                        data = json.load(f)
+                    except ValueError as error:
+                        raise ConfigError('unable to parse %s : %s' % (path, error))
+                check(data, schema, filename)
+                self.files[filename] = (mtime, freeze(data))
+            return self.files[filename]
+
+    def _index(self, name, files, build):
+        """Return the index called name built by build() from files, a list
+        of (filename, schema), rebuilding it if any of the files changed."""
+        with self.lock:
+            loaded = [self._load(filename, schema) for filename, schema in files]
+            mtimes = tuple(x[0] for x in loaded)
+            if name not in self.indexes or self.indexes[name][0] != mtimes:
+                self.indexes[name] = (mtimes, build(*[x[1] for x in loaded]))
+            return self.indexes[name][1]
+
+    def _by_application(self, entries):
+        index = {}
+        for entry in entries:
+            index[entry.get('application')] = index.get(entry.get('application'), ()) + (entry,)
+        return index
+
+    def _load_balancer_index(self, stack_type):
+        def build(public, private):
+            entries = public + private
+            return {'all': entries,
+                    'application': self._by_application(entries),
+                    'name': dict((x['name'], x) for x in entries)}
+        return self._index('load_balancers %s' % stack_type,
+                           [('elbs_public.%s.json' % stack_type, [LOAD_BALANCER]),
+                            ('elbs_private.json', [LOAD_BALANCER])],
+                           build)
+
+    def _autoscale_index(self, stack_type):
+        def build(entries):
+            return {'all': entries,
+                    'application': self._by_application(entries),
+                    'tier': dict((x['launch_configuration']['tier'], x) for x in entries)}
+        return self._index('autoscale %s' % stack_type,
+                           [('autoscale.%s.json' % stack_type, [AUTOSCALE])],
+                           build)
+
+    def load_balancers(self, stack_type, application=None):
+        """Return the load balancers for stack_type, optionally only those
+        for application."""
+        index = self._load_balancer_index(stack_type)
+        if application is None:
+            return index['all']
+        return index['application'].get(application, ())
+
+    def load_balancer(self, stack_type, name):
+        return self._load_balancer_index(stack_type)['name'].get(name)
+
+    def autoscale(self, stack_type, application=None):
+        """Return the autoscale groups for stack_type, optionally only those
+        for application."""
+        index = self._autoscale_index(stack_type)
+        if application is None:
+            return index['all']
+        return index['application'].get(application, ())
+
+    def autoscale_tier(self, stack_type, tier):
+        return self._autoscale_index(stack_type)['tier'].get(tier)
+
+    def ami(self, name, region):
+        """Return the AMI id for the AMI called name in region."""
+        try:
+            return self.registry.get(name, region)
+        except ami_registry.AmiRegistryError as error:
+            raise ConfigError(str(error))
+
+    def security_groups(self):
+        return self._load('security_groups.json', [SECURITY_GROUP])[1]
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+def get(directory='config'):
+    """Return the shared Config for directory."""
+    with _configs_lock:
+        if directory not in _configs:
+            _configs[directory] = Config(directory)
+        return _configs[directory]
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
 import logging
-logging.basicConfig(level=logging.DEBUG)
-
 import json
 import time
 import os
-import itertools
+
+import ami_resolver
+import ciphersuite
+import connections
+import stack_config
+import task_graph
+import teardown
+import waiters
+from inventory import Inventory
+from tagging import TagAccumulator
 
 class Stack:
     def __init__(self,
@@ -42,146 +49,80 @@ def test_for_stack_existence(region,
     if len(reservations) > 0:
         logging.error('stack exists. instances found : %s' % [x for x in reservations])
 
-def create_stack(region,
-                 environment,
-                 stack_type,
-                 application,
-                 availability_zones,
-                 path,
-                 replace=False,
-                 name=None,
-                 key_name=None,
-                 mini_stack=False,
-                 generic=False,
-                 hydrate=True):
-    if name == None:
-        # Maybe we set the stack name to the username of the user creating with a number suffix?
-        import random
-        name = str(random.randint(1, 9999))
-    if len(name) > 4:
-        raise ValueError("name must not exceed 4 characters in length. '%s' is too long" % name)
-
-    if not key_name:
-        key_name = '20130416-svcops-base-key'
-
-    from string import Template
-    import boto.ec2
-    import boto.ec2.elb
-    import boto.ec2.elb.healthcheck
-    import boto.vpc
+def get_user_data(stack_type, tier, stack_info, region, generic, hydrate):
+    if 'AWS_CONFIG_DIR' in os.environ:
+        user_data_filename = os.path.join(os.environ['AWS_CONFIG_DIR'], 'userdata.%s.%s.json' % (stack_type, tier))
+    else:
+        user_data_filename = 'config/userdata.%s.%s.json' % (stack_type, tier)
+
+    try:
+        with open(user_data_filename, 'r') as f:
+            user_data = json.load(f)
+    except IOError:
+        # There is no userdata file
+        return None
+    user_data.update({'tier': tier})
+    user_data.update({'stack': stack_info})
+    user_data.update({'aws_region': region})
+    if not generic:
+        if stack_type == 'stage':
+            user_data['run_list'].append('recipe[access]')
+    else:
+        # strip everything out except the run_list and tier
+        user_data = {'run_list': user_data['run_list'],
+                     'tier': user_data['tier']}
+    result = '''#!/bin/bash
+cat > /etc/chef/node.json <<End-of-message
+%s
+End-of-message
+''' % json.dumps(user_data, sort_keys=True, indent=4, separators=(',', ': '))
+    if generic:
+        result += "cd /root/identity-ops && git pull\n"
+    if hydrate:
+        result += "chef-solo -c /etc/chef/solo.rb -j /etc/chef/node.json\n"
+    return result
+
+SNS_TOPICS = {"us-west-2": "arn:aws:sns:us-west-2:351644144250:identity-alert",
+              "us-east-1": "arn:aws:sns:us-east-1:351644144250:identity-alert"}
+
+DEFAULT_HEALTHCHECK = {"interval" : 30,
+                       "target" : "HTTP:80/__heartbeat__",
+                       "healthy_threshold" : 3,
+                       "timeout" : 5,
+                       "unhealthy_threshold" : 5}
+
+def get_stack_specs(region,
+                    environment,
+                    stack_type,
+                    application,
+                    path,
+                    name,
+                    key_name,
+                    inventory):
+    """Work out the load balancers and autoscale groups a stack should have
+    from the config files.
+
+    Returns the stack's vpc, a list of load balancer specs and a list of
+    autoscale specs. Every spec is a dict of the parameters the create_*
+    functions below need. Launch configuration user data isn't included
+    because it depends on the load balancers that exist when the launch
+    configuration is created.
+    """
     import boto.iam
-    import boto.ec2.cloudwatch
-    import boto.ec2.cloudwatch.alarm
     conn_iam = boto.iam.connect_to_region('universal')
-    conn_elb = boto.ec2.elb.connect_to_region(region)
-    conn_vpc = boto.vpc.connect_to_region(region)
-    conn_ec2 = boto.ec2.connect_to_region(region)
-    conn_cw = boto.ec2.cloudwatch.connect_to_region(region)
-    stack = {}
 
-    # Apply recommendation from https://wiki.mozilla.org/Security/Server_Side_TLS
-    policy_attributes = {"ADH-AES128-GCM-SHA256": False,
-                        "ADH-AES256-GCM-SHA384": False,
-                        "ADH-AES128-SHA": False,
-                        "ADH-AES128-SHA256": False,
-                        "ADH-AES256-SHA": False,
-                        "ADH-AES256-SHA256": False,
-                        "ADH-CAMELLIA128-SHA": False,
-                        "ADH-CAMELLIA256-SHA": False,
-                        "ADH-DES-CBC3-SHA": False,
-                        "ADH-DES-CBC-SHA": False,
-                        "ADH-RC4-MD5": False,
-                        "ADH-SEED-SHA": False,
-                        "AES128-GCM-SHA256": True,
-                        "AES256-GCM-SHA384": True,
-                        "AES128-SHA": True,
-                        "AES128-SHA256": True,
-                        "AES256-SHA": True,
-                        "AES256-SHA256": True,
-                        "CAMELLIA128-SHA": True,
-                        "CAMELLIA256-SHA": True,
-                        "DES-CBC3-MD5": False,
-                        "DES-CBC3-SHA": False,
-                        "DES-CBC-MD5": False,
-                        "DES-CBC-SHA": False,
-                        "DHE-DSS-AES128-GCM-SHA256": True,
-                        "DHE-DSS-AES256-GCM-SHA384": True,
-                        "DHE-DSS-AES128-SHA": True,
-                        "DHE-DSS-AES128-SHA256": True,
-                        "DHE-DSS-AES256-SHA": True,
-                        "DHE-DSS-AES256-SHA256": True,
-                        "DHE-DSS-CAMELLIA128-SHA": False,
-                        "DHE-DSS-CAMELLIA256-SHA": False,
-                        "DHE-DSS-SEED-SHA": False,
-                        "DHE-RSA-AES128-GCM-SHA256": True,
-                        "DHE-RSA-AES256-GCM-SHA384": True,
-                        "DHE-RSA-AES128-SHA": True,
-                        "DHE-RSA-AES128-SHA256": True,
-                        "DHE-RSA-AES256-SHA": True,
-                        "DHE-RSA-AES256-SHA256": True,
-                        "DHE-RSA-CAMELLIA128-SHA": False,
-                        "DHE-RSA-CAMELLIA256-SHA": False,
-                        "DHE-RSA-SEED-SHA": False,
-                        "EDH-DSS-DES-CBC3-SHA": False,
-                        "EDH-DSS-DES-CBC-SHA": False,
-                        "EDH-RSA-DES-CBC3-SHA": False,
-                        "EDH-RSA-DES-CBC-SHA": False,
-                        "EXP-ADH-DES-CBC-SHA": False,
-                        "EXP-ADH-RC4-MD5": False,
-                        "EXP-DES-CBC-SHA": False,
-                        "EXP-EDH-DSS-DES-CBC-SHA": False,
-                        "EXP-EDH-RSA-DES-CBC-SHA": False,
-                        "EXP-KRB5-DES-CBC-MD5": False,
-                        "EXP-KRB5-DES-CBC-SHA": False,
-                        "EXP-KRB5-RC2-CBC-MD5": False,
-                        "EXP-KRB5-RC2-CBC-SHA": False,
-                        "EXP-KRB5-RC4-MD5": False,
-                        "EXP-KRB5-RC4-SHA": False,
-                        "EXP-RC2-CBC-MD5": False,
-                        "EXP-RC4-MD5": False,
-                        "IDEA-CBC-SHA": False,
-                        "KRB5-DES-CBC3-MD5": False,
-                        "KRB5-DES-CBC3-SHA": False,
-                        "KRB5-DES-CBC-MD5": False,
-                        "KRB5-DES-CBC-SHA": False,
-                        "KRB5-RC4-MD5": False,
-                        "KRB5-RC4-SHA": False,
-                        "Protocol-SSLv2": False,
-                        "Protocol-SSLv3": True,
-                        "Protocol-TLSv1": True,
-                        "Protocol-TLSv1.1": True,
-                        "Protocol-TLSv1.2": True,
-                        "PSK-3DES-EDE-CBC-SHA": False,
-                        "PSK-AES128-CBC-SHA": False,
-                        "PSK-AES256-CBC-SHA": False,
-                        "PSK-RC4-SHA": False,
-                        "RC2-CBC-MD5": False,
-                        "RC4-MD5": False,
-                        "RC4-SHA": True,
-                        "SEED-SHA": False}
-
-    policy_name = 'Mozilla-Security-Assurance-Ciphersuite-Policy-v-1-2'
-
-    ami_map = json.load(open('config/ami_map.json', 'r'))
-
-    sns_topics = {"us-west-2": "arn:aws:sns:us-west-2:351644144250:identity-alert",
-                  "us-east-1": "arn:aws:sns:us-east-1:351644144250:identity-alert"}
-
-    existing_vpcs = conn_vpc.get_all_vpcs()
-    # This will throw an IndexError exception if the VPC isn't found which isn't very intuitive
-    vpc = [x for x in existing_vpcs if 'Name' in x.tags and x.tags['Name'] == environment][0]
-    
-    stack['loadbalancer'] = []
-    existing_load_balancers = conn_elb.get_all_load_balancers()
-    existing_security_groups = conn_ec2.get_all_security_groups()
+    vpc = inventory.get('vpcs', 'tag:Name', environment)
+    if vpc is None:
+        raise ValueError("unable to find vpc %s in %s" % (environment, region))
+
     existing_certs = conn_iam.get_all_server_certs(path_prefix=path)['list_server_certificates_response']['list_server_certificates_result']['server_certificate_metadata_list']
-    existing_subnets = conn_vpc.get_all_subnets(filters=[('vpcId', [vpc.id])])
+    existing_subnets = inventory.find('subnets', 'vpc', vpc.id)
+    config = stack_config.get()
 
-    for load_balancers_params in json.load(open('config/elbs_public.%s.json' % stack_type, 'r')) + json.load(open('config/elbs_private.json')):
-        if load_balancers_params['application'] != application:
-            continue
-        load_balancers_params['name'] = '%s-%s' % (load_balancers_params['name'], name)
-        for listener in load_balancers_params['listeners']:
+    load_balancer_specs = []
+    for load_balancers_params in config.load_balancers(stack_type, application):
+        listeners = stack_config.thaw(load_balancers_params['listeners'])
+        for listener in listeners:
             if len(listener) == 4:
                 # Convert the cert name to an ARN
                 # listener[3] = global_data['certs'][listener[3]]['arn']
@@ -192,154 +133,34 @@ def create_stack(region,
                     logging.error("unable to find cert %s in certs %s" % (listener[3], existing_certs))
                     raise
 
-        # subnets = []
-        # for availability_zone in vpc['availability_zones'].keys():
-        #    for subnet_name in load_balancers_params['subnets']:
-        #        subnets.append(vpc['availability_zones'][availability_zone]['subnets'][subnet_name].id)
-
         subnets = [x for x in existing_subnets if 'Name' in x.tags and environment + '-' + load_balancers_params['subnet'] in x.tags['Name']]
 
-        security_groups = [x for x in existing_security_groups if x.name in [environment + '-' + y for y in load_balancers_params['security_groups']]]
-
-        # This doesn't converge the configuration of the loadbalancer
-        # it merely checks if it exists
-        if load_balancers_params['name'] in [x.name for x in existing_load_balancers]:
-            if replace:
-                conn_elb.delete_load_balancer(load_balancers_params['name'])
-            else:
-                continue
-
-        stack['loadbalancer'].append(conn_elb.create_load_balancer(
-                                       name=load_balancers_params['name'],
-                                       zones=None,
-                                       listeners=load_balancers_params['listeners'],
-                                       subnets=[x.id for x in subnets],
-                                       security_groups=[x.id for x in security_groups],
-                                       scheme='internal' if load_balancers_params['is_internal'] else 'internet-facing'
-                                       ))
-        load_balancer = stack['loadbalancer'][-1]
-        
-        # TODO : tag the load_balancer
-
-        healthcheck_params = load_balancers_params['healthcheck'] if 'healthcheck' in load_balancers_params else {
-            "interval" : 30,
-            "target" : "HTTP:80/__heartbeat__",
-            "healthy_threshold" : 3,
-            "timeout" : 5,
-            "unhealthy_threshold" : 5
-        }
-        # healthcheck_params['access_point'] = load_balancer[name]
-        load_balancer.configure_health_check(boto.ec2.elb.healthcheck.HealthCheck(**healthcheck_params))
-
-        # set the Ciphersuite for https listeners
-        https_listeners = [x[0] for x in load_balancers_params['listeners'] if x[2] == 'HTTPS']
-        for listener in https_listeners:
-            # Create the Ciphersuite Policy
-            params = {'LoadBalancerName': load_balancers_params['name'],
-                      'PolicyName': policy_name,
-                      'PolicyTypeName': 'SSLNegotiationPolicyType'}
-            conn_elb.build_complex_list_params(params, 
-                                               [(x, policy_attributes[x]) for x in policy_attributes.keys()],
-                                               'PolicyAttributes.member',
-                                               ('AttributeName', 'AttributeValue'))
-            policy = conn_elb.get_list('CreateLoadBalancerPolicy', params, None)
-            
-            # Apply the Ciphersuite Policy to your ELB
-            params = {'LoadBalancerName': load_balancers_params['name'],
-                      'LoadBalancerPort': listener,
-                      'PolicyNames.member.1': policy_name}
-            
-            result = conn_elb.get_list('SetLoadBalancerPoliciesOfListener', params, None)
-            logging.debug("New Policy '%s' created and applied to load balancer %s in %s" % (policy_name, load_balancers_params['name'], region))
-
-        if environment == 'prod':
-            # monitor the ELB
-            metric = "HTTPCode_Backend_5XX"
-            threshold = 6
-            period = 120
-            metric_alarm = boto.ec2.cloudwatch.alarm.MetricAlarm(
-                name="%s %s" % (load_balancers_params['name'], metric),
-                metric=metric,
-                namespace="AWS/ELB",
-                statistic="Average",
-                comparison=">=",
-                threshold=threshold,
-                period=period,
-                evaluation_periods=1,
-                unit="Count",
-                alarm_actions=[sns_topics[region]],
-                dimensions={"LoadBalancerName": load_balancers_params['name']},
-                description="Alarm when the rate of %s exceeds the threshold %s for %s seconds on the %s ELB" % (
-                             metric, threshold, period, load_balancers_params['name']))
-            conn_cw.put_metric_alarm(metric_alarm)
-        
-        stack['loadbalancer'].append(load_balancer)
-
-    existing_load_balancers = conn_elb.get_all_load_balancers()
-
-    stack_info = {}
-    stack_info['load_balancers'] = {}
-    for x in [y for y in existing_load_balancers if y.vpc_id == vpc.id and y.name.endswith('-%s' % name) or y.name.endswith('-univ-%s' % stack_type)]:
-        if x.name.endswith('-univ-%s' % stack_type):
-            si_tier_name = x.name[:-len('-univ-%s' % stack_type)]
-        elif x.name.endswith('-%s' % name):
-            si_tier_name = x.name[:-len('-%s' % name)]
-        stack_info['load_balancers'][si_tier_name] = {}
-        stack_info['load_balancers'][si_tier_name]['dns_name'] = x.dns_name
-        stack_info['load_balancers'][si_tier_name]['name'] = x.name
-
-    stack_info.update({'name': name,
-                       'type': stack_type,
-                       'environment': environment})
-    
-    # auto scale
-    import boto.ec2.autoscale
-    import boto.ec2.autoscale.tag
-    conn_autoscale = boto.ec2.autoscale.connect_to_region(region)
+        security_groups = inventory.named('security_groups', [environment + '-' + y for y in load_balancers_params['security_groups']])
 
-    stack['launch_configuration'] = []
-    stack['autoscale_group'] = []
+        load_balancer_specs.append({'short_name': load_balancers_params['name'],
+                                    'name': '%s-%s' % (load_balancers_params['name'], name),
+                                    'listeners': listeners,
+                                    'subnets': [x.id for x in subnets],
+                                    'security_groups': [x.id for x in security_groups],
+                                    'scheme': 'internal' if load_balancers_params['is_internal'] else 'internet-facing',
+                                    'environment': environment,
+                                    'tags': {'App': 'identity',
+                                             'Env': stack_type,
+                                             'Stack': name},
+                                    'healthcheck': stack_config.thaw(load_balancers_params['healthcheck']) if 'healthcheck' in load_balancers_params else DEFAULT_HEALTHCHECK})
 
     # I'm going to combine launch configuration and autoscale group because I don't
     # see us having more than one autoscale group for each launch configuration
 
-    for autoscale_params in json.load(open('config/autoscale.%s.json' % stack_type, 'r')):
-        if autoscale_params['application'] != application:
-            continue
-        launch_configuration_params = autoscale_params['launch_configuration']
+    # Every tier's image is resolved at once, from the AMI map or failing
+    # that with one describe call
+    image_ids = ami_resolver.resolve(region, [x['launch_configuration']['image_id'] for x in config.autoscale(stack_type, application)])
+
+    autoscale_specs = []
+    for autoscale_params in config.autoscale(stack_type, application):
+        launch_configuration_params = stack_config.thaw(autoscale_params['launch_configuration'])
         tier = launch_configuration_params['tier']
 
-        if 'AWS_CONFIG_DIR' in os.environ:
-            user_data_filename = os.path.join(os.environ['AWS_CONFIG_DIR'], 'userdata.%s.%s.json' % (stack_type, tier))
-        else:
-            user_data_filename = 'config/userdata.%s.%s.json' % (stack_type, tier)
-
-        try:
-            with open(user_data_filename, 'r') as f:
-                user_data = json.load(f)
-                user_data.update({'tier': tier})
-                user_data.update({'stack': stack_info})
-                user_data.update({'aws_region': region})
-                if not generic:
-                    if stack_type == 'stage':
-                        user_data['run_list'].append('recipe[access]')
-                else:
-                    # strip everything out except the run_list and tier
-                    user_data = {'run_list': user_data['run_list'],
-                                 'tier': user_data['tier']}
-                launch_configuration_params['user_data'] = '''#!/bin/bash
-cat > /etc/chef/node.json <<End-of-message
-%s
-End-of-message
-''' % json.dumps(user_data, sort_keys=True, indent=4, separators=(',', ': '))
-                if generic:
-                    launch_configuration_params['user_data'] += "cd /root/identity-ops && git pull\n"
-                if hydrate:
-                    launch_configuration_params['user_data'] += "chef-solo -c /etc/chef/solo.rb -j /etc/chef/node.json\n"
-        except IOError:
-            # There is no userdata file
-            pass
-        
         launch_configuration_params['name'] = '%s-%s-%s-%s' % (environment, stack_type, tier, name)
         # TODO : pull the "key_name" out of the json config
         # and set this per stack_type. prod keys for prod servers etc.
@@ -357,10 +178,10 @@ End-of-message
         # launch_configuration_params['security_groups'].append('monitorable')
         
         # launch_configuration_params['security_groups'] = [vpc['security-groups'][environment + '-' + x].id for x in launch_configuration_params['security_groups']]
-        launch_configuration_params['security_groups'] = [x.id for x in existing_security_groups if x.name in [environment + '-' + y for y in launch_configuration_params['security_groups']]]
+        launch_configuration_params['security_groups'] = [x.id for x in inventory.named('security_groups', [environment + '-' + y for y in launch_configuration_params['security_groups']])]
 
         # ami mapping
-        launch_configuration_params['image_id'] = ami_map[launch_configuration_params['image_id']][region]
+        launch_configuration_params['image_id'] = image_ids[launch_configuration_params['image_id']]
 
         # key_name
         launch_configuration_params['key_name'] = key_name
@@ -374,96 +195,341 @@ End-of-message
             launch_configuration_params['instance_profile_name'] = 'identity'
 
         ag_subnets = [x.id for x in existing_subnets if 'Name' in x.tags and environment + '-' + autoscale_params['subnet'] in x.tags['Name']]
-        vpc_zone_identifier = ','.join(ag_subnets)
 
-        if 'scale_method' in autoscale_params and autoscale_params['scale_method'] == 'manual':
+        manual = 'scale_method' in autoscale_params and autoscale_params['scale_method'] == 'manual'
+        if manual:
             launch_configuration_params['security_group_ids'] = launch_configuration_params['security_groups']
             del(launch_configuration_params['security_groups'])
             launch_configuration_params['monitoring_enabled'] = launch_configuration_params['instance_monitoring']
             del(launch_configuration_params['instance_monitoring'])
-            instance_name = launch_configuration_params['name']
             del(launch_configuration_params['name'])
 
             if 'ebs_optimized' in autoscale_params and autoscale_params['ebs_optimized']:
-                launch_configuration_params['ebs_optimized'] = true
+                launch_configuration_params['ebs_optimized'] = True
             # kernel_id? do we need to set this or is None ok?
             # monitoring_enabled
-            
-            current_capacity = 0
-            for subnet in itertools.cycle([x for x in existing_subnets if x.id in ag_subnets]):
-                launch_configuration_params['placement'] = subnet.availability_zone
-                launch_configuration_params['subnet_id'] = subnet.id
-                reservation = conn_ec2.run_instances(launch_configuration_params)
-                current_capacity += 1
-                reservation.instances[0].add_tag('Name', instance_name)
-                reservation.instances[0].add_tag('App', 'identity')
-                reservation.instances[0].add_tag('Env', stack_type)
-                reservation.instances[0].add_tag('Stack', name)
-                reservation.instances[0].add_tag('Tier', tier)
-                if current_capacity >= autoscale_params['desired_capacity'] if 'desired_capacity' in autoscale_params else 1:
-                    break
         else:
             del(launch_configuration_params['tier'])
             if 'ebs_optimized' in launch_configuration_params:
                 del(launch_configuration_params['ebs_optimized'])  # boto doesn't yet support ebsoptimized for autoscaled gropup
-            stack['launch_configuration'].append(boto.ec2.autoscale.LaunchConfiguration(**launch_configuration_params))
-            launch_configuration = stack['launch_configuration'][-1]
-    
-            # Don't know what this returns, maybe I should use the return object from create_launch_configuration
-            # instead of the instance from the LaunchConfiguration constructor
-            # http://docs.aws.amazon.com/AutoScaling/latest/APIReference/API_CreateLaunchConfiguration.html
-            # https://github.com/boto/boto/blob/7d1c814c4fecaa69b887e5f1b723ab1f8361cde0/boto/ec2/autoscale/__init__.py#L240
-            conn_autoscale.create_launch_configuration(launch_configuration)
-
-            autoscale_group = boto.ec2.autoscale.AutoScalingGroup(
-                    group_name=launch_configuration_params['name'],
-                    load_balancers=['%s-%s' % (x, name) for x in autoscale_params['load_balancers']],
-                    availability_zones=[region + x for x in availability_zones],
-                    launch_config=launch_configuration,
-                    min_size=1,
-                    max_size=12,
-                    vpc_zone_identifier=vpc_zone_identifier,
-                    desired_capacity=0,
-                    connection=conn_autoscale)
-            conn_autoscale.create_auto_scaling_group(autoscale_group)
-            
-            stack['autoscale_group'].append(conn_autoscale.get_all_groups(names=[launch_configuration_params['name']])[0])
-            autoscale_group = stack['autoscale_group'][-1]
-    
-            conn_autoscale.create_or_update_tags([boto.ec2.autoscale.Tag(key='Name',
-                                                                         value=launch_configuration_params['name'],
-                                                                         propagate_at_launch=True,
-                                                                         resource_id=launch_configuration_params['name']),
-                                                  boto.ec2.autoscale.Tag(key='App',
-                                                                         value='identity',
-                                                                         propagate_at_launch=True,
-                                                                         resource_id=launch_configuration_params['name']),
-                                                  boto.ec2.autoscale.Tag(key='Env',
-                                                                         value=stack_type,
-                                                                         propagate_at_launch=True,
-                                                                         resource_id=launch_configuration_params['name']),
-                                                  boto.ec2.autoscale.Tag(key='Stack',
-                                                                         value=name,
-                                                                         propagate_at_launch=True,
-                                                                         resource_id=launch_configuration_params['name']),
-                                                  boto.ec2.autoscale.Tag(key='Tier',
-                                                                         value=tier,
-                                                                         propagate_at_launch=True,
-                                                                         resource_id=launch_configuration_params['name'])])    
-
-            # Now we set_desired_capacity up from 0 so instances start spinning up
-            if mini_stack:
-                autoscale_params['desired_capacity'] = 1
-
-            conn_autoscale.set_desired_capacity(launch_configuration_params['name'],
-                                                autoscale_params['desired_capacity'] if 'desired_capacity' in autoscale_params else 1)
-
-            # Let's see how it's going
-            # conn_autoscale = boto.ec2.autoscale.connect_to_region(region)
-            # conn_autoscale.get_all_groups(['identity-dev1-stage-admin-g1'])[0].get_activities()
-            # conn_autoscale.get_all_groups(['identity-dev-stage-admin-g1'])[0].get_activities()
-        
-            # Associate Elastic IP with admin box?
+
+        autoscale_specs.append({'tier': tier,
+                                'name': '%s-%s-%s-%s' % (environment, stack_type, tier, name),
+                                'environment': environment,
+                                'manual': manual,
+                                'launch_configuration': launch_configuration_params,
+                                'short_load_balancers': list(autoscale_params['load_balancers']),
+                                'load_balancers': ['%s-%s' % (x, name) for x in autoscale_params['load_balancers']],
+                                'subnets': ag_subnets,
+                                'desired_capacity': autoscale_params['desired_capacity'] if 'desired_capacity' in autoscale_params else 1})
+    return vpc, load_balancer_specs, autoscale_specs
+
+def create_load_balancer(region, spec, replace=False, tags=None):
+    conn_elb = connections.connect('boto.ec2.elb', region)
+    if replace:
+        conn_elb.delete_load_balancer(spec['name'])
+    load_balancer = conn_elb.create_load_balancer(
+                        name=spec['name'],
+                        zones=None,
+                        listeners=spec['listeners'],
+                        subnets=spec['subnets'],
+                        security_groups=spec['security_groups'],
+                        scheme=spec['scheme'])
+    if tags is None:
+        tags = TagAccumulator(region)
+        tags.add_load_balancer(spec['name'], spec['tags'])
+        tags.flush()
+    else:
+        tags.add_load_balancer(spec['name'], spec['tags'])
+    return load_balancer
+
+def configure_health_check(region, spec):
+    import boto.ec2.elb.healthcheck
+    conn_elb = connections.connect('boto.ec2.elb', region)
+    return conn_elb.configure_health_check(spec['name'],
+                                           boto.ec2.elb.healthcheck.HealthCheck(**spec['healthcheck']))
+
+def set_ciphersuite(region, spec, ports=None, create_policy=True):
+    # set the Ciphersuite for https listeners
+    https_listeners = ports or [x[0] for x in spec['listeners'] if x[2] == 'HTTPS']
+    return ciphersuite.set_policy(region, spec['name'], https_listeners, create_policy)
+
+def create_alarm(region, spec):
+    # monitor the ELB
+    import boto.ec2.cloudwatch.alarm
+    conn_cw = connections.connect('boto.ec2.cloudwatch', region)
+    metric = "HTTPCode_Backend_5XX"
+    threshold = 6
+    period = 120
+    metric_alarm = boto.ec2.cloudwatch.alarm.MetricAlarm(
+        name="%s %s" % (spec['name'], metric),
+        metric=metric,
+        namespace="AWS/ELB",
+        statistic="Average",
+        comparison=">=",
+        threshold=threshold,
+        period=period,
+        evaluation_periods=1,
+        unit="Count",
+        alarm_actions=[SNS_TOPICS[region]],
+        dimensions={"LoadBalancerName": spec['name']},
+        description="Alarm when the rate of %s exceeds the threshold %s for %s seconds on the %s ELB" % (
+                     metric, threshold, period, spec['name']))
+    conn_cw.put_metric_alarm(metric_alarm)
+
+def get_stack_info(vpc, environment, stack_type, name, inventory):
+    """Describe the stack's load balancers for the user data of its
+    instances."""
+    stack_info = {}
+    stack_info['load_balancers'] = {}
+    for x in [y for y in inventory.all('load_balancers') if y.vpc_id == vpc.id and y.name.endswith('-%s' % name) or y.name.endswith('-univ-%s' % stack_type)]:
+        if x.name.endswith('-univ-%s' % stack_type):
+            si_tier_name = x.name[:-len('-univ-%s' % stack_type)]
+        elif x.name.endswith('-%s' % name):
+            si_tier_name = x.name[:-len('-%s' % name)]
+        stack_info['load_balancers'][si_tier_name] = {}
+        stack_info['load_balancers'][si_tier_name]['dns_name'] = x.dns_name
+        stack_info['load_balancers'][si_tier_name]['name'] = x.name
+
+    stack_info.update({'name': name,
+                       'type': stack_type,
+                       'environment': environment})
+    return stack_info
+
+def create_launch_configuration(region, spec, user_data, name=None):
+    import boto.ec2.autoscale
+    conn_autoscale = connections.connect('boto.ec2.autoscale', region)
+    launch_configuration_params = dict(spec['launch_configuration'])
+    if user_data is not None:
+        launch_configuration_params['user_data'] = user_data
+    if name:
+        launch_configuration_params['name'] = name
+    launch_configuration = boto.ec2.autoscale.LaunchConfiguration(**launch_configuration_params)
+
+    # Don't know what this returns, maybe I should use the return object from create_launch_configuration
+    # instead of the instance from the LaunchConfiguration constructor
+    # http://docs.aws.amazon.com/AutoScaling/latest/APIReference/API_CreateLaunchConfiguration.html
+    # https://github.com/boto/boto/blob/7d1c814c4fecaa69b887e5f1b723ab1f8361cde0/boto/ec2/autoscale/__init__.py#L240
+    conn_autoscale.create_launch_configuration(launch_configuration)
+    return launch_configuration
+
+def create_autoscale_group(region, spec, launch_configuration, availability_zones, stack_type, name):
+    import boto.ec2.autoscale
+    import boto.ec2.autoscale.tag
+    conn_autoscale = connections.connect('boto.ec2.autoscale', region)
+    autoscale_group = boto.ec2.autoscale.AutoScalingGroup(
+            group_name=spec['name'],
+            load_balancers=spec['load_balancers'],
+            availability_zones=[region + x for x in availability_zones],
+            launch_config=launch_configuration,
+            min_size=1,
+            max_size=12,
+            vpc_zone_identifier=','.join(spec['subnets']),
+            desired_capacity=0,
+            connection=conn_autoscale)
+    conn_autoscale.create_auto_scaling_group(autoscale_group)
+
+    conn_autoscale.create_or_update_tags([boto.ec2.autoscale.Tag(key='Name',
+                                                                 value=spec['name'],
+                                                                 propagate_at_launch=True,
+                                                                 resource_id=spec['name']),
+                                          boto.ec2.autoscale.Tag(key='App',
+                                                                 value='identity',
+                                                                 propagate_at_launch=True,
+                                                                 resource_id=spec['name']),
+                                          boto.ec2.autoscale.Tag(key='Env',
+                                                                 value=stack_type,
+                                                                 propagate_at_launch=True,
+                                                                 resource_id=spec['name']),
+                                          boto.ec2.autoscale.Tag(key='Stack',
+                                                                 value=name,
+                                                                 propagate_at_launch=True,
+                                                                 resource_id=spec['name']),
+                                          boto.ec2.autoscale.Tag(key='Tier',
+                                                                 value=spec['tier'],
+                                                                 propagate_at_launch=True,
+                                                                 resource_id=spec['name'])])    
+    return conn_autoscale.get_all_groups(names=[spec['name']])[0]
+
+def set_desired_capacity(region, spec, mini_stack=False):
+    # Now we set_desired_capacity up from 0 so instances start spinning up
+    conn_autoscale = connections.connect('boto.ec2.autoscale', region)
+    conn_autoscale.set_desired_capacity(spec['name'],
+                                        1 if mini_stack else spec['desired_capacity'])
+
+    # Let's see how it's going
+    # conn_autoscale = boto.ec2.autoscale.connect_to_region(region)
+    # conn_autoscale.get_all_groups(['identity-dev1-stage-admin-g1'])[0].get_activities()
+    # conn_autoscale.get_all_groups(['identity-dev-stage-admin-g1'])[0].get_activities()
+
+    # Associate Elastic IP with admin box?
+
+def run_instances(region, spec, user_data, inventory, stack_type, name, wait=True):
+    """Start a manually scaled tier's instances, spread across its subnets.
+
+    The number of instances each subnet should have is worked out up front
+    and only what's missing, counting instances of the tier already pending
+    or running there, is started with one run_instances call per subnet.
+    """
+    conn_ec2 = connections.connect('boto.ec2', region)
+    launch_configuration_params = dict(spec['launch_configuration'])
+    del(launch_configuration_params['tier'])
+    if user_data is not None:
+        launch_configuration_params['user_data'] = user_data
+
+    # Deal the desired capacity out across the subnets in turn
+    if not spec['subnets']:
+        raise stack_config.ConfigError('tier %s matches no subnets in vpc %s in %s' % (
+            spec['tier'], spec['environment'], region))
+    subnets = [inventory.get('subnets', 'id', x) for x in spec['subnets']]
+    desired = dict((x.id, 0) for x in subnets)
+    for i in range(spec['desired_capacity']):
+        desired[subnets[i % len(subnets)].id] += 1
+
+    reservations = conn_ec2.get_all_instances(filters={'tag:Stack': name,
+                                                       'tag:Tier': spec['tier'],
+                                                       'instance-state-name': ['pending', 'running'],
+                                                       'subnet-id': spec['subnets']})
+    existing = dict((x.id, 0) for x in subnets)
+    for instance in sum([x.instances for x in reservations], []):
+        existing[instance.subnet_id] += 1
+
+    tags = TagAccumulator(region)
+    instance_ids = []
+    for subnet in subnets:
+        missing = desired[subnet.id] - existing[subnet.id]
+        if missing <= 0:
+            continue
+        launch_configuration_params['placement'] = subnet.availability_zone
+        launch_configuration_params['subnet_id'] = subnet.id
+        reservation = conn_ec2.run_instances(min_count=missing,
+                                             max_count=missing,
+                                             **launch_configuration_params)
+        logging.debug('started %s %s instances in %s' % (missing, spec['tier'], subnet.availability_zone))
+        for instance in reservation.instances:
+            instance_ids.append(instance.id)
+            tags.add(instance.id, {'Name': spec['name'],
+                                   'App': 'identity',
+                                   'Env': stack_type,
+                                   'Stack': name,
+                                   'Tier': spec['tier']})
+    tags.flush()
+
+    if wait and instance_ids:
+        list(waiters.wait_for_instances([(region, x) for x in instance_ids]))
+    return instance_ids
+
+def create_stack(region,
+                 environment,
+                 stack_type,
+                 application,
+                 availability_zones,
+                 path,
+                 replace=False,
+                 name=None,
+                 key_name=None,
+                 mini_stack=False,
+                 generic=False,
+                 hydrate=True,
+                 max_workers=8,
+                 inventory=None):
+    if name == None:
+        # Maybe we set the stack name to the username of the user creating with a number suffix?
+        import random
+        name = str(random.randint(1, 9999))
+    if len(name) > 4:
+        raise ValueError("name must not exceed 4 characters in length. '%s' is too long" % name)
+
+    if not key_name:
+        key_name = '20130416-svcops-base-key'
+
+    if inventory is None:
+        inventory = Inventory(region, ['vpcs', 'subnets', 'security_groups', 'load_balancers'])
+    vpc, load_balancer_specs, autoscale_specs = get_stack_specs(region, environment, stack_type, application,
+                                                                path, name, key_name, inventory)
+
+    # Everything below is added to a task graph so that independent resources
+    # are created concurrently. Each task opens its own connections through
+    # connections.connect since boto connections can't be shared across threads
+    graph = task_graph.TaskGraph(max_workers)
+
+    # Task names, keyed on the short ELB name from the config, that must finish
+    # before the ELB exists (created) and before it's fully configured
+    elb_created = {}
+    elb_configured = {}
+    tags = TagAccumulator(region)
+
+    for spec in load_balancer_specs:
+        # This doesn't converge the configuration of the loadbalancer
+        # it merely checks if it exists. Use plan_stack and apply_stack in
+        # stack_plan to converge an existing stack
+        exists = inventory.get('load_balancers', 'name', spec['name']) is not None
+        if exists and not replace:
+            continue
+
+        elb_created[spec['short_name']] = graph.add('elb %s' % spec['name'],
+                                                    lambda spec=spec, exists=exists: create_load_balancer(region, spec, exists, tags),
+                                                    phase='load balancers')
+        elb_configured[spec['short_name']] = [elb_created[spec['short_name']]]
+        elb_configured[spec['short_name']].append(graph.add('healthcheck %s' % spec['name'],
+                                                            lambda spec=spec: configure_health_check(region, spec),
+                                                            [elb_created[spec['short_name']]], phase='health checks'))
+        if [x for x in spec['listeners'] if x[2] == 'HTTPS']:
+            elb_configured[spec['short_name']].append(graph.add('ciphersuite %s' % spec['name'],
+                                                                lambda spec=spec: set_ciphersuite(region, spec),
+                                                                [elb_created[spec['short_name']]], phase='ciphersuite policies'))
+        if environment == 'prod':
+            elb_configured[spec['short_name']].append(graph.add('alarm %s' % spec['name'],
+                                                                lambda spec=spec: create_alarm(region, spec),
+                                                                [elb_created[spec['short_name']]], phase='alarms'))
+
+    # The user data of every tier describes every load balancer in the stack
+    # so launch configurations wait for all of them to exist, though not for
+    # their health checks, policies or alarms
+    def describe_stack():
+        inventory.refresh('load_balancers', [graph.result(x).name for x in elb_created.values()])
+        return get_stack_info(vpc, environment, stack_type, name, inventory)
+    graph.add('stack info', describe_stack, elb_created.values(), phase='stack info')
+    # All of the load balancers are tagged together once they exist
+    graph.add('load balancer tags', tags.flush, elb_created.values(), phase='tags')
+
+    def user_data(spec):
+        return get_user_data(stack_type, spec['tier'], graph.result('stack info'), region, generic, hydrate)
+
+    for spec in autoscale_specs:
+        tier = spec['tier']
+        if spec['manual']:
+            graph.add('instances %s' % tier,
+                      lambda spec=spec: run_instances(region, spec, user_data(spec), inventory, stack_type, name),
+                      ['stack info'], phase='instances')
+            continue
+
+        # The autoscale group can be created as soon as its load balancers
+        # exist but instances aren't started until the load balancers'
+        # health checks are in place
+        tier_elbs = [x for x in spec['short_load_balancers'] if x in elb_created]
+        graph.add('launch configuration %s' % tier,
+                  lambda spec=spec: create_launch_configuration(region, spec, user_data(spec)),
+                  ['stack info'], phase='launch configurations')
+        graph.add('autoscale group %s' % tier,
+                  lambda spec=spec, tier=tier: create_autoscale_group(region, spec, graph.result('launch configuration %s' % tier),
+                                                                      availability_zones, stack_type, name),
+                  ['launch configuration %s' % tier] + [elb_created[x] for x in tier_elbs],
+                  phase='autoscale groups')
+        graph.add('capacity %s' % tier,
+                  lambda spec=spec: set_desired_capacity(region, spec, mini_stack),
+                  ['autoscale group %s' % tier] + sum([elb_configured[x] for x in tier_elbs], []),
+                  phase='desired capacity')
+
+    try:
+        graph.run()
+    finally:
+        logging.info('%s : stack %s:%s timings\n%s' % (time.strftime('%c'), region, name, graph.timing_report()))
+
+    stack = {}
+    stack['loadbalancer'] = [graph.result(x) for x in graph.order if x.startswith('elb ')]
+    stack['launch_configuration'] = [graph.result(x) for x in graph.order if x.startswith('launch configuration ')]
+    stack['autoscale_group'] = [graph.result(x) for x in graph.order if x.startswith('autoscale group ')]
 
     # stack_filename = "/home/gene/Documents/identity-stack-%s.pkl" % name
     # pickle.dump(stack, open(stack_filename, 'wb'))
@@ -474,7 +540,8 @@ End-of-message
 def destroy_stack(region,
                   environment,
                   stack_type,
-                  name):
+                  name,
+                  inventory=None):
     # Find associated ELBs
     # Find ELB associated Autoscale groups
     # find EIPs associated with proxy instances and delete them
@@ -488,91 +555,59 @@ def destroy_stack(region,
     import boto.ec2.elb
     import boto.ec2.autoscale
     import boto.ec2.cloudwatch
-    conn_autoscale = boto.ec2.autoscale.connect_to_region(region)
-    conn_elb = boto.ec2.elb.connect_to_region(region)
     conn_ec2 = boto.ec2.connect_to_region(region)
     conn_cw = boto.ec2.cloudwatch.connect_to_region(region)
 
-    existing_autoscale_groups = conn_autoscale.get_all_groups()
-    existing_launch_configurations = conn_autoscale.get_all_launch_configurations()
-    existing_load_balancers = conn_elb.get_all_load_balancers()
-    existing_addresses = conn_ec2.get_all_addresses()
+    if inventory is None:
+        inventory = Inventory(region, ['autoscale_groups', 'launch_configurations', 'load_balancers', 'addresses'])
 
     autoscale_groups = []
     launch_configurations = []
     load_balancers = []
     alarms = []
-    for autoscale_params in json.load(open('config/autoscale.%s.json' % stack_type, 'r')):
+    config = stack_config.get()
+    for autoscale_params in config.autoscale(stack_type):
         ag_name = '%s-%s-%s-%s' % (environment, stack_type, autoscale_params['launch_configuration']['tier'], name)
-        ag = [x for x in existing_autoscale_groups if x.name == ag_name]
-        autoscale_groups.extend(ag)
-        launch_configurations.extend([x for x in existing_launch_configurations if x.name == ag_name])
+        autoscale_groups.extend(inventory.find('autoscale_groups', 'name', ag_name))
+        launch_configurations.extend(inventory.find('launch_configurations', 'name', ag_name))
+    # apply_stack gives a group a new launch configuration when it changes
+    for autoscale_group in autoscale_groups:
+        if autoscale_group.launch_config_name not in [x.name for x in launch_configurations]:
+            launch_configurations.extend(inventory.find('launch_configurations', 'name', autoscale_group.launch_config_name))
 
     metric = "HTTPCode_Backend_5XX"
 
-    for load_balancers_params in json.load(open('config/elbs_public.%s.json' % stack_type, 'r')) + json.load(open('config/elbs_private.json')):
-        load_balancers_params['name'] = '%s-%s' % (load_balancers_params['name'], name)
-        load_balancers.extend([x for x in existing_load_balancers if x.name == load_balancers_params['name']])
-        alarms.extend(["%s %s" % (load_balancers_params['name'], metric)])
+    for load_balancers_params in config.load_balancers(stack_type):
+        load_balancer_name = '%s-%s' % (load_balancers_params['name'], name)
+        load_balancers.extend(inventory.find('load_balancers', 'name', load_balancer_name))
+        alarms.extend(["%s %s" % (load_balancer_name, metric)])
 
     # Delete alarms
     conn_cw.delete_alarms(alarms)
     
     # Disassociate EIPs and release them
     for autoscale_group in autoscale_groups:
-        for address in [x for x in existing_addresses if x.instance_id in [y.instance_id for y in autoscale_group.instances]]:
+        for address in sum([inventory.find('addresses', 'instance', x.instance_id) for x in autoscale_group.instances], []):
             if not conn_ec2.disassociate_address(association_id=address.association_id):
                 logging.error('failed to disassociate eip %s from instance %s' % (address.public_ip, address.instance_id))
             if not conn_ec2.release_address(allocation_id=address.allocation_id):
                 logging.error('failed to release eip %s' % address.public_ip)
 
-    # Shutdown all instances in the stack
-    for autoscale_group in autoscale_groups:
-        autoscale_group.shutdown_instances()
-
-    # Wait for all instances to terminate and deleting autoscale groups
-    existing_autoscale_groups = conn_autoscale.get_all_groups()
-    for autoscale_group in autoscale_groups:
-        attempts = 0
-        while True:
-            attempts += 1
-            remaining_live_instances = len([x.instances for x in existing_autoscale_groups if x.name == autoscale_group.name][0])
-            if remaining_live_instances == 0:
-                time.sleep(5)
-                autoscale_group.delete()
-                break
-            else:
-                logging.debug('waiting 10 seconds for remaining %s instances in the %s autoscale group to finish shutting down' % (remaining_live_instances, autoscale_group.name))
-                time.sleep(10)
-                existing_autoscale_groups = conn_autoscale.get_all_groups([x.name for x in autoscale_groups])
-                if attempts > 30:
-                    logging.error('unable to delete autoscale group %s after 5 minutes' % autoscale_group.name)
-                    autoscale_group.get_activities()
-                    autoscale_group.delete()
-                    break
-
-    # Delete launch configurations
-    for launch_configuration in launch_configurations:
-        launch_configuration.delete()
-
-    # Delete load balancers
-    for load_balancer in load_balancers:
-        load_balancer.delete()
+    # Shutdown all instances in the stack, delete each autoscale group once
+    # its instances are gone and each launch configuration and load balancer
+    # once the groups using it are gone
+    teardown.teardown(region, autoscale_groups, launch_configurations, load_balancers)
+    inventory.forget('autoscale_groups', [x.name for x in autoscale_groups])
+    inventory.forget('launch_configurations', [x.name for x in launch_configurations])
+    inventory.forget('load_balancers', [x.name for x in load_balancers])
     logging.debug('%s : stack %s:%s destroyed' % (time.strftime('%c'), region, name))
 
-def get_stack(region, environment, stack_type, name):
+def get_stack(region, environment, stack_type, name, inventory=None):
     import pprint
-    import boto.ec2
-    import boto.ec2.elb
     import json
-    # import boto.ec2.autoscale
-    # conn_autoscale = boto.ec2.autoscale.connect_to_region(region)
-    conn_elb = boto.ec2.elb.connect_to_region(region)
     #conn_ec2 = boto.ec2.connect_to_region(region)
-    # existing_autoscale_groups = conn_autoscale.get_all_groups()
-    # existing_launch_configurations = conn_autoscale.get_all_launch_configurations()
-    existing_load_balancers = conn_elb.get_all_load_balancers()
-    # existing_addresses = conn_ec2.get_all_addresses()
+    if inventory is None:
+        inventory = Inventory(region, ['load_balancers'])
 
     output = {}
     #output['instances'] = {}
@@ -589,7 +624,7 @@ def get_stack(region, environment, stack_type, name):
     #            if instance.ip_address:
     #               output['bastion_ip'] = instance.ip_address
     #output['instance_ip_list'] = " ".join([output['instances'][x]['private_ip_address'] for x in output['instances'].keys()])
-    for load_balancer in [x for x in existing_load_balancers if x.name[-len(name) - 1:] == "-%s" % name]:
+    for load_balancer in [x for x in inventory.all('load_balancers') if x.name[-len(name) - 1:] == "-%s" % name]:
         #lb_instances = [{'id': x.id,
         #                 'Name' : output['instances'][x.id]['Name'],
         #                 'private_ip_address' : output['instances'][x.id]['private_ip_address']} for x in load_balancer.instances]
@@ -598,7 +633,9 @@ def get_stack(region, environment, stack_type, name):
     return output
 
 def show_stack(region, environment, stack_type, name):
-    output = get_stack(region, environment, stack_type, name)
+    print_stack(region, stack_type, name, get_stack(region, environment, stack_type, name))
+
+def print_stack(region, stack_type, name, output):
     print "# Stack %s : %s : %s" % (name, region, stack_type)
     print "```"
     for x in output.keys():
@@ -689,44 +726,40 @@ def point_dns_to_stack(region, stack_type, application, name):
     rest_iface.execute('/Session/', 'DELETE')
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    import regions
     path = "/identity/"
 
-    # region = 'us-west-1'
-    # availability_zones = ['b','c']
-
-    region = 'us-west-2'
-    availability_zones = ['a', 'b', 'c']
-
-    #region = 'us-east-1'
-    #availability_zones = ['a','b','d']
+    # Availability zones for each region are in regions.AVAILABILITY_ZONES
+    stack_regions = ['us-west-2']
+    #stack_regions = ['us-west-2', 'us-east-1']
    
     environment = 'identity-dev'
     #environment = 'identity-prod'
 
-#     stack = create_stack(region=region,
-#                            environment=environment, 
-#                            stack_type='stage', 
-#                            application='bridge-yahoo', 
-#                            availability_zones=availability_zones, 
-#                            path=path,
-#                            replace=False, 
-#                            name='1234',
-#                            key_name=None,
-#                            mini_stack=False,
-#                            generic=False,
-#                            hydrate=True)
-
-#     destroy_stack(region=region,
-#                   environment=environment,
-#                   stack_type='stage',
-#                   name='1234')
-
-#     show_stack(region,
-#                environment,
-#                'prod',
-#                '1234')
-
-#     point_dns_to_stack(region=region, 
+#     results = regions.create_stacks(stack_regions,
+#                                     environment=environment, 
+#                                     stack_type='stage', 
+#                                     application='bridge-yahoo', 
+#                                     path=path,
+#                                     replace=False, 
+#                                     name='1234',
+#                                     key_name=None,
+#                                     mini_stack=False,
+#                                     generic=False,
+#                                     hydrate=True)
+
+#     results = regions.destroy_stacks(stack_regions,
+#                                      environment=environment,
+#                                      stack_type='stage',
+#                                      name='1234')
+
+#     results = regions.show_stacks(stack_regions,
+#                                   environment,
+#                                   'prod',
+#                                   '1234')
+
+#     point_dns_to_stack(region='us-west-2', 
 #                        stack_type='stage', 
 #                        application='bridge-yahoo',
 #                        name='1014')
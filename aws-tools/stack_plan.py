@@ -0,0 +1,317 @@
+"""Converge an existing stack on its config instead of rebuilding it.
+
+plan_stack compares what the config files say a stack should look like
+with the live load balancers, launch configurations and autoscale groups
+and works out the smallest set of changes that would bring them in line,
+with an estimate of the API calls each one needs. apply_stack makes only
+those changes.
+
+    plan = plan_stack('us-west-2', 'identity-dev', 'stage', 'persona',
+                      ['a', 'b', 'c'], '/identity/', '1234')
+    print_plan(plan)
+    apply_stack(plan)
+
+Anything that doesn't exist yet is created the same way create_stack would
+create it.
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+import ciphersuite
+import connections
+import stack_control
+import task_graph
+from inventory import Inventory
+
+class Change:
+    def __init__(self, kind, name, action, details, api_calls, apply=None):
+        self.kind = kind
+        self.name = name
+        self.action = action
+        self.details = details
+        self.api_calls = api_calls
+        self.apply = apply
+
+class Plan:
+    def __init__(self, region, environment, stack_type, name, changes, notes):
+        self.region = region
+        self.environment = environment
+        self.stack_type = stack_type
+        self.name = name
+        self.changes = changes
+        self.notes = notes
+
+    def api_calls(self):
+        return sum(x.api_calls for x in self.changes)
+
+def listener_key(listener):
+    """Normalise a listener from the config or from boto for comparison."""
+    if isinstance(listener, (list, tuple)):
+        return (int(listener[0]), int(listener[1]), listener[2].upper(),
+                listener[3] if len(listener) > 3 else None)
+    return (int(listener.load_balancer_port), int(listener.instance_port),
+            listener.protocol.upper(), listener.ssl_certificate_id or None)
+
+def build_load_balancer(region, spec, replace=False):
+    """Return a function that creates a load balancer the way create_stack
+    does, with its tags, health check, ciphersuite and, in prod, its alarm,
+    and the number of API calls it makes."""
+    https_ports = [x[0] for x in spec['listeners'] if x[2] == 'HTTPS']
+    alarm = spec['environment'] == 'prod'
+    def apply():
+        stack_control.create_load_balancer(region, spec, replace=replace)
+        stack_control.configure_health_check(region, spec)
+        if https_ports:
+            stack_control.set_ciphersuite(region, spec)
+        if alarm:
+            stack_control.create_alarm(region, spec)
+    # Delete if replacing, create, tags and health check, then one call to
+    # create the policy and one per HTTPS port, then the alarm
+    api_calls = (4 if replace else 3) + (1 + len(https_ports) if https_ports else 0) + (1 if alarm else 0)
+    return apply, api_calls
+
+def plan_load_balancer(region, spec, load_balancer):
+    """Return the Change that converges one load balancer, or None."""
+    if load_balancer is None:
+        apply, api_calls = build_load_balancer(region, spec)
+        return Change('load balancer', spec['name'], 'create',
+                      ['%s listeners, scheme %s' % (len(spec['listeners']), spec['scheme'])],
+                      api_calls, apply)
+
+    if load_balancer.scheme != spec['scheme']:
+        apply, api_calls = build_load_balancer(region, spec, replace=True)
+        return Change('load balancer', spec['name'], 'replace',
+                      ['scheme %s -> %s can only be changed by recreating the load balancer' % (load_balancer.scheme, spec['scheme'])],
+                      api_calls, apply)
+
+    details = []
+    steps = []
+
+    live_listeners = dict((listener_key(x)[0], x) for x in load_balancer.listeners)
+    live_keys = set(listener_key(x) for x in load_balancer.listeners)
+    desired_keys = set(listener_key(x) for x in spec['listeners'])
+    removed = sorted(set(x[0] for x in live_keys - desired_keys))
+    added = sorted(desired_keys - live_keys)
+    if removed:
+        details.append('remove listeners on ports %s' % removed)
+        steps.append(lambda conn_elb: conn_elb.delete_load_balancer_listeners(spec['name'], removed))
+    if added:
+        details.append('add listeners %s' % [x[:3] for x in added])
+        steps.append(lambda conn_elb: conn_elb.create_load_balancer_listeners(
+            spec['name'], [x if x[3] else x[:3] for x in added]))
+
+    health_check = load_balancer.health_check
+    differences = ['%s %s -> %s' % (x, getattr(health_check, x, None), spec['healthcheck'][x])
+                   for x in sorted(spec['healthcheck'].keys())
+                   if str(getattr(health_check, x, None)) != str(spec['healthcheck'][x])]
+    if differences:
+        details.append('health check %s' % ', '.join(differences))
+        steps.append(lambda conn_elb: stack_control.configure_health_check(region, spec))
+
+    # HTTPS listeners that are being added or don't carry the policy
+    https_ports = [x[0] for x in desired_keys if x[2] == 'HTTPS' and
+                   (x in added or ciphersuite.POLICY_NAME not in (live_listeners[x[0]].policy_names or []))]
+    if https_ports:
+        create_policy = not ciphersuite.has_policy(load_balancer)
+        details.append('ciphersuite policy on ports %s' % sorted(https_ports))
+        steps.append(lambda conn_elb: stack_control.set_ciphersuite(region, spec, sorted(https_ports), create_policy))
+
+    if set(load_balancer.security_groups) != set(spec['security_groups']):
+        details.append('security groups %s -> %s' % (sorted(load_balancer.security_groups), sorted(spec['security_groups'])))
+        steps.append(lambda conn_elb: conn_elb.apply_security_groups_to_lb(spec['name'], spec['security_groups']))
+
+    attach = sorted(set(spec['subnets']) - set(load_balancer.subnets))
+    detach = sorted(set(load_balancer.subnets) - set(spec['subnets']))
+    if attach:
+        details.append('attach subnets %s' % attach)
+        steps.append(lambda conn_elb: conn_elb.attach_lb_to_subnets(spec['name'], attach))
+    if detach:
+        details.append('detach subnets %s' % detach)
+        steps.append(lambda conn_elb: conn_elb.detach_lb_from_subnets(spec['name'], detach))
+
+    if not details:
+        return None
+    # One call per step, except that the ciphersuite step makes one call
+    # per port plus one to create the policy if the ELB doesn't have it
+    api_calls = len(steps)
+    if https_ports:
+        api_calls += len(https_ports) - (0 if create_policy else 1)
+    def apply():
+        conn_elb = connections.connect('boto.ec2.elb', region)
+        for step in steps:
+            step(conn_elb)
+    return Change('load balancer', spec['name'], 'update', details, api_calls, apply)
+
+def launch_configuration_name(spec, user_data):
+    """Name a new launch configuration after its contents so re-running an
+    apply doesn't create another one."""
+    content = json.dumps([spec['launch_configuration'], user_data], sort_keys=True)
+    return '%s-%s' % (spec['name'], hashlib.sha1(content).hexdigest()[:8])
+
+def get_or_create_launch_configuration(region, spec, user_data):
+    """Return the launch configuration named by launch_configuration_name,
+    creating it unless an earlier apply already did."""
+    name = launch_configuration_name(spec, user_data)
+    conn_autoscale = connections.connect('boto.ec2.autoscale', region)
+    existing = conn_autoscale.get_all_launch_configurations(names=[name])
+    if existing:
+        logging.debug('using launch configuration %s from an earlier apply' % name)
+        return existing[0]
+    return stack_control.create_launch_configuration(region, spec, user_data, name)
+
+def plan_autoscale_group(region, spec, autoscale_group, launch_configuration, user_data, get_user_data,
+                         availability_zones, stack_type, name, mini_stack):
+    """Return the Change that converges one autoscale group and its launch
+    configuration, or None. get_user_data is called at apply time since
+    the stack's load balancers may have changed by then."""
+    if autoscale_group is None:
+        def apply():
+            launch_configuration = get_or_create_launch_configuration(region, spec, get_user_data())
+            stack_control.create_autoscale_group(region, spec, launch_configuration,
+                                                 availability_zones, stack_type, name)
+            stack_control.set_desired_capacity(region, spec, mini_stack)
+        return Change('autoscale group', spec['name'], 'create',
+                      ['image %s, %s x %s' % (spec['launch_configuration']['image_id'],
+                                             1 if mini_stack else spec['desired_capacity'],
+                                             spec['launch_configuration']['instance_type'])],
+                      6, apply)
+
+    details = []
+    desired = spec['launch_configuration']
+    if launch_configuration is None:
+        details.append('launch configuration %s is missing' % autoscale_group.launch_config_name)
+    else:
+        live = {'image_id': launch_configuration.image_id,
+                'instance_type': launch_configuration.instance_type,
+                'key_name': launch_configuration.key_name,
+                'instance_profile_name': launch_configuration.instance_profile_name,
+                'security_groups': sorted(launch_configuration.security_groups)}
+        for key in sorted(live.keys()):
+            wanted = sorted(desired[key]) if key == 'security_groups' else desired[key]
+            if live[key] != wanted:
+                details.append('%s %s -> %s' % (key, live[key], wanted))
+        if (launch_configuration.user_data or None) != user_data:
+            details.append('user data')
+    replace_launch_configuration = bool(details)
+
+    update_subnets = set(autoscale_group.vpc_zone_identifier.split(',')) != set(spec['subnets'])
+    if update_subnets:
+        details.append('subnets %s -> %s' % (autoscale_group.vpc_zone_identifier, ','.join(spec['subnets'])))
+
+    capacity = 1 if mini_stack else spec['desired_capacity']
+    update_capacity = autoscale_group.desired_capacity != capacity
+    if update_capacity:
+        details.append('desired capacity %s -> %s' % (autoscale_group.desired_capacity, capacity))
+
+    if set(autoscale_group.load_balancers) != set(spec['load_balancers']):
+        logging.warning('load balancers of %s can only be changed by recreating the group : %s -> %s'
+                        % (spec['name'], sorted(autoscale_group.load_balancers), sorted(spec['load_balancers'])))
+
+    if not details:
+        return None
+
+    old_launch_configuration_name = autoscale_group.launch_config_name
+    def apply():
+        conn_autoscale = connections.connect('boto.ec2.autoscale', region)
+        autoscale_group.connection = conn_autoscale
+        if replace_launch_configuration:
+            new_launch_configuration = get_or_create_launch_configuration(region, spec, get_user_data())
+            autoscale_group.launch_config_name = new_launch_configuration.name
+        if replace_launch_configuration or update_subnets:
+            autoscale_group.vpc_zone_identifier = ','.join(spec['subnets'])
+            autoscale_group.update()
+        if replace_launch_configuration and old_launch_configuration_name != autoscale_group.launch_config_name:
+            # Instances already running keep the old configuration until
+            # they're replaced
+            conn_autoscale.delete_launch_configuration(old_launch_configuration_name)
+        if update_capacity:
+            stack_control.set_desired_capacity(region, spec, mini_stack)
+    api_calls = (4 if replace_launch_configuration else 1 if update_subnets else 0) + (1 if update_capacity else 0)
+    return Change('autoscale group', spec['name'], 'update', details, api_calls, apply)
+
+def plan_stack(region,
+               environment,
+               stack_type,
+               application,
+               availability_zones,
+               path,
+               name,
+               key_name=None,
+               mini_stack=False,
+               generic=False,
+               hydrate=True,
+               inventory=None):
+    """Return a Plan of the changes that would converge a stack on its
+    config."""
+    if not key_name:
+        key_name = '20130416-svcops-base-key'
+    if inventory is None:
+        inventory = Inventory(region, ['vpcs', 'subnets', 'security_groups', 'load_balancers',
+                                       'autoscale_groups', 'launch_configurations'])
+    vpc, load_balancer_specs, autoscale_specs = stack_control.get_stack_specs(
+        region, environment, stack_type, application, path, name, key_name, inventory)
+
+    changes = []
+    notes = []
+    for spec in load_balancer_specs:
+        change = plan_load_balancer(region, spec, inventory.get('load_balancers', 'name', spec['name']))
+        if change:
+            changes.append(change)
+
+    def get_user_data(spec):
+        inventory.refresh('load_balancers', [x['name'] for x in load_balancer_specs])
+        return stack_control.get_user_data(stack_type, spec['tier'],
+                                           stack_control.get_stack_info(vpc, environment, stack_type, name, inventory),
+                                           region, generic, hydrate)
+
+    stack_info = stack_control.get_stack_info(vpc, environment, stack_type, name, inventory)
+    for spec in autoscale_specs:
+        if spec['manual']:
+            notes.append('%s is scaled manually and is not planned' % spec['name'])
+            continue
+        autoscale_group = inventory.get('autoscale_groups', 'name', spec['name'])
+        launch_configuration = None
+        if autoscale_group is not None:
+            launch_configuration = inventory.get('launch_configurations', 'name', autoscale_group.launch_config_name)
+        user_data = stack_control.get_user_data(stack_type, spec['tier'], stack_info, region, generic, hydrate)
+        change = plan_autoscale_group(region, spec, autoscale_group, launch_configuration, user_data,
+                                      lambda spec=spec: get_user_data(spec),
+                                      availability_zones, stack_type, name, mini_stack)
+        if change:
+            changes.append(change)
+
+    return Plan(region, environment, stack_type, name, changes, notes)
+
+def print_plan(plan):
+    print "# Plan for stack %s : %s : %s" % (plan.name, plan.region, plan.stack_type)
+    if not plan.changes:
+        print "no changes"
+    for change in plan.changes:
+        print "%-8s %-16s %s (%s API calls)" % (change.action, change.kind, change.name, change.api_calls)
+        for detail in change.details:
+            print "             %s" % detail
+    for note in plan.notes:
+        print "note : %s" % note
+    print "%s changes, about %s API calls" % (len(plan.changes), plan.api_calls())
+
+def apply_stack(plan, max_workers=8):
+    """Make the changes in a plan. Load balancers are converged first and
+    concurrently, then autoscale groups, also concurrently, since new
+    launch configurations describe the load balancers in their user data."""
+    graph = task_graph.TaskGraph(max_workers)
+    load_balancer_changes = []
+    for change in plan.changes:
+        if change.kind == 'load balancer':
+            load_balancer_changes.append(graph.add('%s %s' % (change.action, change.name), change.apply,
+                                                   phase='load balancers'))
+    for change in plan.changes:
+        if change.kind == 'autoscale group':
+            graph.add('%s %s' % (change.action, change.name), change.apply, load_balancer_changes,
+                      phase='autoscale groups')
+    try:
+        graph.run()
+    finally:
+        logging.info('%s : stack %s:%s apply timings\n%s' % (time.strftime('%c'), plan.region, plan.name, graph.timing_report()))
@@ -0,0 +1,97 @@
+"""Collect tags during an operation and apply them in as few calls as
+possible.
+
+CreateTags applies every tag in a call to every resource in it, so tags are
+grouped by key and value and each group is sent as one multi-resource call,
+with groups that cover exactly the same resources merged into one call. A
+run that tags thirty resources with the same App and Env but their own Name
+makes thirty-one calls instead of ninety.
+
+    tags = TagAccumulator(region)
+    tags.add(vpc.id, {'Name': environment, 'App': 'identity', 'Env': 'dev'})
+    tags.add(subnet.id, {'Name': subnet_name, 'App': 'identity', 'Env': 'dev'})
+    tags.flush()
+
+Resources that were only just created sometimes aren't visible to
+CreateTags yet, so calls that fail with a NotFound error are retried.
+Load balancers are tagged through the ELB AddTags call instead, twenty
+load balancers per call.
+"""
+
+import logging
+import threading
+
+import connections
+import waiters
+
+class TagAccumulator:
+    def __init__(self, region, attempts=6):
+        self.region = region
+        self.attempts = attempts
+        self.lock = threading.Lock()
+        self.tags = {}
+        self.load_balancer_tags = {}
+
+    def add(self, resource_id, tags):
+        """Queue tags (a dict) for an EC2 resource id."""
+        with self.lock:
+            self.tags.setdefault(resource_id, {}).update(tags)
+
+    def add_load_balancer(self, name, tags):
+        """Queue tags (a dict) for a load balancer name."""
+        with self.lock:
+            self.load_balancer_tags.setdefault(name, {}).update(tags)
+
+    def _calls(self, tags):
+        """Group queued tags into (resource ids, tags) calls."""
+        resources_by_tag = {}
+        for resource_id, resource_tags in tags.items():
+            for key, value in resource_tags.items():
+                resources_by_tag.setdefault((key, value), set()).add(resource_id)
+        tags_by_resources = {}
+        for (key, value), resource_ids in resources_by_tag.items():
+            tags_by_resources.setdefault(frozenset(resource_ids), {})[key] = value
+        return [(sorted(x), tags_by_resources[x]) for x in
+                sorted(tags_by_resources, key=lambda x: sorted(x))]
+
+    def _retry(self, call, description):
+        import boto.exception
+        backoff = waiters.Backoff(1, 10)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                return call()
+            except boto.exception.BotoServerError as error:
+                if not (error.error_code or '').endswith('NotFound') or attempts >= self.attempts:
+                    raise
+                logging.debug('%s not visible yet, retrying : %s' % (description, error.error_code))
+                backoff.sleep()
+
+    def flush(self):
+        """Apply everything queued so far. Returns the number of calls made."""
+        with self.lock:
+            tags, self.tags = self.tags, {}
+            load_balancer_tags, self.load_balancer_tags = self.load_balancer_tags, {}
+        calls = 0
+        if tags:
+            conn_ec2 = connections.connect('boto.ec2', self.region)
+            for resource_ids, call_tags in self._calls(tags):
+                self._retry(lambda: conn_ec2.create_tags(resource_ids, call_tags),
+                            'resources %s' % resource_ids)
+                logging.debug('tagged %s with %s' % (', '.join(resource_ids), call_tags))
+                calls += 1
+        if load_balancer_tags:
+            conn_elb = connections.connect('boto.ec2.elb', self.region)
+            for names, call_tags in self._calls(load_balancer_tags):
+                for i in range(0, len(names), 20):
+                    params = {}
+                    conn_elb.build_list_params(params, names[i:i + 20], 'LoadBalancerNames.member.%d')
+                    for j, key in enumerate(sorted(call_tags.keys())):
+                        params['Tags.member.%d.Key' % (j + 1)] = key
+                        params['Tags.member.%d.Value' % (j + 1)] = call_tags[key]
+                    self._retry(lambda: conn_elb.get_status('AddTags', params),
+                                'load balancers %s' % names[i:i + 20])
+                    logging.debug('tagged %s with %s' % (', '.join(names[i:i + 20]), call_tags))
+                    calls += 1
+        return calls
@@ -0,0 +1,197 @@
+"""Run a graph of dependent tasks on a bounded pool of threads.
+
+Tasks are added with the names of the tasks they depend on. Once a task's
+dependencies have all finished it's handed to the next free worker, so
+independent resources are created at the same time while anything that
+needs another resource waits only for that resource.
+
+If a task raises, everything that depends on it is skipped, the rest of the
+graph runs to completion and TaskGraphError is raised at the end.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+import time
+
+class TaskGraphError(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, 'tasks failed : %s' % ', '.join(
+            '%s (%s)' % (name, error) for name, error in failures))
+
+class Task:
+    def __init__(self, name, func, dependencies, phase):
+        self.name = name
+        self.func = func
+        self.dependencies = list(dependencies)
+        self.phase = phase
+        self.result = None
+        self.error = None
+        self.skipped = False
+        self.started = None
+        self.finished = None
+
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return 0
+        return self.finished - self.started
+
+class TaskGraph:
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.order = []
+        self.started = None
+        self.finished = None
+
+    def add(self, name, func, dependencies=(), phase=None):
+        """Add a task. func is called with no arguments once every task
+        named in dependencies has finished successfully. Returns name so
+        callers can collect task names as they add them."""
+        if name in self.tasks:
+            raise ValueError("task '%s' was added twice" % name)
+        self.tasks[name] = Task(name, func, dependencies, phase or name)
+        self.order.append(name)
+        return name
+
+    def result(self, name):
+        return self.tasks[name].result
+
+    def _check(self):
+        for task in self.tasks.values():
+            for dependency in task.dependencies:
+                if dependency not in self.tasks:
+                    raise ValueError("task '%s' depends on unknown task '%s'" % (task.name, dependency))
+        visiting = set()
+        visited = set()
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError("dependency cycle through task '%s'" % name)
+            visiting.add(name)
+            for dependency in self.tasks[name].dependencies:
+                visit(dependency)
+            visiting.discard(name)
+            visited.add(name)
+        for name in self.order:
+            visit(name)
+
+    def _worker(self, work, done):
+        while True:
+            name = work.get()
+            if name is None:
+                return
+            task = self.tasks[name]
+            task.started = time.time()
+            try:
+                task.result = task.func()
+            except Exception:
+                task.error = sys.exc_info()[1]
+                logging.exception('task %s failed' % name)
+            task.finished = time.time()
+            done.put(name)
+
+    def _skip(self, name, dependents):
+        for dependent in dependents[name]:
+            if not self.tasks[dependent].skipped:
+                self.tasks[dependent].skipped = True
+                logging.error('skipping task %s because task %s failed' % (dependent, name))
+                self._skip(dependent, dependents)
+
+    def run(self):
+        """Run every task and return a dict of task name to result."""
+        self._check()
+        waiting_on = dict((name, set(self.tasks[name].dependencies)) for name in self.order)
+        dependents = dict((name, []) for name in self.order)
+        for name in self.order:
+            for dependency in self.tasks[name].dependencies:
+                dependents[dependency].append(name)
+
+        work = Queue.Queue()
+        done = Queue.Queue()
+        workers = [threading.Thread(target=self._worker, args=(work, done))
+                   for x in range(max(1, min(self.max_workers, len(self.order))))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        self.started = time.time()
+        running = 0
+        for name in self.order:
+            if not waiting_on[name]:
+                work.put(name)
+                running += 1
+        while running:
+            name = done.get()
+            running -= 1
+            if self.tasks[name].error is not None:
+                self._skip(name, dependents)
+                continue
+            for dependent in dependents[name]:
+                waiting_on[dependent].discard(name)
+                if not waiting_on[dependent] and not self.tasks[dependent].skipped:
+                    work.put(dependent)
+                    running += 1
+        self.finished = time.time()
+
+        for worker in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+
+        failures = [(name, self.tasks[name].error) for name in self.order
+                    if self.tasks[name].error is not None]
+        if failures:
+            raise TaskGraphError(failures)
+        return dict((name, self.tasks[name].result) for name in self.order)
+
+    def critical_path(self):
+        """Return the chain of tasks that determined the total run time,
+        following each task back through the dependency that finished
+        last."""
+        finished = [self.tasks[x] for x in self.order if self.tasks[x].finished is not None]
+        if not finished:
+            return []
+        task = max(finished, key=lambda x: x.finished)
+        path = [task]
+        while task.dependencies:
+            task = max([self.tasks[x] for x in task.dependencies], key=lambda x: x.finished)
+            path.append(task)
+        path.reverse()
+        return path
+
+    def timing_report(self):
+        """Return a per-phase breakdown of the last run as a string."""
+        phases = []
+        by_phase = {}
+        for name in self.order:
+            task = self.tasks[name]
+            if task.started is None:
+                continue
+            if task.phase not in by_phase:
+                by_phase[task.phase] = []
+                phases.append(task.phase)
+            by_phase[task.phase].append(task)
+        lines = ['%-28s %5s %9s %9s %9s' % ('phase', 'tasks', 'start', 'wall', 'busy')]
+        for phase in phases:
+            tasks = by_phase[phase]
+            first = min(x.started for x in tasks)
+            last = max(x.finished for x in tasks)
+            lines.append('%-28s %5d %8.1fs %8.1fs %8.1fs' % (
+                phase, len(tasks), first - self.started, last - first,
+                sum(x.duration() for x in tasks)))
+        if self.started is not None and self.finished is not None:
+            lines.append('%-28s %5d %9s %8.1fs' % (
+                'total', sum(len(x) for x in by_phase.values()), '',
+                self.finished - self.started))
+        path = self.critical_path()
+        if path:
+            lines.append('critical path : %s' % ' -> '.join(
+                '%s (%.1fs)' % (x.name, x.duration()) for x in path))
+        skipped = [x for x in self.order if self.tasks[x].skipped]
+        if skipped:
+            lines.append('skipped : %s' % ', '.join(skipped))
+        return '\n'.join(lines)
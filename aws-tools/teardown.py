@@ -0,0 +1,190 @@
+"""Tear down autoscale groups and the launch configurations and load
+balancers that depend on them.
+
+Every group is shut down at once and then all of them are watched with a
+single batched describe per tick, backing off while nothing changes. A
+group is deleted as soon as its last instance is gone, its launch
+configuration as soon as the group is gone and a load balancer as soon as
+every group attached to it is gone.
+
+Groups that still have instances after timeout seconds are force deleted.
+If anything is still left after deadline seconds in all, polling stops and
+TeardownError lists what remains.
+"""
+
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import connections
+import waiters
+
+class TeardownError(Exception):
+    def __init__(self, remaining):
+        self.remaining = remaining
+        Exception.__init__(self, 'unable to tear down %s' % ', '.join(remaining))
+
+class Teardown:
+    def __init__(self,
+                 region,
+                 autoscale_groups,
+                 launch_configurations,
+                 load_balancers,
+                 max_workers=8,
+                 interval=5,
+                 timeout=300,
+                 deadline=900):
+        self.region = region
+        self.autoscale_groups = autoscale_groups
+        self.launch_configurations = launch_configurations
+        self.load_balancers = load_balancers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.timeout = timeout
+        self.deadline = deadline
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def _finished(self, kind, name):
+        with self.lock:
+            self.latencies['%s %s' % (kind, name)] = time.time() - self.started
+        logging.debug('%s %s deleted after %.1fs' % (kind, name, time.time() - self.started))
+
+    def _shutdown(self, autoscale_group):
+        autoscale_group.connection = connections.connect('boto.ec2.autoscale', self.region)
+        autoscale_group.shutdown_instances()
+
+    def _delete_group(self, name, force_delete):
+        import boto.exception
+        conn_autoscale = connections.connect('boto.ec2.autoscale', self.region)
+        try:
+            conn_autoscale.delete_auto_scaling_group(name, force_delete=force_delete)
+        except boto.exception.BotoServerError as error:
+            logging.debug('unable to delete autoscale group %s yet : %s' % (name, error.message))
+            return False
+        return True
+
+    def _delete_launch_configuration(self, name):
+        conn_autoscale = connections.connect('boto.ec2.autoscale', self.region)
+        conn_autoscale.delete_launch_configuration(name)
+        self._finished('launch configuration', name)
+
+    def _delete_load_balancer(self, name):
+        conn_elb = connections.connect('boto.ec2.elb', self.region)
+        conn_elb.delete_load_balancer(name)
+        self._finished('load balancer', name)
+
+    def _describe(self, names):
+        """Return the named groups that still exist, fetched in as few
+        DescribeAutoScalingGroups calls as the API allows."""
+        conn_autoscale = connections.connect('boto.ec2.autoscale', self.region)
+        names = sorted(names)
+        groups = {}
+        for i in range(0, len(names), 50):
+            next_token = None
+            while True:
+                result = conn_autoscale.get_all_groups(names=names[i:i + 50], next_token=next_token)
+                groups.update((x.name, x) for x in result)
+                next_token = result.next_token
+                if not next_token:
+                    break
+        return groups
+
+    def run(self):
+        """Tear everything down and return a dict of resource to the number
+        of seconds it took to delete."""
+        self.started = time.time()
+        deadline = self.started + self.timeout
+        overall_deadline = self.started + self.deadline
+        remaining = []
+        pool = ThreadPool(self.max_workers)
+        try:
+            pool.map(self._shutdown, self.autoscale_groups)
+
+            backoff = waiters.Backoff(self.interval)
+            pending = set(x.name for x in self.autoscale_groups)
+            deleting = {}
+            released = set()
+            cleanups = []
+            while True:
+                progress = False
+                groups = self._describe(pending) if pending else {}
+                for name in sorted(pending):
+                    if name not in groups:
+                        pending.discard(name)
+                        deleting.pop(name, None)
+                        self._finished('autoscale group', name)
+                        progress = True
+                        continue
+                    if name in deleting:
+                        if deleting[name].ready() and not deleting[name].get():
+                            # The delete was refused, try again this tick
+                            del deleting[name]
+                        else:
+                            continue
+                    remaining_live_instances = len(groups[name].instances)
+                    if remaining_live_instances == 0:
+                        deleting[name] = pool.apply_async(self._delete_group, (name, False))
+                        progress = True
+                    elif time.time() > deadline:
+                        logging.error('unable to delete autoscale group %s after %s seconds, forcing deletion' % (name, self.timeout))
+                        for activity in groups[name].get_activities():
+                            logging.error('%s : %s' % (name, activity))
+                        deleting[name] = pool.apply_async(self._delete_group, (name, True))
+                    else:
+                        logging.debug('waiting for remaining %s instances in the %s autoscale group to finish shutting down' % (remaining_live_instances, name))
+
+                gone = set(x.name for x in self.autoscale_groups) - pending
+                for launch_configuration in self.launch_configurations:
+                    if launch_configuration.name in released:
+                        continue
+                    users = [x.name for x in self.autoscale_groups if x.launch_config_name == launch_configuration.name]
+                    if set(users) <= gone:
+                        released.add(launch_configuration.name)
+                        cleanups.append(pool.apply_async(self._delete_launch_configuration, (launch_configuration.name,)))
+                for load_balancer in self.load_balancers:
+                    if load_balancer.name in released:
+                        continue
+                    users = [x.name for x in self.autoscale_groups if load_balancer.name in x.load_balancers]
+                    if set(users) <= gone:
+                        released.add(load_balancer.name)
+                        cleanups.append(pool.apply_async(self._delete_load_balancer, (load_balancer.name,)))
+
+                if not pending:
+                    break
+                if time.time() > overall_deadline:
+                    # Groups stuck in delete-in-progress, and whatever depends
+                    # on them, are reported rather than polled forever
+                    remaining = ['autoscale group %s' % x for x in sorted(pending)]
+                    remaining.extend('launch configuration %s' % x.name for x in self.launch_configurations
+                                     if x.name not in released)
+                    remaining.extend('load balancer %s' % x.name for x in self.load_balancers
+                                     if x.name not in released)
+                    logging.error('gave up tearing down after %s seconds : %s' % (self.deadline, ', '.join(remaining)))
+                    break
+                backoff.sleep(progress)
+
+            for cleanup in cleanups:
+                # Re-raise anything that went wrong deleting a dependent resource
+                cleanup.get()
+        finally:
+            pool.close()
+            pool.join()
+        if remaining:
+            raise TeardownError(remaining)
+        return self.latencies
+
+    def report(self):
+        """Return the per-resource teardown latencies as a string."""
+        return '\n'.join(['%8.1fs %s' % (self.latencies[x], x)
+                          for x in sorted(self.latencies, key=lambda x: self.latencies[x])])
+
+def teardown(region, autoscale_groups, launch_configurations, load_balancers, **kwargs):
+    """Tear down the given boto autoscale groups, launch configurations and
+    load balancers and log how long each one took."""
+    engine = Teardown(region, autoscale_groups, launch_configurations, load_balancers, **kwargs)
+    try:
+        return engine.run()
+    finally:
+        logging.info('%s : teardown latencies in %s\n%s' % (time.strftime('%c'), region, engine.report()))
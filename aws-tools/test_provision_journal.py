@@ -0,0 +1,98 @@
+"""Tests for provision_journal, with the describe calls answered by a fake
+connection instead of AWS.
+
+    python -m unittest test_provision_journal
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import provision_journal
+
+class Resource:
+    def __init__(self, id):
+        self.id = id
+
+class FakeConnection:
+    """Answers the describe calls rebind makes with the resources in
+    existing, a set of ids."""
+    def __init__(self, existing):
+        self.existing = existing
+
+    def __getattr__(self, method):
+        def describe(filters):
+            id_filter = [x for x in filters if x.endswith('-id')][0]
+            return [Resource(x) for x in filters[id_filter] if x in self.existing]
+        return describe
+
+class ProvisionJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'provision-us-west-2.json')
+        self.existing = set()
+        self.created = 0
+        self.connect = provision_journal.connections.connect
+        provision_journal.connections.connect = lambda service, region: FakeConnection(self.existing)
+
+    def tearDown(self):
+        provision_journal.connections.connect = self.connect
+        shutil.rmtree(self.directory)
+
+    def create(self, prefix):
+        self.created += 1
+        id = '%s-%s' % (prefix, self.created)
+        self.existing.add(id)
+        return Resource(id)
+
+    def provision(self, journal, calls):
+        """Run the steps for one security group and one route table,
+        appending the steps that were actually done to calls."""
+        def step(name, func):
+            def run():
+                calls.append(name)
+                return func()
+            return run
+        group = journal.run('dev security group web', step('group', lambda: self.create('sg')),
+                            kind='security_group')
+        journal.run('dev security group rules web', step('rules', lambda: None),
+                    uses=['dev security group web'])
+        route_table = journal.run('dev route table public', step('route table', lambda: self.create('rtb')),
+                                  kind='route_table')
+        journal.run('dev route public', step('route', lambda: None),
+                    uses=['dev route table public'])
+        return group, route_table
+
+    def test_resume_skips_done_steps(self):
+        self.provision(provision_journal.ProvisionJournal('us-west-2', self.filename), [])
+        journal = provision_journal.ProvisionJournal('us-west-2', self.filename)
+        journal.rebind()
+        calls = []
+        self.provision(journal, calls)
+        self.assertEqual(calls, [])
+
+    def test_recreated_resources_are_changed_again(self):
+        group, route_table = self.provision(provision_journal.ProvisionJournal('us-west-2', self.filename), [])
+        self.existing.discard(group.id)
+        self.existing.discard(route_table.id)
+        journal = provision_journal.ProvisionJournal('us-west-2', self.filename)
+        journal.rebind()
+        calls = []
+        new_group, new_route_table = self.provision(journal, calls)
+        self.assertEqual(calls, ['group', 'rules', 'route table', 'route'])
+        self.assertNotEqual(new_group.id, group.id)
+        self.assertEqual(journal.entries['dev security group rules web']['uses'], [new_group.id])
+        self.assertEqual(journal.entries['dev route public']['uses'], [new_route_table.id])
+
+    def test_only_steps_of_recreated_resources_are_done_again(self):
+        group, route_table = self.provision(provision_journal.ProvisionJournal('us-west-2', self.filename), [])
+        self.existing.discard(route_table.id)
+        journal = provision_journal.ProvisionJournal('us-west-2', self.filename)
+        journal.rebind()
+        calls = []
+        self.provision(journal, calls)
+        self.assertEqual(calls, ['route table', 'route'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,34 +2,106 @@
 import json
 import argparse
 import logging
+import sys
+from multiprocessing.pool import ThreadPool
 logging.basicConfig(level=logging.INFO)
 
+def type_comma_delimited_string(string):
+  return string.split(',')
+
 parser = argparse.ArgumentParser(description='Update the autoscale json with a new set of AMIs')
-parser.add_argument('hash', 
+parser.add_argument('hash',
                     help='git hash of identity-ops that the instances were created from')
-parser.add_argument('filename', 
-                    help="Autoscale json file to update")
+parser.add_argument('filenames', nargs='+', metavar='filename',
+                    help="Autoscale json files to update")
 parser.add_argument('--tiers', nargs='+', default=['webhead', 'keysign', 'dbwrite'],
                    help='tiers to update (default: webhead, keysign, dbwrite)')
+parser.add_argument('--regions', default=['us-west-2', 'us-east-1'],
+                    type=type_comma_delimited_string, metavar='REGION,REGION...',
+                    help='regions every AMI must be available in (default: us-west-2,us-east-1)')
+parser.add_argument('--owner', default='self',
+                    help='owner of the AMIs (default: self)')
+parser.add_argument('--wait', action="store_true",
+                    help="wait for pending AMIs to become available instead of failing")
+parser.add_argument('--timeout', default=3600, type=int, metavar='SECONDS',
+                    help='how long to wait for pending AMIs (default: 3600)')
+parser.add_argument('--skip-check', action="store_true",
+                    help="don't check that the AMIs exist before updating")
 parser.add_argument('--dryrun', action="store_true",
                     help="don't actually change anything")
 
+def find_images(region, names):
+  """Return a dict of name to (AMI id, state) for the AMIs found in region."""
+  import connections
+  conn_ec2 = connections.connect('boto.ec2', region)
+  images = conn_ec2.get_all_images(owners=[args.owner], filters={'name': names})
+  return dict((x.name, (x.id, x.state)) for x in images)
+
+def check_images(names):
+  """Check that every AMI is available in every region, concurrently and with
+  one describe per region. Returns a list of problems."""
+  import waiters
+  pool = ThreadPool(len(args.regions))
+  try:
+    found = dict(zip(args.regions, pool.map(lambda x: find_images(x, names), args.regions)))
+  finally:
+    pool.close()
+    pool.join()
+
+  problems = []
+  pending = []
+  for region in args.regions:
+    for name in names:
+      if name not in found[region]:
+        problems.append('AMI %s does not exist in %s' % (name, region))
+        continue
+      ami_id, state = found[region][name]
+      if state == 'available':
+        logging.info('AMI %s is available in %s as %s' % (name, region, ami_id))
+      elif state == 'pending' and args.wait:
+        pending.append((region, ami_id))
+      else:
+        problems.append('AMI %s in %s is %s as %s' % (name, region, state, ami_id))
+  if pending:
+    try:
+      for region, ami_id, image in waiters.wait_for_images(pending, timeout=args.timeout):
+        logging.info('AMI %s is available in %s as %s' % (image.name, region, ami_id))
+    except waiters.WaiterError as error:
+      problems.extend('AMI %s in %s failed' % (x[1], x[0]) for x in error.failed)
+      problems.extend('AMI %s in %s is still pending' % (x[1], x[0]) for x in error.timed_out)
+  return problems
+
 args = parser.parse_args()
 
-with open(args.filename, 'r') as f:
-  autoscale = json.load(f)
-
-new_autoscale = []
-for item in autoscale:
-  for tier in args.tiers:
-    if item['launch_configuration']['tier'] == tier:
-      item['launch_configuration']['image_id'] = "persona-%s-%s" % (tier, args.hash)
-  new_autoscale.append(item)
-
-if args.dryrun:
-  logging.info("Would have written %s" % args.filename)
-  print json.dumps(new_autoscale, sort_keys=True, indent=4, separators=(',', ': '))
-else:
-  with open(args.filename, 'w') as f:
-    json.dump(new_autoscale, f, sort_keys=True, indent=4, separators=(',', ': '))
-  logging.info("Updated %s" % args.filename)
+autoscales = {}
+for filename in args.filenames:
+  with open(filename, 'r') as f:
+    autoscales[filename] = json.load(f)
+
+names = set()
+for filename in args.filenames:
+  new_autoscale = []
+  for item in autoscales[filename]:
+    for tier in args.tiers:
+      if item['launch_configuration']['tier'] == tier:
+        item['launch_configuration']['image_id'] = "persona-%s-%s" % (tier, args.hash)
+        names.add(item['launch_configuration']['image_id'])
+    new_autoscale.append(item)
+  autoscales[filename] = new_autoscale
+
+if names and not args.skip_check:
+  problems = check_images(sorted(names))
+  if problems:
+    for problem in problems:
+      logging.error(problem)
+    logging.error("Not updating %s" % ', '.join(args.filenames))
+    sys.exit(1)
+
+for filename in args.filenames:
+  if args.dryrun:
+    logging.info("Would have written %s" % filename)
+    print json.dumps(autoscales[filename], sort_keys=True, indent=4, separators=(',', ': '))
+  else:
+    with open(filename, 'w') as f:
+      json.dump(autoscales[filename], f, sort_keys=True, indent=4, separators=(',', ': '))
+    logging.info("Updated %s" % filename)
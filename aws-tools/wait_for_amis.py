@@ -1,20 +1,82 @@
 #!/usr/bin/env python
-import boto.ec2
+"""Wait for AMIs to become available.
+
+usage: wait_for_amis.py [-h] [-r REGION,REGION...] [-o OWNER] [-t SECONDS]
+                        AMIID|HASH [AMIID|HASH ...]
+
+Each argument is either an AMI id or a git hash. A hash matches every AMI
+whose name contains it, found with owner and name filters in each region.
+All the AMIs in all the regions are then checked together with one describe
+per region per tick.
+
+A line of JSON is printed as each AMI becomes available, followed by a
+summary line. The exit status is 0 if every AMI became available, 1 if any
+failed or timed out and 3 if nothing matched.
+"""
+
+import argparse
+import json
 import sys
-import time
-region='us-west-2'
-conn_ec2 = boto.ec2.connect_to_region(region)
-images = conn_ec2.get_all_images()
-if sys.argv[1][0:3] != 'ami':
-  print "searching for hash %s" % sys.argv[1]
-  ids = [x.id for x in images if sys.argv[1] in str(x.name)]
-else:
-  ids = sys.argv[1:]
-
-print "ids are '%s'" % ids
-
-for id in ids:
-  while conn_ec2.get_image(id).state != 'available':
-    print "waiting on %s" % id
-    time.sleep(10)
-  print "%s is available" % id
+
+def type_comma_delimited_string(string):
+  return string.split(',')
+
+def build_parser():
+  parser = argparse.ArgumentParser(description='Wait for AMIs to become available')
+  parser.add_argument('targets', nargs='+', metavar='AMIID|HASH',
+                      help='AMI ids, or git hashes that appear in AMI names')
+  parser.add_argument('-r', '--region', default=['us-west-2'],
+                      type=type_comma_delimited_string,
+                      metavar='REGION,REGION...',
+                      help='AWS regions to look for the AMIs in (default: us-west-2)')
+  parser.add_argument('-o', '--owner', default='self',
+                      help='Owner of the AMIs when searching by hash (default: self)')
+  parser.add_argument('-t', '--timeout', default=3600, type=int,
+                      metavar='SECONDS',
+                      help='How long to wait for each AMI (default: 3600)')
+  return parser
+
+def find_amis(region, targets, owner):
+  """Return the (region, AMI id) of every AMI in region matching targets."""
+  import connections
+  import waiters
+  conn_ec2 = connections.connect('boto.ec2', region)
+  ids = [x for x in targets if x.startswith('ami-')]
+  hashes = [x for x in targets if not x.startswith('ami-')]
+  images = []
+  if ids:
+    images.extend(waiters.describe_images(region, ids))
+  if hashes:
+    images.extend(conn_ec2.get_all_images(owners=[owner],
+                                          filters={'name': ['*%s*' % x for x in hashes]}))
+  return sorted(set((region, x.id) for x in images))
+
+def main(argv=None):
+  import waiters
+  args = build_parser().parse_args(argv)
+  found = sum([find_amis(region, args.targets, args.owner) for region in args.region], [])
+  matched = set(x[1] for x in found)
+  not_found = [x for x in args.targets if x.startswith('ami-') and x not in matched]
+  print json.dumps({'event': 'found', 'amis': ['%s:%s' % x for x in found]}, sort_keys=True)
+  sys.stdout.flush()
+
+  status = {'event': 'done', 'available': [], 'failed': [], 'timed_out': [],
+            'not_found': not_found}
+  try:
+    for region, ami_id, image in waiters.wait_for_images(found, timeout=args.timeout):
+      status['available'].append('%s:%s' % (region, ami_id))
+      print json.dumps({'event': 'available', 'region': region, 'ami': ami_id}, sort_keys=True)
+      sys.stdout.flush()
+  except waiters.WaiterError as error:
+    status['failed'] = ['%s:%s' % x for x in error.failed]
+    status['timed_out'] = ['%s:%s' % x for x in error.timed_out]
+  print json.dumps(status, sort_keys=True)
+
+  if not found:
+    return 3
+  if status['failed'] or status['timed_out'] or not_found:
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
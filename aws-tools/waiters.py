@@ -0,0 +1,149 @@
+"""Wait for many AWS resources at once.
+
+Resources are given as (region, id) pairs. Every tick each region's pending
+ids are checked with a single batched describe call, and the generator
+yields (region, id, resource) for each resource as soon as it's ready so the
+caller can start the next step for it straight away:
+
+    for region, image_id, image in waiters.wait_for_images(pairs):
+        share(region, image_id)
+
+The time between ticks starts short, backs off while nothing changes and
+drops back down whenever something does, with jitter so that concurrent
+waiters don't poll in lockstep. Each resource has its own timeout. Once
+every resource is ready, failed or timed out, WaiterError is raised if any
+of them didn't become ready.
+"""
+
+import logging
+import random
+import time
+
+import connections
+
+class WaiterError(Exception):
+    def __init__(self, description, failed, timed_out):
+        self.failed = failed
+        self.timed_out = timed_out
+        Exception.__init__(self, '%s failed : %s, timed out : %s' % (
+            description,
+            ', '.join('%s:%s' % x for x in failed) or 'none',
+            ', '.join('%s:%s' % x for x in timed_out) or 'none'))
+
+class Backoff:
+    """Sleep between polls, backing off while nothing is changing."""
+    def __init__(self, interval=5, max_interval=60, factor=1.5, jitter=0.2):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.current = interval
+
+    def sleep(self, progress=False):
+        if progress:
+            self.current = self.interval
+        delay = self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(delay)
+        self.current = min(self.current * self.factor, self.max_interval)
+        return delay
+
+def wait(items,
+         describe,
+         is_ready,
+         is_failed=None,
+         get_id=None,
+         missing_is_ready=False,
+         timeout=600,
+         interval=5,
+         max_interval=60,
+         description='resource'):
+    """Yield (region, id, resource) for each item as it becomes ready.
+
+    items is a list of (region, id) pairs. describe(region, ids) returns the
+    resources that currently exist for some of the ids. get_id(resource)
+    returns a resource's id and defaults to resource.id. If missing_is_ready
+    is set, an id that describe no longer returns counts as ready and is
+    yielded with a resource of None. timeout is either a number of seconds
+    or a dict of (region, id) to seconds.
+    """
+    get_id = get_id or (lambda x: x.id)
+    started = time.time()
+    deadlines = {}
+    for item in items:
+        deadlines[item] = started + (timeout[item] if isinstance(timeout, dict) else timeout)
+    pending = list(deadlines.keys())
+    states = {}
+    failed = []
+    timed_out = []
+    backoff = Backoff(interval, max_interval)
+    while pending:
+        progress = False
+        regions = {}
+        for region, resource_id in pending:
+            regions.setdefault(region, []).append(resource_id)
+        for region in sorted(regions):
+            resources = dict((get_id(x), x) for x in describe(region, regions[region]))
+            for resource_id in regions[region]:
+                item = (region, resource_id)
+                resource = resources.get(resource_id)
+                state = getattr(resource, 'state', resource is not None)
+                if states.get(item) != state:
+                    states[item] = state
+                    progress = True
+                if resource is None and missing_is_ready or resource is not None and is_ready(resource):
+                    pending.remove(item)
+                    logging.info('%s %s in %s is ready after %.0fs' % (description, resource_id, region, time.time() - started))
+                    yield region, resource_id, resource
+                elif resource is not None and is_failed and is_failed(resource):
+                    pending.remove(item)
+                    failed.append(item)
+                    logging.error('%s %s in %s failed' % (description, resource_id, region))
+                elif time.time() > deadlines[item]:
+                    pending.remove(item)
+                    timed_out.append(item)
+                    logging.error('%s %s in %s still not ready after %.0fs' % (description, resource_id, region, time.time() - started))
+        if pending:
+            logging.debug('waiting on %s %s' % (description, ', '.join('%s:%s' % x for x in pending)))
+            backoff.sleep(progress)
+    if failed or timed_out:
+        raise WaiterError(description, failed, timed_out)
+
+def wait_all(items, describe, is_ready, callback=None, **kwargs):
+    """Wait for every item, calling callback(region, id, resource) as each
+    becomes ready. Returns a dict of (region, id) to resource."""
+    ready = {}
+    for region, resource_id, resource in wait(items, describe, is_ready, **kwargs):
+        ready[(region, resource_id)] = resource
+        if callback:
+            callback(region, resource_id, resource)
+    return ready
+
+def describe_images(region, ids):
+    # Filtering on image-id rather than passing image_ids means ids that
+    # don't exist yet (a copy that's just been started) don't fail the call
+    conn_ec2 = connections.connect('boto.ec2', region)
+    return conn_ec2.get_all_images(filters={'image-id': ids})
+
+def describe_instances(region, ids):
+    conn_ec2 = connections.connect('boto.ec2', region)
+    reservations = conn_ec2.get_all_instances(filters={'instance-id': ids})
+    return sum([x.instances for x in reservations], [])
+
+def wait_for_images(items, **kwargs):
+    """Yield each (region, image id) as the image becomes available."""
+    kwargs.setdefault('description', 'AMI')
+    kwargs.setdefault('interval', 10)
+    return wait(items,
+                describe_images,
+                lambda x: x.state == 'available',
+                is_failed=lambda x: x.state == 'failed',
+                **kwargs)
+
+def wait_for_instances(items, state='running', **kwargs):
+    """Yield each (region, instance id) as the instance enters state."""
+    kwargs.setdefault('description', 'instance')
+    return wait(items,
+                describe_instances,
+                lambda x: x.state == state,
+                is_failed=lambda x: x.state in ['shutting-down', 'terminated'] and state != x.state,
+                **kwargs)